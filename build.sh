@@ -10,9 +10,9 @@ pip install pyinstaller
 pip install torch --index-url https://download.pytorch.org/whl/cpu
 pip install diffusers transformers Pillow requests ollama
 
-cp ./src/imagine.py ./src/imagine_server.py ./src/imagine_run.py ./src/imagine_enhance.py ./src/imagine_server_defs.py ./src/imagine_list.py -t build/
+cp ./src/imagine.py ./src/imagine_server.py ./src/imagine_run.py ./src/imagine_enhance.py ./src/imagine_server_defs.py ./src/imagine_list.py ./src/imagine_pipes.py ./src/imagine_jobs.py ./src/imagine_preview.py ./src/imagine_frames.py ./src/imagine_server_async.py ./src/imagine_embeds.py ./src/imagine_results.py ./src/imagine_grid.py ./src/imagine_store.py ./src/imagine_catalog.py ./src/imagine_metrics.py ./src/imagine_bench.py ./src/imagine_fake.py ./src/imagine_loadtest.py ./src/imagine_workers.py ./src/imagine_deepcache.py ./src/imagine_tiled.py ./src/imagine_png.py ./src/imagine_index.py -t build/
 
 cd build
-pyinstaller --onefile --collect-all diffusers --collect-all ollama --hidden-import imagine_run --hidden-import imagine_server --hidden-import imagine_server_defs --hidden-import imagine_enhance --hidden-import imagine_list --add-data="imagine_run.py:." --add-data="imagine_list.py:." --add-data="imagine_server.py:." --add-data="imagine_server_defs.py:." --add-data="imagine_enhance.py:." imagine.py
+pyinstaller --onefile --collect-all diffusers --collect-all ollama --hidden-import imagine_run --hidden-import imagine_server --hidden-import imagine_server_defs --hidden-import imagine_enhance --hidden-import imagine_list --hidden-import imagine_index --hidden-import imagine_png --hidden-import imagine_tiled --hidden-import imagine_deepcache --hidden-import imagine_workers --hidden-import imagine_loadtest --hidden-import imagine_fake --hidden-import imagine_bench --hidden-import imagine_metrics --hidden-import imagine_catalog --hidden-import imagine_store --hidden-import imagine_grid --hidden-import imagine_results --hidden-import imagine_embeds --hidden-import imagine_server_async --hidden-import imagine_frames --hidden-import imagine_preview --hidden-import imagine_jobs --hidden-import imagine_pipes --add-data="imagine_run.py:." --add-data="imagine_list.py:." --add-data="imagine_server.py:." --add-data="imagine_server_defs.py:." --add-data="imagine_enhance.py:." --add-data="imagine_pipes.py:." --add-data="imagine_jobs.py:." --add-data="imagine_preview.py:." --add-data="imagine_frames.py:." --add-data="imagine_server_async.py:." --add-data="imagine_embeds.py:." --add-data="imagine_results.py:." --add-data="imagine_grid.py:." --add-data="imagine_store.py:." --add-data="imagine_catalog.py:." --add-data="imagine_metrics.py:." --add-data="imagine_bench.py:." --add-data="imagine_fake.py:." --add-data="imagine_loadtest.py:." --add-data="imagine_workers.py:." --add-data="imagine_deepcache.py:." --add-data="imagine_tiled.py:." --add-data="imagine_png.py:." --add-data="imagine_index.py:." imagine.py
 
 mv dist/imagine ../imagine
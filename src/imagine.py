@@ -2,15 +2,21 @@
 
 import random
 import argparse
+import multiprocessing
 
 import imagine_run
 import imagine_list
+import imagine_index
+import imagine_loadtest
 import imagine_enhance
 import imagine_server_defs
 
 
 # main
 if __name__ == '__main__':
+    # worker processes of pyinstaller builds start through the executable
+    multiprocessing.freeze_support()
+
     parser = argparse.ArgumentParser(description='SD image generator CLI', add_help=False)
     subparsers = parser.add_subparsers(dest='command', help='Commands')
     parser.add_argument('--help', action='help')
@@ -29,18 +35,64 @@ if __name__ == '__main__':
     run_parser.add_argument('--sampler', default='dpm++ 2m', type=str, help=f'SD Sampler {imagine_run.SAMPLERS}')
     run_parser.add_argument('-i', '--img', default=None, type=str, help='Input image')
     run_parser.add_argument('-f', '--hires', default=None, type=float, help='High Resolution fix')
+    run_parser.add_argument('--hires_upscale', default=imagine_server_defs.DEFAULT_HIRES_UPSCALE, type=str, choices=imagine_server_defs.HIRES_UPSCALERS, help='Upscale decoded image or latents (no VAE round trip) before High Resolution fix pass')
     run_parser.add_argument('--seed', default=random.randint(0, 2**64 - 1), type=int, help='Seed')
+    run_parser.add_argument('--count', default=1, type=int, help='Number of images, generated with consecutive seeds starting at `--seed`')
     run_parser.add_argument('--neg', default='ugly, deformed, blurry, low quality', type=str, help='Negative prompt')
     run_parser.add_argument('-s', '--stream', default=None, type=int, help='Stream steps samples to output image')
-    run_parser.add_argument('prompt', nargs='+', type=str, help='Prompt for model')
+    run_parser.add_argument('--preview', default=None, type=str, choices=imagine_server_defs.PREVIEW_MODES, help='Decoder of streamed samples (server default if not set)')
+    run_parser.add_argument('--memory', default=None, type=str, choices=imagine_server_defs.MEMORY_MODES, help='Memory mode of the generation (server default if not set)')
+    run_parser.add_argument('--cache_interval', default=None, type=int, help='UNet calls per full one, calls in between reuse deep features for faster steps (server default if not set)')
+    run_parser.add_argument('--tile', default=None, type=int, help='Denoise outputs larger than this size (px) in overlapping blended tiles, for sizes beyond device memory (hires.fix result or `--img` upscaled to `-w`x`-h`)')
+    run_parser.add_argument('--tile_overlap', default=imagine_server_defs.DEFAULT_TILE_OVERLAP, type=int, help='Overlap (px) of neighbouring tiles')
+    run_parser.add_argument('--batch', default=None, type=str, help='JSONL or CSV file of payloads (`prompt`, `seed`, `output`, ...) generated with the other options as defaults, `-o` is output directory')
+    run_parser.add_argument('-j', '--concurrency', default=imagine_run.DEFAULT_CONCURRENCY, type=int, help='Number of concurrent requests in batch mode')
+    run_parser.add_argument('prompt', nargs='*', type=str, help='Prompt for model')
     run_parser.add_argument('-a', '--address', default='0.0.0.0:5000', type=str, help='Server host address')
     run_parser.add_argument('--help', action='help')
 
+    # grid
+    grid_parser = subparsers.add_parser('grid', help='SD parameter sweep with contact sheet', add_help=False)
+    grid_parser.add_argument('-m', '--model', default=imagine_run.DEFAULT_MODEL, type=str, help='SD model')
+    grid_parser.add_argument('-o', '--output', default=None, type=str, help='Output contact sheet, cells are saved next to it')
+    grid_parser.add_argument('-w', '--width', default=512, type=int, help='Output image width')
+    grid_parser.add_argument('-h', '--height', default=512, type=int, help='Output image height')
+    grid_parser.add_argument('-n', '--steps', default='25', type=str, help='Number of steps, comma separated values or `a..b` range to sweep')
+    grid_parser.add_argument('-g', '--guidance', default='7.0', type=str, help='Guidance scale, comma separated values to sweep')
+    grid_parser.add_argument('-c', '--clip', default='1', type=str, help='Clip skip, comma separated values to sweep')
+    grid_parser.add_argument('--sampler', default='dpm++ 2m', type=str, help=f'SD Sampler, comma separated values to sweep {imagine_run.SAMPLERS}')
+    grid_parser.add_argument('--seed', default=str(random.randint(0, 2**64 - 1)), type=str, help='Seed, comma separated values or `a..b` range to sweep')
+    grid_parser.add_argument('--neg', default='ugly, deformed, blurry, low quality', type=str, help='Negative prompt')
+    grid_parser.add_argument('prompt', nargs='+', type=str, help='Prompt for model')
+    grid_parser.add_argument('-a', '--address', default='0.0.0.0:5000', type=str, help='Server host address')
+    grid_parser.add_argument('--help', action='help')
+
     # info
     info_parser = subparsers.add_parser('info', help='Get generated image meta information', add_help=False)
     info_parser.add_argument('img',  type=str, help='Input image')
     info_parser.add_argument('--help', action='help')
 
+    # index
+    index_parser = subparsers.add_parser('index', help='Index meta of generated images for search, only changed files are read again', add_help=False)
+    index_parser.add_argument('dirs', nargs='*', default=['.'], type=str, help='Directories of generated images (current directory if not set)')
+    index_parser.add_argument('--index', default=imagine_index.DEFAULT_INDEX_PATH, type=str, help='SQLite index file')
+    index_parser.add_argument('-j', '--workers', default=imagine_index.DEFAULT_INDEX_WORKERS, type=int, help='Number of files read in parallel')
+    index_parser.add_argument('--help', action='help')
+
+    # search
+    search_parser = subparsers.add_parser('search', help='Search indexed generated images by meta', add_help=False)
+    search_parser.add_argument('terms', nargs='*', type=str, help='Text the prompt contains, all terms must match')
+    search_parser.add_argument('-m', '--model', default=None, type=str, help='SD model')
+    search_parser.add_argument('--seed', default=None, type=str, help='Seed')
+    search_parser.add_argument('--sampler', default=None, type=str, help='SD Sampler')
+    search_parser.add_argument('-w', '--width', default=None, type=int, help='Image width')
+    search_parser.add_argument('-h', '--height', default=None, type=int, help='Image height')
+    search_parser.add_argument('-n', '--steps', default=None, type=int, help='Number of steps')
+    search_parser.add_argument('-l', '--limit', default=imagine_index.DEFAULT_SEARCH_LIMIT, type=int, help='Max number of results, latest first')
+    search_parser.add_argument('--paths', action='store_true', help='Print paths only')
+    search_parser.add_argument('--index', default=imagine_index.DEFAULT_INDEX_PATH, type=str, help='SQLite index file')
+    search_parser.add_argument('--help', action='help')
+
     # convert
     convert_parser = subparsers.add_parser('convert', help='Convert generated image to json meta and vice versa', add_help=False)
     convert_parser.add_argument('filename',  type=str, help='JSON metadata or generated image')
@@ -62,8 +114,67 @@ if __name__ == '__main__':
     server_parser.add_argument('-p', '--port', default=5000, type=int, help='Server port')
     server_parser.add_argument('-d', '--device', default=imagine_server_defs.DEFAULT_DEVICE, type=str,  choices=['cpu', 'cuda', 'mps'], help='Model compute device')
     server_parser.add_argument('-f', '--full_prec', action='store_true', help='Use full (float32) floating point precision instead of float16 (default).')
+    server_parser.add_argument('--max_models', default=imagine_server_defs.DEFAULT_MAX_MODELS, type=int, help='Max number of models kept loaded in memory')
+    server_parser.add_argument('--mem_reserve', default=imagine_server_defs.DEFAULT_MEM_RESERVE, type=int, help='Device memory (MiB) to keep free, least recently used models are unloaded to keep it')
+    server_parser.add_argument('--store', default=imagine_server_defs.DEFAULT_STORE_PATH, type=str, help='Directory of models converted to diffusers layout at compute precision for fast loading, empty string disables it')
+    server_parser.add_argument('--store_size', default=imagine_server_defs.DEFAULT_STORE_SIZE, type=int, help='Disk space (MiB) for converted models, least recently loaded ones are removed to keep it, 0 (default) disables the store')
+    server_parser.add_argument('--embed_cache', default=imagine_server_defs.DEFAULT_EMBED_CACHE, type=int, help='Memory (MiB) for cached prompt embeddings, 0 disables the cache')
+    server_parser.add_argument('--cache_dir', default=imagine_server_defs.DEFAULT_CACHE_PATH, type=str, help='Directory of cached generated images')
+    server_parser.add_argument('--cache_size', default=imagine_server_defs.DEFAULT_CACHE_SIZE, type=int, help='Disk space (MiB) for cached generated images, 0 (default) disables the cache')
+    server_parser.add_argument('-q', '--queue_size', default=imagine_server_defs.DEFAULT_QUEUE_SIZE, type=int, help='Max number of queued generation requests, further ones are rejected with 429')
+    server_parser.add_argument('-b', '--max_batch', default=imagine_server_defs.DEFAULT_MAX_BATCH, type=int, help='Max number of compatible requests denoised together in one batch')
+    server_parser.add_argument('--batch_window', default=imagine_server_defs.DEFAULT_BATCH_WINDOW, type=int, help='Time (ms) to wait for compatible requests to join a batch')
+    server_parser.add_argument('--preview', default=imagine_server_defs.DEFAULT_PREVIEW, type=str, choices=imagine_server_defs.PREVIEW_MODES, help='Default decoder of streamed samples: full VAE, linear latent approximation or tiny autoencoder (`taesd` in models path)')
+    server_parser.add_argument('--memory', default=imagine_server_defs.DEFAULT_MEMORY, type=str, choices=imagine_server_defs.MEMORY_MODES, help='Default memory mode: pick by size and free memory, none, VAE tiling/slicing (`tiled`), plus attention slicing (`sliced`), model or sequential cpu offload (cuda)')
+    server_parser.add_argument('--quant', default=imagine_server_defs.DEFAULT_QUANT, type=str, choices=imagine_server_defs.QUANT_MODES, help='Quantize UNet and text encoder linear layers of loaded models (cpu, float32 otherwise)')
+    server_parser.add_argument('--cache_interval', default=imagine_server_defs.DEFAULT_CACHE_INTERVAL, type=int, help='Default number of denoising UNet calls per full one, calls in between reuse deep features (1 disables)')
+    server_parser.add_argument('--tile_batch', default=imagine_server_defs.DEFAULT_TILE_BATCH, type=int, help='Tiles denoised together in one UNet call for tiled requests')
+    server_parser.add_argument('--preload', default=None, type=str, help='Comma separated models loaded before generation requests are accepted')
+    server_parser.add_argument('--warmup', action='store_true', help='Run a tiny generation per preloaded model, warmup sampler and size before generation requests are accepted')
+    server_parser.add_argument('--warmup_samplers', default='dpm++ 2m', type=str, help='Comma separated samplers to warm up')
+    server_parser.add_argument('--warmup_sizes', default=imagine_server_defs.DEFAULT_WARMUP_SIZES, type=str, help='Comma separated WIDTHxHEIGHT sizes to warm up')
+    server_parser.add_argument('--compile', action='store_true', help='torch.compile UNet and VAE decoder of loaded models (slow first generation per size, use with `--warmup`)')
+    server_parser.add_argument('--compile_cache', default=imagine_server_defs.DEFAULT_COMPILE_CACHE, type=str, help='Persistent compiled kernels cache directory')
+    server_parser.add_argument('--fake', action='store_true', help='Serve stub model `fake` without weights on cpu, for load tests of the server itself')
+    server_parser.add_argument('--fake_step', default=imagine_server_defs.DEFAULT_FAKE_STEP, type=int, help='Time (ms) per denoising step of the stub model')
+    server_parser.add_argument('--fake_size', default=None, type=str, help='WIDTHxHEIGHT of stub model images (requested size if not set)')
+    server_parser.add_argument('--async', dest='async_server', action='store_true', help='Use asyncio server: keep-alive connections, immediate cancellation of disconnected requests')
+    server_parser.add_argument('--workers', nargs='?', default=0, const=-1, type=int, help='Run generations in worker processes: one per GPU or CPU NUMA node without a number, else that many (cpu cores split between them)')
     server_parser.add_argument('--help', action='help')
 
+    # bench
+    bench_parser = subparsers.add_parser('bench', help='Offline server benchmark on a tiny random model', add_help=False)
+    bench_parser.add_argument('-o', '--output', default=None, type=str, help='Output JSON results (stdout if not set)')
+    bench_parser.add_argument('-w', '--width', default=64, type=int, help='Image width')
+    bench_parser.add_argument('-h', '--height', default=64, type=int, help='Image height')
+    bench_parser.add_argument('-n', '--steps', default=4, type=int, help='Number of steps per /generate request')
+    bench_parser.add_argument('-f', '--full_prec', action='store_true', help='Use full (float32) floating point precision instead of bfloat16 (server default on cpu)')
+    bench_parser.add_argument('-q', '--quant', default=imagine_server_defs.DEFAULT_QUANT, type=str, choices=imagine_server_defs.QUANT_MODES, help='Also benchmark quantized stages and serve quantized, with image quality (PSNR) against float32')
+    bench_parser.add_argument('-m', '--model', default=None, type=str, help='Benchmark a checkpoint or diffusers model directory instead of the tiny random model')
+    bench_parser.add_argument('-r', '--repeat', default=imagine_server_defs.DEFAULT_BENCH_REPEAT, type=int, help='Timed runs per stage')
+    bench_parser.add_argument('-c', '--concurrency', default=imagine_server_defs.DEFAULT_BENCH_CONCURRENCY, type=str, help='Comma separated numbers of concurrent /generate clients, empty string skips the server benchmark')
+    bench_parser.add_argument('--requests', default=imagine_server_defs.DEFAULT_BENCH_REQUESTS, type=int, help='Number of /generate requests per concurrency level')
+    bench_parser.add_argument('--compare', default=None, type=str, help='Baseline JSON results, exits with code 1 on regressions')
+    bench_parser.add_argument('--threshold', default=imagine_server_defs.DEFAULT_BENCH_THRESHOLD, type=float, help='Relative slowdown against baseline counted as regression')
+    bench_parser.add_argument('--help', action='help')
+
+    # loadtest
+    loadtest_parser = subparsers.add_parser('loadtest', help='Load test a server with concurrent streaming, non-streaming and disconnecting clients', add_help=False)
+    loadtest_parser.add_argument('-m', '--model', default='fake', type=str, help='SD model (`fake` of `serve --fake`)')
+    loadtest_parser.add_argument('-c', '--clients', default=imagine_loadtest.DEFAULT_CLIENTS, type=int, help='Number of concurrent clients')
+    loadtest_parser.add_argument('-n', '--requests', default=imagine_loadtest.DEFAULT_REQUESTS, type=int, help='Total number of requests')
+    loadtest_parser.add_argument('--steps', default=10, type=int, help='Number of steps per request')
+    loadtest_parser.add_argument('-w', '--width', default=64, type=int, help='Image width')
+    loadtest_parser.add_argument('-h', '--height', default=64, type=int, help='Image height')
+    loadtest_parser.add_argument('--stream', default=0.4, type=float, help='Share of all requests that stream to the end')
+    loadtest_parser.add_argument('--disconnect', default=0.1, type=float, help='Share of all requests that stream and disconnect after the first record')
+    loadtest_parser.add_argument('--abort', default=0.05, type=float, help='Share of all requests that don\'t stream and give up before the result')
+    loadtest_parser.add_argument('--seed', default=0, type=int, help='Seed of the client behaviour mix')
+    loadtest_parser.add_argument('--settle', default=imagine_loadtest.DEFAULT_SETTLE, type=int, help='Max time (s) to wait for the server to drain before checking for leaks')
+    loadtest_parser.add_argument('-o', '--output', default=None, type=str, help='Output JSON report')
+    loadtest_parser.add_argument('-a', '--address', default='0.0.0.0:5000', type=str, help='Server host address')
+    loadtest_parser.add_argument('--help', action='help')
+
     # list
     list_parser = subparsers.add_parser('list', help='List available models', add_help=False)
     list_parser.add_argument('-a', '--address', default='0.0.0.0:5000', type=str, help='Server host address')
@@ -76,12 +187,23 @@ if __name__ == '__main__':
         imagine_server.serve(args)
     elif args.command == 'run':
         imagine_run.run(args)
+    elif args.command == 'grid':
+        imagine_run.grid(args)
     elif args.command == 'info':
         imagine_run.info(args)
+    elif args.command == 'index':
+        imagine_index.index(args)
+    elif args.command == 'search':
+        imagine_index.search(args)
     elif args.command == 'enhance':
         imagine_enhance.enhance(args)
     elif args.command == 'convert':
         imagine_run.convert(args)
+    elif args.command == 'bench':
+        import imagine_bench
+        imagine_bench.bench(args)
+    elif args.command == 'loadtest':
+        imagine_loadtest.loadtest(args)
     elif args.command == 'list':
         imagine_list.list_models(args)
     else:
@@ -0,0 +1,400 @@
+import os
+import sys
+import json
+import math
+import time
+import socket
+import platform
+import contextlib
+import tempfile
+import statistics
+import subprocess
+import concurrent.futures
+
+import numpy
+import torch
+import requests
+import diffusers
+import transformers
+
+import imagine_pipes
+import imagine_server
+
+
+BENCH_MODEL = 'tiny'
+BENCH_PROMPT = 'a photograph of an astronaut riding a horse'
+BENCH_NEG = 'ugly, deformed, blurry, low quality'
+
+SERVER_START_TIMEOUT = 120 # s
+
+# metrics where higher is better, all others are durations
+THROUGHPUT_METRICS = ('throughput',)
+QUALITY_GROUP = 'quality' # PSNR (dB) against float32
+
+
+def byte_chars():
+    # printable characters of the CLIP byte-level BPE alphabet
+    codes = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(range(ord('®'), ord('ÿ') + 1))
+    chars = codes[:]
+
+    # remaining bytes map to code points past 255
+    shifted = 0
+    for byte in range(256):
+        if byte not in codes:
+            codes.append(byte)
+            chars.append(256 + shifted)
+            shifted += 1
+    return [chr(char) for char in chars]
+
+
+def build_tiny_model(path, seed=0):
+    # randomly initialised SD 1.x architecture in diffusers layout, built offline and deterministic for `seed`
+    torch.manual_seed(seed)
+
+    tokenizer_path = os.path.join(path, 'vocab')
+    os.makedirs(tokenizer_path, exist_ok=True)
+
+    # byte-level vocabulary without merges, every character is a token
+    vocab = {}
+    for suffix in ('', '</w>'):
+        for char in byte_chars():
+            vocab[char + suffix] = len(vocab)
+    vocab['<|startoftext|>'] = len(vocab)
+    vocab['<|endoftext|>'] = len(vocab)
+
+    with open(os.path.join(tokenizer_path, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(tokenizer_path, 'merges.txt'), 'w') as f:
+        f.write('#version: 0.2\n')
+
+    tokenizer = transformers.CLIPTokenizer(os.path.join(tokenizer_path, 'vocab.json'), os.path.join(tokenizer_path, 'merges.txt'), model_max_length=77)
+    text_encoder = transformers.CLIPTextModel(transformers.CLIPTextConfig(
+        vocab_size=len(vocab), hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4,
+        max_position_embeddings=77, bos_token_id=vocab['<|startoftext|>'], eos_token_id=vocab['<|endoftext|>'], pad_token_id=vocab['<|endoftext|>']
+    ))
+    unet = diffusers.UNet2DConditionModel(
+        block_out_channels=(32, 64), layers_per_block=2, sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=('CrossAttnDownBlock2D', 'DownBlock2D'), up_block_types=('UpBlock2D', 'CrossAttnUpBlock2D'),
+        cross_attention_dim=32, norm_num_groups=32
+    )
+    vae = diffusers.AutoencoderKL(
+        block_out_channels=[32, 64], in_channels=3, out_channels=3, latent_channels=4, norm_num_groups=32,
+        down_block_types=['DownEncoderBlock2D'] * 2, up_block_types=['UpDecoderBlock2D'] * 2
+    )
+    scheduler = diffusers.DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule='scaled_linear', clip_sample=False, set_alpha_to_one=False, steps_offset=1)
+
+    pipe = diffusers.StableDiffusionPipeline(
+        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet, scheduler=scheduler,
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False
+    )
+    pipe.save_pretrained(path, safe_serialization=True)
+
+
+def summarize(durations):
+    # seconds -> {median, min, max, runs}
+    return {
+        'median': statistics.median(durations),
+        'min': min(durations),
+        'max': max(durations),
+        'runs': len(durations)
+    }
+
+
+def measure(fn, repeat):
+    # one untimed warmup call, then `repeat` timed ones
+    fn()
+
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
+
+
+@torch.no_grad()
+def bench_stages(model_path, fp_prec, args, quant='none'):
+    # hot path stages in process, on the same helpers the server uses
+    results = {}
+    load = lambda: imagine_pipes.quantize_pipe(imagine_pipes.load_pipe(model_path, 'cpu', fp_prec), quant)
+
+    print(f'Benchmarking model load: {model_path}' + (f' ({quant})' if quant != 'none' else ''))
+    results['load'] = measure(load, args.repeat)
+    pipe = load()
+
+    print('Benchmarking text encoding')
+    encode = lambda: pipe.encode_prompt(BENCH_PROMPT, 'cpu', num_images_per_prompt=1, do_classifier_free_guidance=True, negative_prompt=BENCH_NEG)
+    results['encode'] = measure(encode, args.repeat)
+    embeds, neg_embeds = encode()
+
+    # one classifier-free guidance step: unconditional and conditional latents in one batch
+    print('Benchmarking UNet step')
+    generator = torch.Generator('cpu').manual_seed(0)
+    latents = torch.randn((1, pipe.unet.config.in_channels, args.height // 8, args.width // 8), generator=generator).to(fp_prec)
+    timestep = torch.tensor(500)
+    hidden_states = torch.cat([neg_embeds, embeds])
+    results['step'] = measure(lambda: pipe.unet(torch.cat([latents] * 2), timestep, encoder_hidden_states=hidden_states).sample, args.repeat)
+
+    print('Benchmarking VAE decode')
+    results['decode'] = measure(lambda: imagine_pipes.decode_images(pipe, latents), args.repeat)
+    image = imagine_pipes.decode_images(pipe, latents)[0]
+
+    print('Benchmarking image encoding')
+    results['png'] = measure(lambda: imagine_server.encode_png(image), args.repeat)
+    png = imagine_server.encode_png(image)
+
+    record = {"img": png, "seed": "0", "index": 0, "format": "png", "status": "final"}
+    results['record'] = measure(lambda: imagine_server.encode_record(record, False), args.repeat)
+
+    return results
+
+
+@torch.no_grad()
+def render(pipe, args):
+    # fixed seed txt2img image
+    pipe.set_progress_bar_config(disable=True)
+    generator = torch.Generator('cpu').manual_seed(0)
+    return pipe(prompt=BENCH_PROMPT, negative_prompt=BENCH_NEG, width=args.width, height=args.height, num_inference_steps=args.steps, generator=generator).images[0]
+
+
+def psnr(reference, image):
+    # peak signal to noise ratio (dB) of 8 bit images, inf if identical
+    mse = numpy.mean((numpy.asarray(reference, dtype=numpy.float64) - numpy.asarray(image, dtype=numpy.float64)) ** 2)
+    return 10 * math.log10(255**2 / mse) if mse > 0 else float('inf')
+
+
+def bench_quality(model_path, fp_prec, args):
+    # PSNR against float32 of the benchmarked precision and quantization, same seed and prompt
+    print('Measuring image quality against float32')
+    reference = render(imagine_pipes.load_pipe(model_path, 'cpu', torch.float32), args)
+
+    quality = {}
+    if fp_prec != torch.float32:
+        quality[str(fp_prec).split('.')[-1]] = psnr(reference, render(imagine_pipes.load_pipe(model_path, 'cpu', fp_prec), args))
+    if args.quant != 'none':
+        pipe = imagine_pipes.quantize_pipe(imagine_pipes.load_pipe(model_path, 'cpu', torch.float32), args.quant)
+        quality[args.quant] = psnr(reference, render(pipe, args))
+
+    for name, value in quality.items():
+        print(f'PSNR {name}: {value:.2f} dB')
+
+    # JSON has no infinity, identical images are written as "inf"
+    return {name: value if math.isfinite(value) else 'inf' for name, value in quality.items()}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command():
+    # pyinstaller builds are the imagine executable itself
+    if getattr(sys, 'frozen', False):
+        return [sys.executable]
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imagine.py')]
+
+
+def start_server(models_path, port, args, log_file):
+    # cpu server without result cache, store or warmup, so every request is generated
+    command = server_command() + [
+        'serve', '--host', '127.0.0.1', '-p', str(port), '-d', 'cpu', '-m', models_path,
+        '--store', '', '--cache_size', '0', '--mem_reserve', '0', '-q', str(max(args.levels) * 2)
+    ]
+    if args.full_prec:
+        command.append('-f')
+    if args.quant != 'none':
+        command += ['--quant', args.quant]
+
+    server = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Benchmark server exited with code {server.returncode}')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/ready', timeout=1).status_code == 200:
+                return server
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError(f'Benchmark server did not become ready in {SERVER_START_TIMEOUT}s')
+
+
+def generate(session, url, args, seed):
+    payload = {
+        'model': args.model_name,
+        'prompt': BENCH_PROMPT,
+        'neg': BENCH_NEG,
+        'width': args.width,
+        'height': args.height,
+        'steps': args.steps,
+        'seed': seed,
+        'cache': False
+    }
+
+    started = time.perf_counter()
+    response = session.post(url, json=payload)
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+def bench_generate(port, args):
+    # end to end /generate latency and throughput per concurrency level, distinct seeds so nothing coalesces
+    url = f'http://127.0.0.1:{port}/generate'
+    results = {}
+
+    # first request loads the model
+    with requests.Session() as session:
+        results['first'] = generate(session, url, args, 0)
+
+    seed = 1
+    for level in args.levels:
+        print(f'Benchmarking /generate with {level} concurrent requests')
+        seeds = range(seed, seed + args.requests)
+        seed += args.requests
+
+        def worker(seeds):
+            with requests.Session() as session:
+                return [generate(session, url, args, seed) for seed in seeds]
+
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=level) as executor:
+            latencies = [latency for part in executor.map(worker, [seeds[i::level] for i in range(level)]) for latency in part]
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        results[f'c{level}'] = {
+            **summarize(latencies),
+            'p95': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+            'throughput': len(latencies) / elapsed # images/s
+        }
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results):
+    # {"stages.load.median": value, ...} of comparable metrics, "inf" PSNR as float
+    metrics = {}
+    for group in results:
+        if group == 'meta':
+            continue
+        for name, values in results[group].items():
+            if isinstance(values, dict):
+                for key in ('median', 'p95', 'throughput'):
+                    if key in values:
+                        metrics[f'{group}.{name}.{key}'] = float(values[key])
+            else:
+                metrics[f'{group}.{name}'] = float(values)
+    return metrics
+
+
+def compare(results, baseline, threshold):
+    # metrics slower than baseline by more than `threshold`, printed as a table
+    current = flatten(results)
+    previous = flatten(baseline)
+
+    regressions = []
+    for name, value in current.items():
+        if name not in previous or not previous[name]:
+            continue
+
+        # relative slowdown or quality loss, positive is worse, throughput counts as time per image
+        quality = name.startswith(f'{QUALITY_GROUP}.')
+        higher_better = quality or name.endswith(THROUGHPUT_METRICS)
+        if math.isinf(value) or math.isinf(previous[name]):
+            # PSNR of identical images is infinite, equal values are unchanged, otherwise the infinite side wins
+            change = 0.0 if value == previous[name] else (math.inf if (value < previous[name]) == higher_better else -math.inf)
+        else:
+            change = (previous[name] / value - 1) if higher_better else (value / previous[name] - 1)
+
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        described = f'{change:+.1%} {"loss" if quality else "time"}' if math.isfinite(change) else ('worse' if change > 0 else 'better')
+        print(f'{"!" if regressed else " "} {name:<32} {previous[name]:>10.4f} -> {value:>10.4f} ({described})')
+
+    return regressions
+
+
+def bench(args):
+    os.environ['HF_HUB_OFFLINE'] = '1'
+
+    args.levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    fp_prec = torch.float32 if args.full_prec else torch.bfloat16
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'diffusers': diffusers.__version__,
+            'platform': platform.platform(),
+            'threads': torch.get_num_threads(),
+            'precision': str(fp_prec),
+            'quant': args.quant,
+            'model': args.model,
+            'width': args.width,
+            'height': args.height,
+            'steps': args.steps,
+            'repeat': args.repeat,
+            'requests': args.requests
+        }
+    }
+
+    # progress and model loading logs go to stderr, stdout only carries the JSON results
+    with contextlib.redirect_stdout(sys.stderr), tempfile.TemporaryDirectory(prefix='imagine-bench-') as tmp_path:
+        if args.model:
+            # served from its own directory, under its own name
+            model_path = os.path.realpath(os.path.expanduser(args.model))
+            models_path = os.path.dirname(model_path)
+            args.model_name = os.path.basename(model_path).removesuffix('.safetensors')
+        else:
+            models_path = tmp_path
+            model_path = os.path.join(models_path, BENCH_MODEL)
+            args.model_name = BENCH_MODEL
+            print(f'Building tiny model: {model_path}')
+            build_tiny_model(model_path)
+
+        results['stages'] = bench_stages(model_path, fp_prec, args)
+        if args.quant != 'none':
+            results[f'stages_{args.quant}'] = bench_stages(model_path, torch.float32, args, args.quant)
+        results[QUALITY_GROUP] = bench_quality(model_path, fp_prec, args)
+
+        if args.levels:
+            port = free_port()
+            with open(os.path.join(tmp_path, 'server.log'), 'w') as log_file:
+                print(f'Starting benchmark server on port {port}')
+                server = start_server(models_path, port, args, log_file)
+                try:
+                    results['generate'] = bench_generate(port, args)
+                finally:
+                    server.terminate()
+                    server.wait()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print(f'Results saved: {args.output}', file=sys.stderr)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        with contextlib.redirect_stdout(sys.stderr):
+            regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}: {", ".join(regressions)}', file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,234 @@
+import os
+import json
+import struct
+import hashlib
+import threading
+import collections
+import concurrent.futures
+
+import imagine_server_defs
+
+
+MODEL_EXTENSIONS = ('.safetensors', '.ckpt')
+PRETRAINED_INDEX = 'model_index.json' # marks a diffusers model directory
+MAX_HEADER_SIZE = 100 * 1024**2
+
+# tensor names only present in checkpoints of one architecture
+ARCHITECTURE_KEYS = [
+    ('SDXL', 'conditioner.embedders.1.'),
+    ('SD2.x', 'cond_stage_model.model.transformer.'),
+    ('SD1.x', 'cond_stage_model.transformer.')
+]
+UNET_INPUT_KEY = 'model.diffusion_model.input_blocks.0.0.weight'
+
+# text conditioning width of diffusers UNet configs
+CROSS_ATTENTION_ARCHITECTURES = {768: 'SD1.x', 1024: 'SD2.x', 2048: 'SDXL'}
+
+DTYPE_SIZES = {'F64': 8, 'F32': 4, 'F16': 2, 'BF16': 2, 'I64': 8, 'I32': 4, 'I16': 2, 'I8': 1, 'U8': 1, 'BOOL': 1}
+
+
+def read_header(path):
+    # safetensors JSON header: tensor name -> {dtype, shape, data_offsets}, no tensor data is read
+    with open(path, 'rb') as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            raise ValueError('File is too short for a safetensors header')
+
+        (header_size,) = struct.unpack('<Q', prefix)
+        if header_size > MAX_HEADER_SIZE:
+            raise ValueError(f'Header of {header_size} bytes is too large')
+
+        return json.loads(f.read(header_size))
+
+
+def describe(header):
+    # architecture, dominant parameter dtype and parameter count of a checkpoint
+    tensors = {name: info for name, info in header.items() if name != '__metadata__'}
+
+    architecture = 'unknown'
+    for name, prefix in ARCHITECTURE_KEYS:
+        if any(key.startswith(prefix) for key in tensors):
+            architecture = name
+            break
+
+    # 9 input channels: latents, mask and masked image
+    unet_input = tensors.get(UNET_INPUT_KEY)
+    if unet_input is not None and len(unet_input.get('shape', [])) > 1 and unet_input['shape'][1] == 9:
+        architecture += ' inpaint'
+
+    params = collections.Counter()
+    for info in tensors.values():
+        count = 1
+        for dim in info.get('shape', []):
+            count *= dim
+        params[info.get('dtype', 'unknown')] += count
+
+    dtype = params.most_common(1)[0][0].lower() if params else None
+    return architecture, dtype, sum(params.values())
+
+
+def describe_pretrained(path):
+    # `describe` for a diffusers model directory, from UNet config and weight headers
+    architecture = 'unknown'
+    try:
+        with open(os.path.join(path, 'unet', 'config.json')) as f:
+            config = json.load(f)
+        architecture = CROSS_ATTENTION_ARCHITECTURES.get(config.get('cross_attention_dim'), 'unknown')
+        if config.get('in_channels') == 9:
+            architecture += ' inpaint'
+    except (OSError, ValueError):
+        pass
+
+    header = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            if name.endswith('.safetensors'):
+                header.update({f'{root}/{key}': info for key, info in read_header(os.path.join(root, name)).items() if key != '__metadata__'})
+
+    _, dtype, params = describe(header)
+    return architecture, dtype, params
+
+
+def model_size(path):
+    # bytes on disk of a single-file checkpoint or diffusers model directory
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def file_hash(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 1024**2), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class ModelCatalog:
+    """
+    In-memory index of checkpoints and diffusers model directories in the models directory.
+
+    Entries are rebuilt only when the directory mtime changes, and then only for files
+    whose size or mtime changed, from their safetensors headers. Content hashes (sha256 of
+    the whole file) are computed in the background and kept in `hashes_path` across runs.
+    """
+    def __init__(self, models_path=imagine_server_defs.DEFAULT_MODELS_PATH, hashes_path=imagine_server_defs.DEFAULT_HASHES_PATH):
+        self.models_path = os.path.expanduser(models_path)
+        self.hashes_path = os.path.expanduser(hashes_path)
+
+        self.entries = {} # file name -> entry
+        self.dir_mtime = None
+        self.lock = threading.Lock()
+
+        self.hashes = self.load_hashes() # realpath -> {size, mtime, hash}
+        self.hashes_lock = threading.Lock()
+        self.hasher = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='imagine-catalog')
+
+    def load_hashes(self):
+        try:
+            with open(self.hashes_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_hashes(self):
+        # caller holds `hashes_lock`
+        try:
+            os.makedirs(os.path.dirname(self.hashes_path), exist_ok=True)
+            tmp_path = f'{self.hashes_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.hashes, f, indent=2)
+            os.replace(tmp_path, self.hashes_path)
+        except OSError as e:
+            print(f"Failed to save model hashes: {e}")
+
+    def known_hash(self, path, stat):
+        with self.hashes_lock:
+            known = self.hashes.get(os.path.realpath(path))
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+            return known['hash']
+        return None
+
+    def compute_hash(self, filename, path, stat):
+        # background task, fills in `hash` of the entry once done
+        digest = self.known_hash(path, stat)
+        if digest is None:
+            try:
+                digest = file_hash(path)
+            except OSError as e:
+                print(f"Failed to hash model {path}: {e}")
+                return
+
+            with self.hashes_lock:
+                self.hashes[os.path.realpath(path)] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest}
+                self.save_hashes()
+
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and entry['mtime'] == stat.st_mtime_ns:
+                entry['hash'] = digest
+
+    def scan_file(self, filename, path, stat):
+        pretrained = os.path.isdir(path)
+        name, ext = (filename, '.diffusers') if pretrained else os.path.splitext(filename)
+        entry = {
+            'name': name,
+            'file': filename,
+            'format': ext[1:],
+            'size': model_size(path) if pretrained else stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'architecture': 'unknown',
+            'dtype': None,
+            'params': None,
+            'hash': self.known_hash(path, stat)
+        }
+
+        try:
+            if pretrained:
+                entry['architecture'], entry['dtype'], entry['params'] = describe_pretrained(path)
+            elif ext == '.safetensors':
+                entry['architecture'], entry['dtype'], entry['params'] = describe(read_header(path))
+        except (OSError, ValueError) as e:
+            print(f"Failed to read model header {path}: {e}")
+
+        # content hash only for single files
+        if entry['hash'] is None and not pretrained:
+            self.hasher.submit(self.compute_hash, filename, path, stat)
+        return entry
+
+    def refresh(self):
+        # rescan if the directory changed since last time
+        try:
+            dir_mtime = os.stat(self.models_path).st_mtime_ns
+        except FileNotFoundError:
+            os.makedirs(self.models_path, exist_ok=True)
+            dir_mtime = os.stat(self.models_path).st_mtime_ns
+
+        with self.lock:
+            if dir_mtime == self.dir_mtime:
+                return
+
+            entries = {}
+            for item in os.scandir(self.models_path):
+                if item.is_dir():
+                    if not os.path.isfile(os.path.join(item.path, PRETRAINED_INDEX)):
+                        continue
+                elif not item.name.endswith(MODEL_EXTENSIONS) or not item.is_file():
+                    continue
+
+                stat = item.stat()
+                # directory entries store the size of their contents, only their mtime tells a change
+                entry = self.entries.get(item.name)
+                if entry is None or entry['mtime'] != stat.st_mtime_ns or (entry['format'] != 'diffusers' and entry['size'] != stat.st_size):
+                    entry = self.scan_file(item.name, item.path, stat)
+                entries[item.name] = entry
+
+            self.entries = entries
+            self.dir_mtime = dir_mtime
+            print(f"Model catalog: {len(entries)} models in {self.models_path}")
+
+    def models(self):
+        # entries sorted by name, copies safe to extend by the caller
+        self.refresh()
+        with self.lock:
+            return [dict(entry) for entry in sorted(self.entries.values(), key=lambda entry: entry['name'])]
@@ -0,0 +1,110 @@
+import contextlib
+
+import diffusers
+
+
+class FeatureCache:
+    """
+    DeepCache-style reuse of deep UNet features across denoising steps.
+
+    Every `interval`-th UNet call runs the whole network and keeps the input of the last up
+    block, which carries the output of all deeper blocks. Calls in between only run the
+    shallow blocks at full resolution (input convolution, first down block, last up block)
+    on top of the kept features. Counting UNet calls rather than scheduler steps keeps the
+    schedule valid for samplers calling the UNet more than once per step.
+    """
+    def __init__(self, unet, interval):
+        self.unet = unet
+        self.interval = interval
+        self.forward_full = unet.forward # hooked by model offload, if enabled
+
+        self.features = None # input of the last up block of the latest full call
+        self.capturing = False
+        self.calls = 0
+        self.full_calls = 0
+
+    def capture(self, module, args, kwargs):
+        if self.capturing:
+            self.features = kwargs['hidden_states']
+
+    def forward(self, sample, timestep, encoder_hidden_states, timestep_cond=None, cross_attention_kwargs=None, added_cond_kwargs=None, return_dict=True, **kwargs):
+        # full call on schedule and whenever kept features don't match the input (hires pass, batch size)
+        full = self.calls % self.interval == 0 or self.features is None or self.features.shape[0] != sample.shape[0] or self.features.shape[-2:] != sample.shape[-2:]
+        self.calls += 1
+
+        if full:
+            self.full_calls += 1
+            self.capturing = True
+            try:
+                return self.forward_full(sample, timestep, encoder_hidden_states, timestep_cond=timestep_cond, cross_attention_kwargs=cross_attention_kwargs, added_cond_kwargs=added_cond_kwargs, return_dict=return_dict, **kwargs)
+            finally:
+                self.capturing = False
+
+        sample = self.forward_shallow(sample, timestep, encoder_hidden_states, timestep_cond, cross_attention_kwargs, added_cond_kwargs)
+        return (sample,) if not return_dict else diffusers.models.unets.unet_2d_condition.UNet2DConditionOutput(sample=sample)
+
+    def forward_shallow(self, sample, timestep, encoder_hidden_states, timestep_cond, cross_attention_kwargs, added_cond_kwargs):
+        # `UNet2DConditionModel.forward` limited to the blocks at full resolution
+        unet = self.unet
+
+        if unet.config.center_input_sample:
+            sample = 2 * sample - 1.0
+
+        emb = unet.time_embedding(unet.get_time_embed(sample=sample, timestep=timestep), timestep_cond)
+        if unet.time_embed_act is not None:
+            emb = unet.time_embed_act(emb)
+        encoder_hidden_states = unet.process_encoder_hidden_states(encoder_hidden_states=encoder_hidden_states, added_cond_kwargs=added_cond_kwargs)
+
+        sample = unet.conv_in(sample)
+
+        down_block = unet.down_blocks[0]
+        if getattr(down_block, 'has_cross_attention', False):
+            _, res_samples = down_block(hidden_states=sample, temb=emb, encoder_hidden_states=encoder_hidden_states, cross_attention_kwargs=cross_attention_kwargs)
+        else:
+            _, res_samples = down_block(hidden_states=sample, temb=emb)
+
+        # skip connections of the last up block are the first ones of the down path
+        up_block = unet.up_blocks[-1]
+        res_samples = ((sample,) + res_samples)[:len(up_block.resnets)]
+
+        if getattr(up_block, 'has_cross_attention', False):
+            sample = up_block(hidden_states=self.features, temb=emb, res_hidden_states_tuple=res_samples, encoder_hidden_states=encoder_hidden_states, cross_attention_kwargs=cross_attention_kwargs)
+        else:
+            sample = up_block(hidden_states=self.features, temb=emb, res_hidden_states_tuple=res_samples)
+
+        if unet.conv_norm_out:
+            sample = unet.conv_norm_out(sample)
+            sample = unet.conv_act(sample)
+        return unet.conv_out(sample)
+
+
+def supported(unet):
+    # plain text conditioned UNets of SD 1.x/2.x, not compiled (forward is traced once)
+    return (
+        isinstance(unet, diffusers.UNet2DConditionModel)
+        and unet.config.class_embed_type is None
+        and unet.config.addition_embed_type is None
+        and getattr(unet, '_compiled_call_impl', None) is None
+    )
+
+
+@contextlib.contextmanager
+def feature_cache(unet, interval):
+    # UNet calls within the block reuse deep features for `interval` - 1 calls, yields the `FeatureCache` or None
+    if interval <= 1 or not supported(unet):
+        yield None
+        return
+
+    cache = FeatureCache(unet, interval)
+    previous = unet.__dict__.get('forward')
+    hook = unet.up_blocks[-1].register_forward_pre_hook(cache.capture, with_kwargs=True)
+    unet.forward = cache.forward
+
+    try:
+        yield cache
+    finally:
+        hook.remove()
+        if previous is None:
+            del unet.forward
+        else:
+            unet.forward = previous
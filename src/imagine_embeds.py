@@ -0,0 +1,84 @@
+import threading
+import collections
+
+import torch
+
+import imagine_server_defs
+
+
+def tensor_size(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of text encoder outputs keyed by (model key, prompt, negative prompt, clip skip).
+
+    Entries stay on the device they were encoded on, least recently used ones are dropped
+    once they take more than `max_size` bytes. `hits` and `misses` count lookups.
+    """
+    def __init__(self, max_size=imagine_server_defs.DEFAULT_EMBED_CACHE * 1024**2):
+        self.max_size = max_size
+
+        self.entries = collections.OrderedDict() # key -> (prompt_embeds, negative_prompt_embeds, size in bytes)
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][:2]
+
+    def store(self, key, embeds, neg_embeds):
+        size = tensor_size(embeds) + tensor_size(neg_embeds)
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            self.entries[key] = (embeds, neg_embeds, size)
+            self.size += size
+
+            while self.size > self.max_size:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+    @torch.no_grad()
+    def encode(self, pipe, model_key, prompt, neg_prompt, clip_skip):
+        # (prompt_embeds, negative_prompt_embeds) for a single prompt, batch dimension 1
+        key = (model_key, prompt, neg_prompt, clip_skip)
+
+        cached = self.lookup(key)
+        if cached is not None:
+            return cached
+
+        embeds, neg_embeds = pipe.encode_prompt(
+            prompt,
+            pipe._execution_device,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=True,
+            negative_prompt=neg_prompt,
+            clip_skip=clip_skip
+        )
+
+        self.store(key, embeds, neg_embeds)
+        return embeds, neg_embeds
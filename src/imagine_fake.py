@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import types
+import struct
+
+import torch
+import diffusers
+
+import imagine_server_defs
+
+from diffusers.image_processor import VaeImageProcessor
+
+
+FAKE_MODEL = 'fake'
+EMBED_DIM = 8 # width of fake prompt embeddings
+LATENT_CHANNELS = 4
+
+
+def create_model(models_path):
+    # placeholder checkpoint with a valid empty safetensors header, never read by the fake loader
+    model_path = os.path.join(models_path, f'{FAKE_MODEL}.safetensors')
+    header = json.dumps({'__metadata__': {'format': FAKE_MODEL}}).encode('utf-8')
+    with open(model_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+    return model_path
+
+
+class FakeVAE:
+    # nearest upscale of latents to pixels, output in [-1, 1] like the real decoder
+    config = types.SimpleNamespace(scaling_factor=1.0)
+
+    def decode(self, latents, return_dict=True):
+        images = torch.nn.functional.interpolate(latents[:, :3].float(), scale_factor=8, mode='nearest').tanh()
+        return (images,)
+
+
+class FakePipe:
+    """
+    Stub of the diffusers pipeline API used by the server, without weights.
+
+    Denoising sleeps `step_delay` seconds per step and draws latents from the request
+    generators, so outputs are deterministic per seed. Callbacks are invoked with the same
+    arguments and frequency as diffusers does, which makes queueing, batching, streaming
+    and cancellation behave like with a real model. `size` ((width, height) or None) fixes
+    the output size regardless of the request.
+    """
+    def __init__(self, step_delay=imagine_server_defs.DEFAULT_FAKE_STEP / 1000, size=None, img2img=False):
+        self.step_delay = step_delay
+        self.size = size
+        self.img2img = img2img
+
+        self.components = {}
+        self.vae = FakeVAE()
+        self.image_processor = VaeImageProcessor(vae_scale_factor=8)
+        self._execution_device = torch.device('cpu')
+
+    def derive(self, img2img, scheduler_cls):
+        return FakePipe(self.step_delay, self.size, img2img)
+
+    def encode_prompt(self, prompt, device, num_images_per_prompt=1, do_classifier_free_guidance=True, negative_prompt=None, clip_skip=None):
+        embeds = torch.full((1, 77, EMBED_DIM), float(len(prompt)))
+        neg_embeds = torch.full((1, 77, EMBED_DIM), float(len(negative_prompt or '')))
+        return embeds, neg_embeds
+
+    def image_size(self, image, width, height):
+        # img2img takes its size from the input: PIL images or latents
+        if self.size is not None:
+            return self.size
+        if image is None:
+            return width, height
+        if isinstance(image, torch.Tensor):
+            return image.shape[-1] * 8, image.shape[-2] * 8
+
+        image = image[0] if isinstance(image, list) else image
+        return image.size
+
+    def __call__(self, prompt_embeds=None, width=512, height=512, num_inference_steps=25, strength=0.8, image=None,
+                 num_images_per_prompt=1, generator=None, callback=None, callback_steps=1, output_type='pil', **kwargs):
+        width, height = self.image_size(image, width, height)
+        count = prompt_embeds.shape[0] * num_images_per_prompt
+        generators = generator if isinstance(generator, list) else [generator] * count
+
+        shape = (LATENT_CHANNELS, height // 8, width // 8)
+        latents = torch.stack([torch.randn(shape, generator=gen) for gen in generators])
+
+        steps = int(num_inference_steps * strength) if self.img2img else num_inference_steps
+        for i in range(steps):
+            time.sleep(self.step_delay)
+            latents = 0.9 * latents + 0.1 * torch.stack([torch.randn(shape, generator=gen) for gen in generators])
+
+            if callback is not None and i % callback_steps == 0:
+                callback(i, 1000 - i * 1000 // max(steps, 1), latents)
+
+        if output_type == 'latent':
+            return types.SimpleNamespace(images=latents)
+
+        images = self.vae.decode(latents)[0]
+        return types.SimpleNamespace(images=self.image_processor.postprocess(images, output_type='pil'))
+
+    def decode_latents(self, latents):
+        images = (self.vae.decode(latents)[0] / 2 + 0.5).clamp(0, 1)
+        return images.permute(0, 2, 3, 1).numpy()
+
+    def numpy_to_pil(self, images):
+        return diffusers.DiffusionPipeline.numpy_to_pil(images)
+
+    def maybe_free_model_hooks(self):
+        pass
+
+
+def loader(step_delay, size=None):
+    # `PipelineCache` loader returning stub pipelines for every checkpoint
+    def load(model_path, dev, fp_prec):
+        print(f"Loading fake model: {model_path} (step delay {step_delay * 1000:.0f} ms)")
+        return FakePipe(step_delay, size)
+    return load
@@ -0,0 +1,44 @@
+import json
+import struct
+
+
+# Binary /generate transport, negotiated with `Accept: application/x-imagine-frames`.
+# Every record is one frame: header length and data length (big endian uint32),
+# followed by the JSON header (record without `img`) and raw image bytes.
+CONTENT_TYPE = 'application/x-imagine-frames'
+ACCEPT = f'{CONTENT_TYPE}, application/json'
+
+FRAME_PREFIX = struct.Struct('>II')
+
+
+def pack_frame(header, data=b''):
+    header_bytes = json.dumps(header).encode('utf-8')
+    return FRAME_PREFIX.pack(len(header_bytes), len(data)) + header_bytes + data
+
+
+def read_exact(stream, size):
+    # read exactly `size` bytes, None at clean end of stream
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            if remaining == size:
+                return None
+            raise EOFError(f'Stream ended inside a frame ({size - remaining}/{size} bytes)')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_frames(stream):
+    # yields (header dict, data bytes) from file-like `stream`
+    while True:
+        prefix = read_exact(stream, FRAME_PREFIX.size)
+        if prefix is None:
+            return
+
+        header_size, data_size = FRAME_PREFIX.unpack(prefix)
+        header = json.loads(read_exact(stream, header_size) or b'{}')
+        data = read_exact(stream, data_size) if data_size else b''
+        yield header, data
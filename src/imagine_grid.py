@@ -0,0 +1,108 @@
+import io
+import itertools
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+# axes a grid can sweep and their value types, image size stays fixed so cells line up
+GRID_AXES = {
+    'seed': int,
+    'guidance': float,
+    'steps': int,
+    'sampler': str,
+    'clip': int,
+    'strength': float,
+    'prompt': str,
+    'neg': str
+}
+
+MAX_GRID_CELLS = 256
+LABEL_PADDING = 8 # px
+
+
+def parse_values(name, text):
+    # "5,7,9" or "1..4" (inclusive, integer axes) -> typed list
+    value_type = GRID_AXES[name]
+
+    values = []
+    for item in str(text).split(','):
+        item = item.strip()
+        if not item:
+            continue
+
+        if value_type is int and '..' in item:
+            start, end = (int(bound) for bound in item.split('..', 1))
+            values.extend(range(start, end + 1) if start <= end else range(start, end - 1, -1))
+        else:
+            values.append(value_type(item))
+
+    if not values:
+        raise ValueError(f"Axis '{name}' has no values")
+    return values
+
+
+def axis_values(name, values):
+    # typed list of a payload axis: list values converted one by one (prompts may contain commas), strings as in `parse_values`
+    if not isinstance(values, list):
+        return parse_values(name, values)
+
+    value_type = GRID_AXES[name]
+    try:
+        values = [value_type(value) for value in values]
+    except (TypeError, ValueError):
+        raise ValueError(f"Axis '{name}' has values that are not {value_type.__name__}")
+
+    if not values:
+        raise ValueError(f"Axis '{name}' has no values")
+    return values
+
+
+def grid_cells(axes):
+    # cells as {axis: value}, row-major with the first axis as columns
+    names = list(axes.keys())
+    cells = [dict(zip(reversed(names), values)) for values in itertools.product(*[axes[name] for name in reversed(names)])]
+    return [{name: cell[name] for name in names} for cell in cells]
+
+
+def format_value(name, value):
+    return f'{name}: {value}'
+
+
+def contact_sheet(images, cells, axes):
+    # stitch equally sized cell images, columns labeled by the first axis and rows by the others
+    names = list(axes.keys())
+    columns = len(axes[names[0]])
+    rows = len(cells) // columns
+
+    font = ImageFont.load_default()
+    measure = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+    def text_size(text):
+        left, top, right, bottom = measure.textbbox((0, 0), text, font=font)
+        return right - left, bottom - top
+
+    row_labels = [', '.join(format_value(name, cells[row * columns][name]) for name in names[1:]) for row in range(rows)]
+    column_labels = [format_value(names[0], value) for value in axes[names[0]]]
+
+    width, height = images[0].size
+    label_width = max((text_size(label)[0] for label in row_labels), default=0) + 2 * LABEL_PADDING if names[1:] else 0
+    label_height = max(text_size(label)[1] for label in column_labels) + 2 * LABEL_PADDING
+
+    sheet = Image.new('RGB', (label_width + columns * width, label_height + rows * height), 'white')
+    draw = ImageDraw.Draw(sheet)
+
+    for column, label in enumerate(column_labels):
+        draw.text((label_width + column * width + LABEL_PADDING, LABEL_PADDING), label, fill='black', font=font)
+
+    for row, label in enumerate(row_labels):
+        if label_width:
+            draw.text((LABEL_PADDING, label_height + row * height + LABEL_PADDING), label, fill='black', font=font)
+
+        for column in range(columns):
+            image = images[row * columns + column]
+            if image is not None:
+                sheet.paste(image.convert('RGB'), (label_width + column * width, label_height + row * height))
+
+    buffer = io.BytesIO()
+    sheet.save(buffer, format='PNG')
+    return buffer.getvalue()
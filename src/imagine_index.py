@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import sqlite3
+import concurrent.futures
+
+import imagine_png
+
+
+DEFAULT_INDEX_PATH = '~/.imagine/index.db'
+DEFAULT_INDEX_WORKERS = 8
+DEFAULT_SEARCH_LIMIT = 50
+
+SCHEMA_VERSION = 1
+SIDECAR_READ = 64 * 1024 # bytes read at a time until the meta object of a json sidecar is complete
+
+# meta fields with their own column, searchable by the index
+FIELDS = {
+    'model': 'TEXT',
+    'seed': 'TEXT', # 64 bit unsigned, beyond sqlite integers
+    'prompt': 'TEXT',
+    'neg': 'TEXT',
+    'sampler': 'TEXT',
+    'width': 'INTEGER',
+    'height': 'INTEGER',
+    'steps': 'INTEGER',
+    'guidance': 'REAL',
+    'date': 'TEXT'
+}
+
+
+def read_sidecar(path):
+    # meta of a {"meta": ..., "out": base64 image} json file, base64 image is not read
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        text = ''
+        while True:
+            chunk = f.read(SIDECAR_READ)
+            text += chunk
+
+            start = text.find('"meta"')
+            if start >= 0:
+                colon = text.find(':', start + len('"meta"'))
+                if colon >= 0:
+                    value = colon + 1
+                    while value < len(text) and text[value].isspace():
+                        value += 1
+                    try:
+                        return decoder.raw_decode(text, value)[0]
+                    except json.JSONDecodeError:
+                        pass
+
+            if not chunk:
+                return None
+
+
+def sidecar_image(path):
+    # image a json file belongs to: `run --meta` (image.png.json) or `convert` (image.json) output
+    base = path[:-len('.json')]
+    return base if base.lower().endswith('.png') else f'{base}.png'
+
+
+def read_meta(path):
+    # meta dict of a generated image or json file, None if it has none
+    try:
+        if path.lower().endswith('.png'):
+            text = imagine_png.read_text(path).get('meta')
+            if text is not None:
+                return json.loads(text)
+
+            # image saved without meta chunk, its `--meta` sidecar
+            sidecar = f'{path}.json'
+            return read_sidecar(sidecar) if os.path.exists(sidecar) else None
+
+        return read_sidecar(path)
+    except (OSError, ValueError, UnicodeDecodeError):
+        return None
+
+
+def scan(directory):
+    # {path: (mtime ns, size)} of images and json files below `directory`, json files of existing images skipped
+    files = {}
+    pending = [directory]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError:
+            continue
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.lower().endswith(('.png', '.json')):
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                continue
+
+    for path in [path for path in files if path.lower().endswith('.json')]:
+        if sidecar_image(path) in files:
+            del files[path]
+    return files
+
+
+def row(path, stat, meta):
+    # images table values of one file, files without meta are kept so they aren't read again
+    if meta is None:
+        return (path, *stat, *[None] * len(FIELDS), None)
+
+    values = []
+    for field, kind in FIELDS.items():
+        value = meta.get(field)
+        if value is not None and kind != 'TEXT':
+            try:
+                value = int(value) if kind == 'INTEGER' else float(value)
+            except (TypeError, ValueError):
+                value = None
+        elif value is not None:
+            value = str(value)
+        values.append(value)
+    return (path, *stat, *values, json.dumps(meta, ensure_ascii=False))
+
+
+class Index:
+    """
+    SQLite index of generated image meta, one row per image or standalone json file.
+
+    `update` rescans a directory and reads meta only of files whose path, mtime or size
+    changed since the last scan, in parallel and without decoding pixels; rows of files
+    that are gone are removed. Meta fields have their own indexed columns, prompts are in
+    a trigram full text index when sqlite has FTS5, so substring queries don't scan rows.
+    """
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+        # index is a cache of the files, older layouts are built again
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.db.executescript('DROP TABLE IF EXISTS prompts; DROP TABLE IF EXISTS images;')
+            self.create()
+
+        self.fts = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'prompts'").fetchone() is not None
+
+    def create(self):
+        columns = ', '.join(f'{field} {kind}' for field, kind in FIELDS.items())
+        with self.db:
+            self.db.execute(f'CREATE TABLE images (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, mtime INTEGER NOT NULL, size INTEGER NOT NULL, {columns}, meta TEXT)')
+            for field in ('model', 'seed', 'sampler', 'date'):
+                self.db.execute(f'CREATE INDEX images_{field} ON images ({field})')
+
+            # prompt substrings, kept in sync with the images table by triggers
+            try:
+                self.db.execute("CREATE VIRTUAL TABLE prompts USING fts5(prompt, content='images', content_rowid='id', tokenize='trigram')")
+                self.db.execute("CREATE TRIGGER images_insert AFTER INSERT ON images BEGIN INSERT INTO prompts (rowid, prompt) VALUES (new.id, new.prompt); END")
+                self.db.execute("CREATE TRIGGER images_delete AFTER DELETE ON images BEGIN INSERT INTO prompts (prompts, rowid, prompt) VALUES ('delete', old.id, old.prompt); END")
+            except sqlite3.OperationalError:
+                print('SQLite without FTS5 trigram tokenizer, prompt search scans all rows')
+            self.db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def close(self):
+        self.db.close()
+
+    def indexed(self, directory):
+        # {path: (mtime ns, size)} of indexed files below `directory`
+        prefix = os.path.join(directory, '')
+        rows = self.db.execute('SELECT path, mtime, size FROM images WHERE path >= ? AND path < ?', (prefix, prefix[:-1] + chr(ord(os.sep) + 1)))
+        return {path: (mtime, size) for path, mtime, size in rows}
+
+    def update(self, directory, workers=DEFAULT_INDEX_WORKERS):
+        # sync rows below `directory` with its files, returns counts of new, changed, removed and unchanged files
+        directory = os.path.abspath(directory)
+        files = scan(directory)
+        indexed = self.indexed(directory)
+
+        changed = [path for path, stat in files.items() if path in indexed and indexed[path] != stat]
+        new = [path for path in files if path not in indexed]
+        removed = [path for path in indexed if path not in files]
+
+        # files only, meta reading is i/o bound
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            metas = executor.map(read_meta, changed + new)
+            rows = [row(path, files[path], meta) for path, meta in zip(changed + new, metas)]
+
+        placeholders = ', '.join('?' * (len(FIELDS) + 4))
+        with self.db:
+            self.db.executemany('DELETE FROM images WHERE path = ?', [(path,) for path in changed + removed])
+            self.db.executemany(f'INSERT INTO images (path, mtime, size, {", ".join(FIELDS)}, meta) VALUES ({placeholders})', rows)
+
+        return {'new': len(new), 'changed': len(changed), 'removed': len(removed), 'unchanged': len(files) - len(new) - len(changed), 'skipped': sum(1 for values in rows if values[-1] is None)}
+
+    def search(self, terms=(), limit=DEFAULT_SEARCH_LIMIT, **fields):
+        # rows whose prompt contains every term and whose fields equal the given values, latest first
+        conditions = ['meta IS NOT NULL']
+        values = []
+
+        for term in terms:
+            pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            if self.fts:
+                conditions.append("id IN (SELECT rowid FROM prompts WHERE prompt LIKE ? ESCAPE '\\')")
+            else:
+                conditions.append("prompt LIKE ? ESCAPE '\\'")
+            values.append(pattern)
+
+        for field, value in fields.items():
+            if value is not None:
+                conditions.append(f'{field} = ?')
+                values.append(str(value) if FIELDS[field] == 'TEXT' else value)
+
+        query = f'SELECT path, {", ".join(FIELDS)} FROM images WHERE {" AND ".join(conditions)} ORDER BY date DESC, path LIMIT ?'
+        columns = ['path', *FIELDS]
+        return [dict(zip(columns, values_row)) for values_row in self.db.execute(query, (*values, limit))]
+
+
+def index(args):
+    try:
+        idx = Index(args.index)
+        for directory in args.dirs:
+            started = time.monotonic()
+            counts = idx.update(directory, args.workers)
+            print(f"Indexed {directory}: {counts['new']} new, {counts['changed']} changed, {counts['removed']} removed, {counts['unchanged']} unchanged, {counts['skipped']} without meta in {time.monotonic() - started:.2f}s")
+        idx.close()
+    except Exception as e:
+        print(f'An unexpected error occurred: {e}')
+
+
+def search(args):
+    try:
+        idx = Index(args.index)
+        started = time.monotonic()
+        results = idx.search(args.terms, args.limit, model=args.model, seed=args.seed, sampler=args.sampler, width=args.width, height=args.height, steps=args.steps)
+        elapsed = time.monotonic() - started
+        idx.close()
+
+        for result in results:
+            if args.paths:
+                print(result['path'])
+            else:
+                print(f"{result['path']}  {result['model'] or '-'}  seed {result['seed'] or '-'}  {result['width'] or '?'}x{result['height'] or '?'}  {(result['prompt'] or '')[:60]}")
+
+        if not args.paths:
+            print(f'{len(results)} image(s) in {elapsed * 1000:.1f} ms')
+    except Exception as e:
+        print(f'An unexpected error occurred: {e}')
@@ -0,0 +1,314 @@
+import math
+import time
+import heapq
+import queue
+import itertools
+import threading
+
+import imagine_server_defs
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'Generation queue is full, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class NotifyQueue(queue.Queue):
+    # queue calling `listener` after every put, lets asyncio consumers wait without a thread
+    def __init__(self):
+        super().__init__()
+        self.listener = None
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+
+        listener = self.listener
+        if listener is not None:
+            listener()
+
+
+class Job:
+    """
+    Single generation request waiting in or executed by `JobScheduler`.
+
+    Results flow back through the same queues `run_pipe` always used: intermediate
+    (index, sample) pairs via `cb_queue` (terminated by None) and the list of final
+    images or an error via `res_queue`.
+
+    Identical requests arriving while a job is queued or running `attach` to it as
+    followers instead of being scheduled. Producers publish with `put_sample` and
+    `put_result`, which fan out to the queues of every follower, and the job is only
+    cancelled once all of them are.
+    """
+    def __init__(self, params, priority=0, size=1):
+        self.params = params
+        self.priority = priority
+        self.size = size # number of images generated
+
+        self.cb_queue = NotifyQueue() # intermediate callbacks from run_pipe
+        self.res_queue = NotifyQueue() # final result or error from run_pipe
+        self.stop_event = threading.Event() # signals run_pipe to stop early
+        self.done = threading.Event() # set once a worker is finished with the job
+
+        self.position = None # place in queue (0 is next), None when not queued
+        self.device = None
+        self.submitted = time.monotonic()
+        self.started = None
+
+        self.leader = None # job this one is attached to
+        self.followers = []
+        self.lock = threading.Lock() # guards followers and published state
+        self.samples_done = False
+        self.result = None
+
+        self.timings = {} # stage -> seconds, filled by the pipeline for the whole group
+        self.memory = None # memory mode and peak use of the pipeline run
+
+    def group(self):
+        return [self] + self.followers
+
+    def cancelled(self):
+        # every request waiting for this job is gone
+        return all(job.stop_event.is_set() for job in self.group())
+
+    def attach(self, follower):
+        # share results with `follower`, False if the job is cancelled already
+        with self.lock:
+            if self.cancelled():
+                return False
+
+            follower.leader = self
+            follower.position = self.position
+            follower.timings.update(self.timings)
+            follower.memory = self.memory
+            self.followers.append(follower)
+
+            # replay the end of a job that finished while attaching
+            if self.samples_done:
+                follower.cb_queue.put(None)
+            if self.result is not None:
+                follower.res_queue.put(self.result)
+            if self.done.is_set():
+                follower.done.set()
+            return True
+
+    def put_sample(self, sample):
+        with self.lock:
+            if sample is None:
+                self.samples_done = True
+            for job in self.group():
+                job.cb_queue.put(sample)
+
+    def put_result(self, result):
+        with self.lock:
+            self.result = result
+            for job in self.group():
+                job.res_queue.put(result)
+
+    def add_timing(self, stage, value):
+        with self.lock:
+            for job in self.group():
+                job.timings[stage] = value
+
+    def set_memory(self, memory):
+        with self.lock:
+            for job in self.group():
+                job.memory = memory
+
+    def set_position(self, position):
+        with self.lock:
+            for job in self.group():
+                job.position = position
+
+    def finish(self):
+        with self.lock:
+            for job in self.group():
+                job.done.set()
+
+
+class JobScheduler:
+    """
+    Bounded priority queue of jobs executed by one worker thread per device.
+
+    Jobs of equal priority run in FIFO order. `submit` raises `QueueFullError` instead of
+    accepting more work than `max_queue`, so load beyond capacity turns into backpressure
+    rather than concurrent generations fighting for device memory.
+
+    With `max_batch` > 1 a worker that picked a job waits up to `batch_window` seconds for
+    queued jobs with the same `batch_key` and hands them to `execute` together, as long as
+    their total number of images stays within `max_batch`.
+
+    With `affinity(job, device)` a free worker prefers, among the jobs of the highest queued
+    priority, one whose model is resident on its device, then one not resident on any other
+    device, before taking the oldest one. It leaves that one to an idle worker with its model
+    resident instead.
+    """
+    def __init__(self, execute, devices, max_queue=imagine_server_defs.DEFAULT_QUEUE_SIZE, batch_key=None, max_batch=1, batch_window=0, affinity=None):
+        self.execute = execute # execute(jobs, device), runs on worker thread
+        self.devices = list(devices)
+        self.affinity = affinity
+        self.max_queue = max(max_queue, 1)
+
+        self.batch_key = batch_key
+        self.max_batch = max(max_batch, 1)
+        self.batch_window = batch_window
+
+        self.pending = [] # heap of (-priority, seq, job)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+        self.running = 0
+        self.idle = set() # devices of workers waiting for jobs
+        self.avg_duration = None # moving average of job execution time (s)
+
+        self.workers = []
+        for device in self.devices:
+            worker = threading.Thread(target=self.work, args=(device,), name=f'imagine-worker-{device}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job):
+        with self.cond:
+            if len(self.pending) >= self.max_queue:
+                raise QueueFullError(self.retry_after())
+
+            heapq.heappush(self.pending, (-job.priority, next(self.seq), job))
+            self.update_positions()
+            # wake idle workers as well as one collecting a batch
+            self.cond.notify_all()
+
+    def cancel(self, job):
+        # stop running job or drop it from queue, once no attached request waits for it
+        leader = job.leader or job
+        with leader.lock:
+            job.stop_event.set()
+            if not leader.cancelled():
+                return
+
+        with self.cond:
+            for i, (_, _, pending_job) in enumerate(self.pending):
+                if pending_job is leader:
+                    self.pending.pop(i)
+                    heapq.heapify(self.pending)
+                    self.update_positions()
+                    leader.set_position(None)
+                    leader.finish()
+                    break
+
+    def depth(self):
+        with self.cond:
+            return len(self.pending)
+
+    def active(self):
+        # number of workers running jobs
+        with self.cond:
+            return self.running
+
+    def update_positions(self):
+        # caller holds `cond`
+        for position, (_, _, job) in enumerate(sorted(self.pending)):
+            job.set_position(position)
+
+    def retry_after(self):
+        # seconds until a queue slot is likely to free up, caller holds `cond`
+        avg = self.avg_duration if self.avg_duration is not None else 1.0
+        return max(1, math.ceil(avg * (len(self.pending) + self.running) / len(self.workers)))
+
+    def take_compatible(self, key, jobs):
+        # move queued jobs with batch `key` into `jobs`, caller holds `cond`
+        taken = False
+        size = sum(job.size for job in jobs)
+        for entry in sorted(self.pending):
+            job = entry[2]
+            if size + job.size > self.max_batch:
+                continue
+            if not job.cancelled() and self.batch_key(job.params) == key:
+                self.pending.remove(entry)
+                jobs.append(job)
+                size += job.size
+                taken = True
+
+        if taken:
+            heapq.heapify(self.pending)
+
+    def next_job(self, device):
+        # pop the job `device` should run next, None to leave it to another worker, caller holds `cond`
+        if self.affinity is None:
+            return heapq.heappop(self.pending)[2]
+
+        entries = sorted(self.pending)
+        candidates = [entry for entry in entries if entry[0] == entries[0][0]]
+        others = [other for other in self.devices if other is not device]
+
+        entry = next((entry for entry in candidates if self.affinity(entry[2], device)), None)
+        if entry is None:
+            entry = next((entry for entry in candidates if not any(self.affinity(entry[2], other) for other in others)), candidates[0])
+            if any(other in self.idle and self.affinity(entry[2], other) for other in others):
+                return None
+
+        self.pending.remove(entry)
+        heapq.heapify(self.pending)
+        return entry[2]
+
+    def collect(self, job):
+        # `job` plus compatible ones arriving within the batch window, caller holds `cond`
+        jobs = [job]
+
+        if self.batch_key is not None and self.max_batch > 1:
+            key = self.batch_key(job.params)
+            deadline = time.monotonic() + self.batch_window
+
+            while True:
+                self.take_compatible(key, jobs)
+
+                remaining = deadline - time.monotonic()
+                if sum(job.size for job in jobs) >= self.max_batch or remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+        for job in jobs:
+            job.set_position(None)
+        self.update_positions()
+        return jobs
+
+    def work(self, device):
+        while True:
+            with self.cond:
+                self.idle.add(device)
+                job = None
+                while job is None:
+                    if self.pending:
+                        job = self.next_job(device)
+                    if job is None:
+                        self.cond.wait()
+                self.idle.discard(device)
+
+                jobs = self.collect(job)
+                self.running += 1
+
+            started = time.monotonic()
+            for job in jobs:
+                job.device = device
+                job.started = started
+
+            active = [job for job in jobs if not job.cancelled()]
+            try:
+                if active:
+                    self.execute(active, device)
+            except Exception as e:
+                # errors before run_pipe took over the queues (model load, bad input image)
+                print(f"Error executing job on {device}: {e}")
+                for job in active:
+                    job.put_result(e)
+                    job.put_sample(None)
+            finally:
+                duration = time.monotonic() - started
+
+                with self.cond:
+                    self.running -= 1
+                    if active:
+                        self.avg_duration = duration if self.avg_duration is None else 0.8 * self.avg_duration + 0.2 * duration
+
+                for job in jobs:
+                    job.finish()
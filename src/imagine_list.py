@@ -5,11 +5,20 @@ IMAGINE_URL = 'http://{address}/models'
 
 def list_models(args):
     try:
-        models = requests.get(IMAGINE_URL.format(address=args.address)).json()['models']
+        response = requests.get(IMAGINE_URL.format(address=args.address)).json()
 
         print('MODELS:')
-        for model in models:
-            print(model)
+        if 'catalog' not in response:
+            # older server, names only
+            for model in response['models']:
+                print(model)
+            return
+
+        # * marks models loaded in memory
+        for entry in response['catalog']:
+            resident = '*' if entry.get('resident') else ' '
+            size = entry['size'] / 1024**3
+            print(f"{resident} {entry['name']:<40} {entry['architecture']:<14} {entry['dtype'] or '-':<5} {size:5.2f} GiB  {(entry['hash'] or '')[:10]}")
     except requests.exceptions.ConnectionError as e:
         print(f'Could not connect to the server. Is it running? Error: {e}')
     except requests.exceptions.RequestException as e:
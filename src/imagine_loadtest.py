@@ -0,0 +1,272 @@
+import json
+import time
+import random
+import requests
+import threading
+import itertools
+import collections
+import concurrent.futures
+
+import imagine_run
+
+
+IMAGINE_METRICS_URL = 'http://{address}/metrics'
+IMAGINE_READY_URL = 'http://{address}/ready'
+
+DEFAULT_CLIENTS = 100
+DEFAULT_REQUESTS = 500
+DEFAULT_SETTLE = 10 # s
+
+REQUEST_TIMEOUT = 300 # s
+CONNECT_TIMEOUT = 10 # s
+ABORT_AFTER = (0.05, 0.5) # s, range of read timeouts of aborting clients
+WARMUP_TIMEOUT = 600 # s, server warmup (preloading, compiling) and the first generation
+
+# client behaviours
+KINDS = ['plain', 'stream', 'disconnect', 'abort']
+
+
+def percentiles(values):
+    # nearest rank percentiles (s) of request durations
+    if not values:
+        return None
+
+    values = sorted(values)
+    pick = lambda q: values[min(int(len(values) * q), len(values) - 1)]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1], 'count': len(values)}
+
+
+def read_metrics(address):
+    # Prometheus text of the server -> {(name, labels): value}
+    response = requests.get(IMAGINE_METRICS_URL.format(address=address), timeout=CONNECT_TIMEOUT)
+    response.raise_for_status()
+
+    metrics = {}
+    for line in response.text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        sample, value = line.rsplit(' ', 1)
+        name, _, labels = sample.partition('{')
+        metrics[(name, labels.rstrip('}'))] = float(value)
+    return metrics
+
+
+def server_state(address):
+    # values watched for leaks
+    metrics = read_metrics(address)
+    return {
+        'threads': int(metrics.get(('imagine_threads', ''), 0)),
+        'memory': int(next((value for (name, labels), value in metrics.items() if name == 'imagine_device_memory_bytes' and 'kind="process"' in labels), 0)),
+        'queue': int(metrics.get(('imagine_queue_depth', ''), 0)),
+        'active': int(metrics.get(('imagine_active_jobs', ''), 0)),
+        'inflight': int(metrics.get(('imagine_inflight_jobs', ''), 0))
+    }
+
+
+def settle(address, before, timeout):
+    # wait for the server to drain cancelled and finished work, then report its state
+    deadline = time.monotonic() + timeout
+    while True:
+        state = server_state(address)
+        idle = state['queue'] == 0 and state['active'] == 0 and state['inflight'] == 0
+        if (idle and state['threads'] <= before['threads']) or time.monotonic() >= deadline:
+            return state
+        time.sleep(0.5)
+
+
+class LoadTest:
+    """
+    Concurrent clients sending /generate requests of mixed behaviour:
+    - plain: non-streaming request, waits for the final record
+    - stream: streaming request, reads every record
+    - disconnect: streaming request, closes the connection after the first record
+    - abort: non-streaming request, gives up after a short read timeout
+    """
+    def __init__(self, args):
+        self.args = args
+        self.url = imagine_run.IMAGINE_URL.format(address=args.address)
+
+        # behaviour of every request, fixed by seed so runs are comparable
+        rng = random.Random(args.seed)
+        weights = [max(1 - args.stream - args.disconnect - args.abort, 0), args.stream, args.disconnect, args.abort]
+        self.kinds = rng.choices(KINDS, weights=weights, k=args.requests)
+        self.abort_after = [rng.uniform(*ABORT_AFTER) for _ in range(args.requests)]
+
+        self.next_index = itertools.count()
+        self.results = [] # (kind, outcome, latency, time to first record)
+        self.errors = collections.Counter() # error message -> count
+        self.lock = threading.Lock()
+
+    def payload(self, index, stream):
+        payload = {
+            'model': self.args.model,
+            'prompt': f'load test {index}',
+            'width': self.args.width,
+            'height': self.args.height,
+            'steps': self.args.steps,
+            'seed': index,
+            'cache': False
+        }
+        if stream:
+            payload['stream'] = 1
+        return payload
+
+    def error(self, message):
+        with self.lock:
+            self.errors[message] += 1
+        return 'error'
+
+    def send(self, session, index):
+        # (outcome, latency, time to first record) of one request
+        kind = self.kinds[index]
+        stream = kind in ('stream', 'disconnect')
+        timeout = (CONNECT_TIMEOUT, self.abort_after[index] if kind == 'abort' else REQUEST_TIMEOUT)
+
+        started = time.monotonic()
+        first = None
+        try:
+            with session.post(self.url, json=self.payload(index, stream), stream=stream, timeout=timeout) as response:
+                if response.status_code == 429:
+                    return 'rejected', None, None
+                if response.status_code != 200:
+                    return self.error(f'HTTP {response.status_code}'), None, None
+
+                final = False
+                for line in response.iter_lines():
+                    record = json.loads(line)
+                    if first is None:
+                        first = time.monotonic() - started
+
+                    if kind == 'disconnect':
+                        # leave without reading the rest, the server sees a broken connection
+                        return 'disconnected', None, first
+                    if record.get('status') == 'error':
+                        return self.error(record.get('details') or record.get('error')), None, first
+                    final = final or record.get('status') == 'final'
+
+                if not final:
+                    return self.error('No final record'), None, first
+                return 'ok', time.monotonic() - started, first
+
+        except requests.exceptions.Timeout:
+            return ('aborted' if kind == 'abort' else 'timeout'), None, first
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return self.error(f'{type(e).__name__}: {e}'), None, first
+
+    def client(self):
+        with requests.Session() as session:
+            while True:
+                index = next(self.next_index)
+                if index >= self.args.requests:
+                    return
+
+                outcome, latency, first = self.send(session, index)
+                with self.lock:
+                    self.results.append((self.kinds[index], outcome, latency, first))
+
+    def run(self):
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.clients) as executor:
+            for future in [executor.submit(self.client) for _ in range(self.args.clients)]:
+                future.result()
+        return time.monotonic() - started
+
+    def report(self, duration):
+        outcomes = {}
+        for kind, outcome, _, _ in self.results:
+            outcomes.setdefault(kind, {}).setdefault(outcome, 0)
+            outcomes[kind][outcome] += 1
+
+        completed = [latency for _, outcome, latency, _ in self.results if outcome == 'ok']
+        return {
+            'duration': duration,
+            'outcomes': outcomes,
+            'throughput': len(completed) / duration, # completed requests/s
+            'latency': {kind: percentiles([latency for k, outcome, latency, _ in self.results if k == kind and outcome == 'ok']) for kind in KINDS},
+            'first_record': percentiles([first for kind, _, _, first in self.results if kind in ('stream', 'disconnect') and first is not None]),
+            'errors': dict(self.errors.most_common(10))
+        }
+
+
+def format_percentiles(values):
+    if values is None:
+        return '-'
+    return f"p50 {values['p50'] * 1000:.0f} ms, p90 {values['p90'] * 1000:.0f} ms, p99 {values['p99'] * 1000:.0f} ms, max {values['max'] * 1000:.0f} ms ({values['count']})"
+
+
+def retry_after(response):
+    try:
+        return max(float(response.headers.get('Retry-After', 1)), 0.1)
+    except ValueError:
+        return 1
+
+
+def warmup(args):
+    # model loaded and lazily started threads (previews) running before counting threads,
+    # waits while the server warms up (503) or its queue is full (429), returns False on other errors
+    print(f'Warming up {args.model} on {args.address}')
+    deadline = time.monotonic() + WARMUP_TIMEOUT
+
+    try:
+        while True:
+            response = requests.get(IMAGINE_READY_URL.format(address=args.address), timeout=CONNECT_TIMEOUT)
+            if response.status_code != 503 or time.monotonic() > deadline:
+                break
+            print('Server is warming up, waiting')
+            time.sleep(retry_after(response))
+
+        while True:
+            response = requests.post(imagine_run.IMAGINE_URL.format(address=args.address), json={
+                'model': args.model, 'prompt': 'warmup', 'width': args.width, 'height': args.height, 'steps': 1, 'stream': 1, 'cache': False
+            }, timeout=REQUEST_TIMEOUT)
+            if response.status_code not in (429, 503) or time.monotonic() > deadline:
+                break
+            print(f'Server answered {response.status_code}, retrying in {retry_after(response):.1f}s')
+            time.sleep(retry_after(response))
+    except requests.exceptions.RequestException as e:
+        print(f'Warmup failed: {e}')
+        return False
+
+    if response.status_code != 200:
+        print(f'Warmup failed: server answered {response.status_code}: {response.text[:200]}')
+        return False
+    return True
+
+
+def loadtest(args):
+    if not warmup(args):
+        return
+
+    before = server_state(args.address)
+
+    test = LoadTest(args)
+    print(f'Sending {args.requests} requests from {args.clients} clients')
+    report = test.report(test.run())
+
+    after = settle(args.address, before, args.settle)
+    report['server'] = {
+        'threads': {'before': before['threads'], 'after': after['threads'], 'growth': after['threads'] - before['threads']},
+        'memory': {'before': before['memory'], 'after': after['memory'], 'growth': after['memory'] - before['memory']},
+        'queue': after['queue'],
+        'active': after['active'],
+        'inflight': after['inflight']
+    }
+    report['config'] = {key: getattr(args, key) for key in ('model', 'clients', 'requests', 'steps', 'width', 'height', 'stream', 'disconnect', 'abort', 'seed')}
+
+    print(f"Finished in {report['duration']:.1f}s, {report['throughput']:.2f} requests/s")
+    for kind, outcomes in sorted(report['outcomes'].items()):
+        print(f"  {kind:<10} {', '.join(f'{outcome} {count}' for outcome, count in sorted(outcomes.items()))}")
+        print(f"  {'':<10} {format_percentiles(report['latency'][kind])}")
+    print(f"  first record {format_percentiles(report['first_record'])}")
+    for message, count in report['errors'].items():
+        print(f"  error ({count}): {message}")
+
+    server = report['server']
+    print(f"Server threads {server['threads']['before']} -> {server['threads']['after']} ({server['threads']['growth']:+d}), "
+          f"memory {server['memory']['before'] / 1024**2:.0f} -> {server['memory']['after'] / 1024**2:.0f} MiB ({server['memory']['growth'] / 1024**2:+.1f} MiB), "
+          f"{server['queue']} queued, {server['active']} active, {server['inflight']} inflight after {args.settle}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results saved: {args.output}')
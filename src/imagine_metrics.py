@@ -0,0 +1,103 @@
+import bisect
+import threading
+
+
+# stage duration buckets (s), from a single denoise step to loading a model from disk
+STAGE_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+# generation stages in pipeline order
+STAGES = ['cache', 'queue', 'load', 'encode', 'step', 'denoise', 'preview', 'hires', 'decode', 'png', 'base64', 'total']
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    # cumulative bucket counts, sum and count of observed values
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        # (sample name, labels, value) lines of the Prometheus histogram
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            cumulative += count
+            yield f'{name}_bucket', {**labels, 'le': format_value(bound)}, cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+
+class Metrics:
+    """
+    Process-wide generation metrics in Prometheus text format.
+
+    Stage durations go into one `imagine_stage_seconds` histogram labeled by stage,
+    request outcomes into `imagine_requests_total`. Point in time values (queue depth,
+    cache sizes, device memory) are read when rendering and passed to `render` as gauges.
+    """
+    def __init__(self):
+        self.stages = {} # stage -> Histogram
+        self.requests = {} # outcome -> count
+        self.images = 0
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    def count_request(self, outcome):
+        with self.lock:
+            self.requests[outcome] = self.requests.get(outcome, 0) + 1
+
+    def count_images(self, count):
+        with self.lock:
+            self.images += count
+
+    def render(self, gauges=()):
+        # `gauges`: (name, type, help, [(labels, value)]) read by the caller
+        families = []
+
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: STAGES.index(item[0]) if item[0] in STAGES else len(STAGES))
+            families.append(('imagine_stage_seconds', 'histogram', 'Time spent per generation stage', [
+                sample for stage, histogram in stages for sample in histogram.samples('imagine_stage_seconds', {'stage': stage})
+            ]))
+            families.append(('imagine_requests_total', 'counter', 'Generation requests by outcome', [
+                ('imagine_requests_total', {'outcome': outcome}, count) for outcome, count in sorted(self.requests.items())
+            ]))
+            families.append(('imagine_images_total', 'counter', 'Images generated by the pipeline', [
+                ('imagine_images_total', {}, self.images)
+            ]))
+
+        for name, metric_type, help_text, values in gauges:
+            families.append((name, metric_type, help_text, [(name, labels, value) for labels, value in values]))
+
+        lines = []
+        for name, metric_type, help_text, samples in families:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for sample_name, labels, value in samples:
+                lines.append(f'{sample_name}{format_labels(labels)} {format_value(value)}')
+
+        return ('\n'.join(lines) + '\n').encode('utf-8')
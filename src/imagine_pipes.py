@@ -0,0 +1,391 @@
+import gc
+import os
+import time
+import itertools
+import threading
+import collections
+
+import torch
+import diffusers
+
+import imagine_catalog
+import imagine_server_defs
+
+
+# rough peak activation elements per latent pixel of one UNet batch entry and per pixel of one VAE decoded image
+UNET_ACTIVATION = 30000
+VAE_ACTIVATION = 5000
+
+# memory modes moving weights between cpu and device
+OFFLOAD_MODES = ['offload', 'sequential']
+
+
+def free_memory(dev):
+    # free memory in bytes for device, None if unknown
+    try:
+        if dev.startswith('cuda') and torch.cuda.is_available():
+            free, _ = torch.cuda.mem_get_info(torch.device(dev))
+            return free
+        if dev == 'mps' and torch.backends.mps.is_available():
+            return torch.mps.recommended_max_memory() - torch.mps.driver_allocated_memory()
+    except Exception:
+        return None
+
+    # cpu: MemAvailable from /proc/meminfo on linux, physical pages otherwise
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def device_memory(dev):
+    # {kind: bytes} of memory use on device, for metrics
+    memory = {}
+
+    free = free_memory(dev)
+    if free is not None:
+        memory['free'] = free
+
+    try:
+        if dev.startswith('cuda') and torch.cuda.is_available():
+            device = torch.device(dev)
+            memory['allocated'] = torch.cuda.memory_allocated(device)
+            memory['reserved'] = torch.cuda.memory_reserved(device)
+            memory['peak'] = torch.cuda.max_memory_allocated(device)
+            memory['total'] = torch.cuda.get_device_properties(device).total_memory
+        elif dev == 'mps' and torch.backends.mps.is_available():
+            memory['allocated'] = torch.mps.current_allocated_memory()
+            memory['reserved'] = torch.mps.driver_allocated_memory()
+    except Exception:
+        pass
+
+    # resident set of the server process, holds the weights on cpu
+    try:
+        with open('/proc/self/statm') as f:
+            memory['process'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        pass
+
+    return memory
+
+
+def synchronize(dev):
+    # wait for queued device work, so host clocks measure it
+    if dev.startswith('cuda') and torch.cuda.is_available():
+        torch.cuda.synchronize(torch.device(dev))
+    elif dev == 'mps' and torch.backends.mps.is_available():
+        torch.mps.synchronize()
+
+
+def reset_peak_memory(dev):
+    # start measuring `peak_memory` from current use
+    try:
+        if dev.startswith('cuda') and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats(torch.device(dev))
+        elif dev == 'cpu':
+            # resets VmHWM of the process on linux
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+    except (OSError, RuntimeError):
+        pass
+
+
+def peak_memory(dev):
+    # bytes of peak memory use on device since `reset_peak_memory`, None if unknown
+    try:
+        if dev.startswith('cuda') and torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated(torch.device(dev))
+        if dev == 'mps' and torch.backends.mps.is_available():
+            # no peak statistics, memory held by the driver after the run
+            return torch.mps.driver_allocated_memory()
+    except RuntimeError:
+        return None
+
+    # cpu: peak resident set of the process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def module_size(module, dev=None):
+    # bytes of module weights, only those on `dev` if given
+    size = 0
+    for tensor in itertools.chain(module.parameters(), module.buffers()):
+        if dev is None or tensor.device.type == torch.device(dev).type:
+            size += tensor.numel() * tensor.element_size()
+
+    # packed weights of int8 layers (cpu only) are not parameters
+    if dev is None or torch.device(dev).type == 'cpu':
+        for layer in module.modules():
+            if isinstance(layer, torch.ao.nn.quantized.dynamic.Linear):
+                size += sum(tensor.numel() * tensor.element_size() for tensor in layer._weight_bias() if tensor is not None)
+    return size
+
+
+def pipe_size(pipe):
+    # bytes occupied by pipeline weights
+    return sum(module_size(component) for component in pipe.components.values() if isinstance(component, torch.nn.Module))
+
+
+def prepare_pipe(pipe, dev, fp_prec):
+    pipe.unet.set_attn_processor(diffusers.models.attention_processor.AttnProcessor2_0())
+    pipe.to(dev, fp_prec)
+
+    pipe.unet.to(fp_prec)
+    pipe.vae.to(fp_prec)
+    pipe.text_encoder.to(fp_prec)
+
+    return pipe
+
+
+def load_pipe(model_path, dev, fp_prec):
+    print(f"Loading model: {model_path} for device {dev}, precision {fp_prec}")
+
+    # diffusers layout needs no checkpoint conversion
+    if os.path.isdir(model_path):
+        pipe = diffusers.StableDiffusionPipeline.from_pretrained(model_path, torch_dtype=fp_prec, safety_checker=None, requires_safety_checker=False)
+    else:
+        pipe = diffusers.StableDiffusionPipeline.from_single_file(model_path, torch_dtype=fp_prec, safety_checker=None, requires_safety_checker=False)
+    return prepare_pipe(pipe, dev, fp_prec)
+
+
+@torch.no_grad()
+def decode_images(pipe, latents):
+    # VAE decode of final latents into PIL images, same as the end of a pipeline call
+    images = pipe.vae.decode(latents / pipe.vae.config.scaling_factor, return_dict=False)[0]
+    return pipe.image_processor.postprocess(images, output_type='pil', do_denormalize=[True] * images.shape[0])
+
+
+def memory_estimate(pipe, width, height, count, fp_prec):
+    # rough peak activation bytes of (denoising, VAE decode, tiled VAE decode) for `count` images
+    element_size = torch.finfo(fp_prec).bits // 8
+    latent_pixels = (width // 8) * (height // 8)
+
+    # classifier-free guidance doubles the UNet batch, tiled VAE decodes one tile of one image at a time
+    tile = getattr(pipe.vae, 'tile_sample_min_size', 512)
+    unet = 2 * count * latent_pixels * UNET_ACTIVATION * element_size
+    vae = count * width * height * VAE_ACTIVATION * element_size
+    vae_tiled = min(tile, width) * min(tile, height) * VAE_ACTIVATION * element_size
+    return unet, vae, vae_tiled
+
+
+def choose_memory_mode(pipe, dev, width, height, count, fp_prec, reserve=0):
+    # cheapest memory mode that fits a `count` x `width`x`height` generation into free device memory
+    free = free_memory(dev)
+    if free is None:
+        return 'none'
+
+    weights = pipe_size(pipe)
+    if dev.startswith('cuda') and torch.cuda.is_available():
+        # memory cached by torch is free for the generation, weights count as if on the device
+        device = torch.device(dev)
+        free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        free -= weights - sum(module_size(component, dev) for component in pipe.components.values() if isinstance(component, torch.nn.Module))
+
+    budget = free - reserve
+    unet, vae, vae_tiled = memory_estimate(pipe, width, height, count, fp_prec)
+
+    if unet + vae <= budget:
+        return 'none'
+    if unet + vae_tiled <= budget:
+        return 'tiled'
+    if not dev.startswith('cuda'):
+        # nothing to offload to, smallest attention working set
+        return 'sliced'
+
+    # model offload keeps one component on the device at a time, the UNet while denoising
+    if unet + vae_tiled <= budget + weights - module_size(pipe.unet):
+        return 'offload'
+    return 'sequential'
+
+
+def set_memory_mode(pipe, mode, dev):
+    # switch resident pipeline to memory `mode`, pipelines derived from it share the change
+    if not isinstance(pipe, diffusers.DiffusionPipeline):
+        return
+
+    current = getattr(pipe, 'memory_mode', 'none')
+    if mode == current:
+        return
+
+    started = time.monotonic()
+    if current in OFFLOAD_MODES:
+        pipe.remove_all_hooks()
+        pipe.to(dev)
+
+    # VAE decodes one image at a time, large ones in overlapping tiles
+    if mode == 'none':
+        pipe.vae.disable_tiling()
+        pipe.vae.disable_slicing()
+    else:
+        pipe.vae.enable_tiling()
+        pipe.vae.enable_slicing()
+
+    memory_format = torch.contiguous_format if mode == 'none' else torch.channels_last
+    pipe.unet.to(memory_format=memory_format)
+    pipe.vae.to(memory_format=memory_format)
+
+    # SDPA is memory efficient on cuda, sliced attention helps where it is not
+    if mode == 'sliced':
+        pipe.unet.set_attention_slice('auto')
+    else:
+        pipe.unet.set_attn_processor(diffusers.models.attention_processor.AttnProcessor2_0())
+
+    # weights stay on cpu, whole components or single layers move to the device when used
+    if mode == 'offload':
+        pipe.enable_model_cpu_offload(device=dev)
+    elif mode == 'sequential':
+        pipe.enable_sequential_cpu_offload(device=dev)
+
+    pipe.memory_mode = mode
+    print(f"Memory mode: {current} -> {mode} in {time.monotonic() - started:.1f}s")
+
+
+def quantize_pipe(pipe, quant):
+    # int8 weights of UNet and text encoder linear layers, activations quantized per call (cpu, float32 pipelines)
+    if quant != 'int8' or not isinstance(pipe, diffusers.DiffusionPipeline):
+        return pipe
+
+    started = time.monotonic()
+    size = pipe_size(pipe)
+    for module in (pipe.unet, pipe.text_encoder):
+        torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    print(f"Quantized UNet and text encoder to int8: {size / 1024**2:.0f} -> {pipe_size(pipe) / 1024**2:.0f} MiB in {time.monotonic() - started:.1f}s")
+    return pipe
+
+
+def compile_pipe(pipe):
+    # inductor kernels for denoising loop and VAE decode, compiled on first call per input shape
+    pipe.unet.compile()
+    pipe.vae.decode = torch.compile(pipe.vae.decode)
+
+
+class PipelineCache:
+    """
+    LRU cache of resident pipelines keyed by (model path, device, precision).
+
+    A model is evicted when more than `max_models` are resident or when loading the next
+    one would leave less than `mem_reserve` bytes of device memory free. With `compile`
+    loaded pipelines are compiled by `compile_pipe`. With a `store` (`imagine_store.ModelStore`)
+    single-file checkpoints are loaded through its converted copies. With `quant` loaded
+    pipelines are quantized by `quantize_pipe` once and stay resident quantized.
+    """
+    def __init__(self, max_models=imagine_server_defs.DEFAULT_MAX_MODELS, mem_reserve=imagine_server_defs.DEFAULT_MEM_RESERVE * 1024**2, compile=False, store=None, loader=load_pipe, quant=imagine_server_defs.DEFAULT_QUANT):
+        self.max_models = max(max_models, 1)
+        self.mem_reserve = mem_reserve
+        self.compile = compile
+        self.quant = quant
+        self.store = store
+        self.loader = loader # loader(model_path, dev, fp_prec) -> pipe
+
+        self.pipes = collections.OrderedDict() # key -> (pipe, size in bytes)
+        self.lock = threading.Lock() # guards `pipes`
+        self.load_lock = threading.Lock() # serializes checkpoint loads
+
+    def key(self, model_path, dev, fp_prec):
+        return (os.path.realpath(model_path), dev, str(fp_prec))
+
+    def lookup(self, key):
+        with self.lock:
+            if key not in self.pipes:
+                return None
+            self.pipes.move_to_end(key)
+            return self.pipes[key][0]
+
+    def resident(self):
+        with self.lock:
+            return list(self.pipes.keys())
+
+    def evict(self, key=None):
+        # evict given key or least recently used one
+        with self.lock:
+            if not self.pipes:
+                return False
+            if key is None:
+                key = next(iter(self.pipes))
+            if key not in self.pipes:
+                return False
+            self.pipes.pop(key)
+
+        print(f"Evicting model: {key[0]} ({key[1]}, {key[2]})")
+        gc.collect()
+        if key[1].startswith('cuda') and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return True
+
+    def make_room(self, dev, estimate):
+        # evict until model count and memory budget allow one more model of `estimate` bytes
+        while True:
+            with self.lock:
+                count = len(self.pipes)
+            if count == 0:
+                return
+            if count >= self.max_models:
+                self.evict()
+                continue
+
+            free = free_memory(dev)
+            if free is not None and free - estimate < self.mem_reserve:
+                self.evict()
+                continue
+            return
+
+    def get(self, model_path, dev, fp_prec, loader=None):
+        key = self.key(model_path, dev, fp_prec)
+        loader = loader or self.loader
+
+        pipe = self.lookup(key)
+        if pipe is not None:
+            return pipe
+
+        with self.load_lock:
+            # model could be loaded by another request while we waited
+            pipe = self.lookup(key)
+            if pipe is not None:
+                return pipe
+
+            if not os.path.exists(model_path):
+                raise ValueError(f"Model '{os.path.splitext(os.path.basename(model_path))[0]}' not found")
+
+            self.make_room(dev, imagine_catalog.model_size(model_path))
+
+            started = time.monotonic()
+            if self.store is not None and not os.path.isdir(model_path):
+                pipe = self.store.load(model_path, dev, fp_prec, loader)
+            else:
+                pipe = loader(model_path, dev, fp_prec)
+            pipe = quantize_pipe(pipe, self.quant)
+            size = pipe_size(pipe)
+
+            if self.compile:
+                compile_pipe(pipe)
+
+            with self.lock:
+                self.pipes[key] = (pipe, size)
+            print(f"Model resident: {model_path} ({size / 1024**2:.0f} MiB) in {time.monotonic() - started:.1f}s, {len(self.pipes)}/{self.max_models} cached")
+            return pipe
+
+
+def derive_pipe(base, img2img, scheduler_cls, fp_prec):
+    # per-request pipeline sharing weights of `base` with its own scheduler
+    if not isinstance(base, diffusers.DiffusionPipeline):
+        # stub backends (`imagine_fake.FakePipe`) derive their own
+        return base.derive(img2img, scheduler_cls)
+
+    pipe_cls = diffusers.StableDiffusionImg2ImgPipeline if img2img else diffusers.StableDiffusionPipeline
+    scheduler = scheduler_cls.from_config(base.scheduler.config)
+    return pipe_cls.from_pipe(base, scheduler=scheduler, torch_dtype=fp_prec)
@@ -0,0 +1,127 @@
+import os
+import zlib
+import struct
+import threading
+
+
+# PNG chunk level reading and writing, pixel data is never decoded
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+CHUNK_PREFIX = struct.Struct('>I4s')
+CRC = struct.Struct('>I')
+TEXT_CHUNKS = (b'tEXt', b'iTXt', b'zTXt')
+
+
+def chunk(chunk_type, data):
+    # length, type, data and CRC of type and data
+    return CHUNK_PREFIX.pack(len(data), chunk_type) + data + CRC.pack(zlib.crc32(chunk_type + data))
+
+
+def text_chunk(key, text):
+    # tEXt for latin-1 text, uncompressed iTXt otherwise, as PIL writes them
+    try:
+        return chunk(b'tEXt', key.encode('latin-1') + b'\0' + text.encode('latin-1'))
+    except UnicodeEncodeError:
+        return chunk(b'iTXt', key.encode('latin-1') + b'\0\0\0\0\0' + text.encode('utf-8'))
+
+
+def parse_text(chunk_type, data):
+    # (key, text) of a text chunk
+    key, _, value = data.partition(b'\0')
+    if chunk_type == b'tEXt':
+        return key.decode('latin-1'), value.decode('latin-1')
+    if chunk_type == b'zTXt':
+        return key.decode('latin-1'), zlib.decompress(value[1:]).decode('latin-1')
+
+    # iTXt: compression flag and method, language tag, translated keyword, text
+    compressed = value[0] == 1
+    _, _, value = value[2:].partition(b'\0')
+    _, _, value = value.partition(b'\0')
+    return key.decode('latin-1'), (zlib.decompress(value) if compressed else value).decode('utf-8')
+
+
+def iter_chunks(png):
+    # (type, start offset, end offset) of every chunk in png bytes
+    if not png.startswith(SIGNATURE):
+        raise ValueError('Not a PNG image')
+
+    offset = len(SIGNATURE)
+    while offset < len(png):
+        length, chunk_type = CHUNK_PREFIX.unpack_from(png, offset)
+        end = offset + CHUNK_PREFIX.size + length + CRC.size
+        if end > len(png):
+            raise ValueError('PNG image is truncated')
+        yield chunk_type, offset, end
+        offset = end
+        if chunk_type == b'IEND':
+            return
+
+
+def set_text(png, key, text):
+    # png bytes with text chunk `key` replaced by `text`, spliced in after the header chunk
+    parts = []
+    for chunk_type, start, end in iter_chunks(png):
+        if chunk_type in TEXT_CHUNKS and parse_text(chunk_type, png[start + CHUNK_PREFIX.size:end - CRC.size])[0] == key:
+            continue
+        parts.append(png[start:end])
+        if chunk_type == b'IHDR':
+            parts.append(text_chunk(key, text))
+    return SIGNATURE + b''.join(parts)
+
+
+def read_text(path):
+    # {key: text} of a PNG file, image data chunks are skipped without reading them
+    texts = {}
+    with open(path, 'rb') as f:
+        if f.read(len(SIGNATURE)) != SIGNATURE:
+            raise ValueError(f'Not a PNG image: {path}')
+
+        while True:
+            prefix = f.read(CHUNK_PREFIX.size)
+            if len(prefix) < CHUNK_PREFIX.size:
+                break
+            length, chunk_type = CHUNK_PREFIX.unpack(prefix)
+
+            if chunk_type in TEXT_CHUNKS:
+                key, text = parse_text(chunk_type, f.read(length))
+                texts.setdefault(key, text)
+                f.seek(CRC.size, os.SEEK_CUR)
+            else:
+                f.seek(length + CRC.size, os.SEEK_CUR)
+
+            if chunk_type == b'IEND':
+                break
+    return texts
+
+
+def copy_chunks(path, key=None):
+    # raw signature and chunks of a PNG file in order, without text chunk `key`
+    with open(path, 'rb') as f:
+        signature = f.read(len(SIGNATURE))
+        if signature != SIGNATURE:
+            raise ValueError(f'Not a PNG image: {path}')
+        yield signature
+
+        while True:
+            prefix = f.read(CHUNK_PREFIX.size)
+            if len(prefix) < CHUNK_PREFIX.size:
+                return
+            length, chunk_type = CHUNK_PREFIX.unpack(prefix)
+            rest = f.read(length + CRC.size)
+
+            if key is None or chunk_type not in TEXT_CHUNKS or parse_text(chunk_type, rest[:length])[0] != key:
+                yield prefix + rest
+            if chunk_type == b'IEND':
+                return
+
+
+def write_file(path, data):
+    # readers of `path` see the previous or the new contents, never a partial write
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
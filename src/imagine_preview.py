@@ -0,0 +1,101 @@
+import io
+import os
+import threading
+import concurrent.futures
+
+import torch
+import diffusers
+
+import imagine_server_defs
+
+from PIL import Image
+
+
+PREVIEW_MODES = imagine_server_defs.PREVIEW_MODES
+TAESD_DIR = 'taesd' # diffusers AutoencoderTiny (madebyollin/taesd) inside models path
+
+# linear approximation of SD 1.x/2.x VAE decoder: latent channels -> RGB
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177]
+]
+
+# previews are encoded here instead of on the denoising thread, one worker keeps them ordered
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='imagine-preview')
+
+taesd_decoders = {} # (device, dtype) -> AutoencoderTiny
+taesd_lock = threading.Lock()
+
+
+def load_taesd(models_path, dev, fp_prec):
+    # tiny autoencoder for cheap previews, None if not installed
+    taesd_path = os.path.join(os.path.expanduser(models_path), TAESD_DIR)
+    if not os.path.isdir(taesd_path):
+        return None
+
+    key = (dev, str(fp_prec))
+    with taesd_lock:
+        if key not in taesd_decoders:
+            print(f"Loading preview decoder: {taesd_path} for device {dev}, precision {fp_prec}")
+            taesd_decoders[key] = diffusers.AutoencoderTiny.from_pretrained(taesd_path, torch_dtype=fp_prec).to(dev)
+        return taesd_decoders[key]
+
+
+def to_pil(images):
+    # float (B, 3, H, W) in [0, 1] -> PIL images
+    images = (images * 255).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+    return [Image.fromarray(image) for image in images]
+
+
+class Previewer:
+    """
+    Turns intermediate latents into preview images.
+
+    `decode` runs on the denoising thread and only does the cheap tensor work of the
+    selected mode, `encode` resizes and compresses on the preview executor:
+    - full: VAE decode, full resolution PNG (previous behaviour)
+    - latent: linear latent -> RGB projection, JPEG at `size`
+    - taesd: tiny autoencoder decode, JPEG at `size`
+    """
+    def __init__(self, mode, pipe, size, taesd=None):
+        if mode == 'taesd' and taesd is None:
+            print(f"Preview decoder '{TAESD_DIR}' not found in models path, falling back to latent previews.")
+            mode = 'latent'
+
+        self.mode = mode
+        self.pipe = pipe
+        self.size = size
+        self.taesd = taesd
+        self.format = 'png' if mode == 'full' else 'jpeg'
+
+    @torch.no_grad()
+    def decode(self, latents):
+        if self.mode == 'full':
+            sample = self.pipe.decode_latents(latents)
+            return self.pipe.numpy_to_pil(sample)
+
+        if self.mode == 'taesd':
+            images = self.taesd.decode(latents.to(self.taesd.dtype) / self.taesd.config.scaling_factor).sample
+            return to_pil((images.float() / 2 + 0.5).clamp(0, 1))
+
+        factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+        images = torch.einsum('bchw,cr->brhw', latents.float(), factors)
+        return to_pil(((images + 1) / 2).clamp(0, 1))
+
+    def encode(self, image):
+        buffer = io.BytesIO()
+
+        if self.format == 'png':
+            image.save(buffer, format='PNG')
+        else:
+            # fit into `size` box keeping aspect ratio, latent previews get upscaled
+            scale = self.size / max(image.size)
+            image = image.resize((max(int(image.width * scale), 1), max(int(image.height * scale), 1)), Image.BILINEAR)
+            image.save(buffer, format='JPEG', quality=80)
+
+        return buffer.getvalue()
+
+    def publish(self, image, job, index):
+        job.put_sample((index, self.encode(image), self.format))
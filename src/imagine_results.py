@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import threading
+import collections
+
+import imagine_server_defs
+
+
+def result_key(fields):
+    # canonical hash of every field the generated image depends on
+    canonical = json.dumps(fields, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    Disk cache of final PNG images keyed by `result_key`.
+
+    Every image is one `<key>.png` file in `path`, files are touched on hit and the least
+    recently used ones are removed once all of them take more than `max_size` bytes.
+    """
+    def __init__(self, path=imagine_server_defs.DEFAULT_CACHE_PATH, max_size=imagine_server_defs.DEFAULT_CACHE_SIZE * 1024**2):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+
+        self.entries = collections.OrderedDict() # key -> size in bytes, least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if self.max_size > 0:
+            self.scan()
+
+    def enabled(self):
+        return self.max_size > 0
+
+    def file(self, key):
+        return os.path.join(self.path, f'{key}.png')
+
+    def scan(self):
+        # index files left by previous runs, oldest first
+        os.makedirs(self.path, exist_ok=True)
+
+        files = []
+        for entry in os.scandir(self.path):
+            key, ext = os.path.splitext(entry.name)
+            if ext == '.png' and entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, key, stat.st_size))
+
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+
+        self.trim()
+        print(f"Result cache: {len(self.entries)} images ({self.size / 1024**2:.0f} MiB) in {self.path}")
+
+    def trim(self):
+        # caller holds `lock` or owns the cache exclusively
+        while self.size > self.max_size and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.file(key))
+            except OSError:
+                pass
+
+    def get(self, key):
+        if not self.enabled():
+            return None
+
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            try:
+                with open(self.file(key), 'rb') as f:
+                    data = f.read()
+                os.utime(self.file(key))
+            except OSError:
+                # removed behind our back
+                self.size -= self.entries.pop(key)
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if not self.enabled() or len(data) > self.max_size:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            # write to temporary file first, readers never see partial images
+            tmp_path = f'{self.file(key)}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.file(key))
+            except OSError as e:
+                print(f"Failed to cache result {key}: {e}")
+                return
+
+            self.entries[key] = len(data)
+            self.size += len(data)
+            self.trim()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses}
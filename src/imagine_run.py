@@ -1,73 +1,326 @@
 import io
 import os
+import csv
 import json
+import time
 import base64
+import hashlib
 import datetime
 import requests
+import threading
+import concurrent.futures
+
+import imagine_png
+import imagine_grid
+import imagine_frames
 
 from PIL import Image
-from PIL.PngImagePlugin import PngInfo
 
 
 IMAGINE_URL = 'http://{address}/generate'
+IMAGINE_GRID_URL = 'http://{address}/grid'
 DEFAULT_MODEL = 'dreamshaper_8'
 SAMPLERS = ['ddim', 'euler', 'euler a', 'heun', 'lms', 'dpm++ 2m', 'dpm++ 2s', 'dpm++ sde', 'dpm2', 'dpm2 a']
 
-def send_generate_request(payload, address, stream, filename, meta, save_meta, prefix="Image saved", resize=None):
-    meta_filename = f'{filename}.json'
-
-    response = requests.post(IMAGINE_URL.format(address=address), json=payload, stream=stream)
-    response.raise_for_status()
-
-    steps = 0
-    for msg in response.iter_lines():
-        result = json.loads(msg)
-
-        if 'img' in result:
-            seed = result.get('seed')
-            img_data = base64.b64decode(result['img'])
-            image = Image.open(io.BytesIO(img_data))
-
-            # For hires.fix, we need to resize the final image back to original dimensions
-            if resize is not None:
-                image = image.resize(resize)
+DEFAULT_CONCURRENCY = 4
+MANIFEST_FILE = 'manifest.jsonl'
+MAX_RETRIES = 5
+STREAM_SAVE_INTERVAL = 0.5 # s, streamed samples replace the output image at most this often
+BASE64_CHUNK = 3 * 2**16 # bytes encoded at a time when streaming base64 to a file
+
+# CSV cells are strings, payload fields the server expects as numbers
+CSV_INT_FIELDS = ['width', 'height', 'steps', 'clip', 'count', 'priority', 'tile', 'tile_overlap']
+CSV_FLOAT_FIELDS = ['guidance', 'strength', 'hires', 'hires_strength']
+
+def indexed_filename(filename, index, count):
+    # name_0.png ... name_N.png when several images are generated
+    if count <= 1:
+        return filename
+
+    base_filename, ext = os.path.splitext(filename)
+    return f'{base_filename}_{index}{ext}'
+
+
+def encode_base64(f, pieces):
+    # writes base64 of consecutive byte `pieces` to text file `f`
+    rest = b''
+    for piece in pieces:
+        data = rest + piece
+        cut = len(data) - len(data) % 3
+        for start in range(0, cut, BASE64_CHUNK):
+            f.write(base64.b64encode(data[start:min(start + BASE64_CHUNK, cut)]).decode('ascii'))
+        rest = data[cut:]
+    f.write(base64.b64encode(rest).decode('ascii'))
+
+
+def save_meta_json(filename, meta, out):
+    # {"meta": ..., "out": base64 image} json file, `out` is base64 text or an iterable of image bytes streamed to the file
+    head, tail = json.dumps({'meta': meta, 'out': ''}, indent=2, ensure_ascii=False).rsplit('""', 1)
+
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(head + '"')
+        if isinstance(out, str):
+            f.write(out)
+        else:
+            encode_base64(f, out)
+        f.write('"' + tail)
 
-            meta['meta']['seed'] = seed
-            meta['meta']['date'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            meta['out'] = result['img']
 
-            meta_json = json.dumps(meta, indent=2, ensure_ascii=False)
-            meta_meta_json = json.dumps(meta['meta'], indent=2, ensure_ascii=False)
+def read_results(response, stream):
+    # (record, image bytes or None) from binary frames or NDJSON lines
+    if response.headers.get('Content-Type', '').startswith(imagine_frames.CONTENT_TYPE):
+        source = response.raw if stream else io.BytesIO(response.content)
+        for header, data in imagine_frames.read_frames(source):
+            yield header, data or None
+    else:
+        for msg in response.iter_lines():
+            result = json.loads(msg)
+            yield result, base64.b64decode(result['img']) if 'img' in result else None
 
-            info = PngInfo()
-            info.add_text("meta", meta_meta_json)
 
-            image.save(filename, pnginfo=info)
+def send_generate_request(payload, address, stream, filename, meta, save_meta, prefix="Image saved", resize=None, session=None):
+    count = len(payload['seeds']) if payload.get('seeds') else payload.get('count', 1)
 
-            if save_meta:
-                with open(meta_filename, 'w') as f:
-                    f.write(meta_json)
+    # binary frames if the server supports them, NDJSON otherwise
+    headers = {'Accept': imagine_frames.ACCEPT}
+    response = (session or requests).post(IMAGINE_URL.format(address=address), json=payload, headers=headers, stream=stream)
+    response.raise_for_status()
 
-            print(f'{prefix} [{steps}/{payload["steps"]}]: {filename}')
-            steps += 1
+    steps = {}
+    results = {}
+    saved = {} # index -> time the output image was last replaced by a streamed sample
+    for result, img_data in read_results(response, stream):
+        if img_data is not None:
+            index = result.get('index', 0)
+            seed = result.get('seed')
+            image_filename = indexed_filename(filename, index, count)
+            meta_filename = f'{image_filename}.json'
+            step = steps.get(index, 0)
+            steps[index] = step + 1
+
+            # streamed samples replace the output at a throttled rate, the final image always does
+            final = result.get('status') != 'intermediate'
+            now = time.monotonic()
+            if not final and now - saved.get(index, -STREAM_SAVE_INTERVAL) < STREAM_SAVE_INTERVAL:
+                continue
+            saved[index] = now
+
+            # meta of a single image, reproducible with its own seed
+            image_meta = {
+                'meta': {**meta['meta'], 'seed': seed, 'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")},
+                'out': ''
+            }
+            image_meta['meta'].pop('count', None)
+            image_meta['meta'].pop('seeds', None)
+
+            meta_meta_json = json.dumps(image_meta['meta'], indent=2, ensure_ascii=False)
+
+            # meta chunk spliced into the received PNG, pixels are only decoded to resize (hires.fix) or convert JPEG previews
+            png = img_data
+            if resize is not None or result.get('format', 'png') != 'png':
+                image = Image.open(io.BytesIO(img_data))
+                if resize is not None:
+                    image = image.resize(resize)
+                buffer = io.BytesIO()
+                image.save(buffer, format='PNG')
+                png = buffer.getvalue()
+
+            imagine_png.write_file(image_filename, imagine_png.set_text(png, 'meta', meta_meta_json))
+
+            if save_meta and final:
+                save_meta_json(meta_filename, image_meta['meta'], result['img'] if 'img' in result else [img_data])
+
+            print(f'{prefix} [{step}/{payload["steps"]}]: {image_filename}')
+            results[index] = {**result, 'data': img_data}
+        elif result.get('status') == 'queued':
+            print(f'Queued at position {result["position"]}')
         elif 'error' in result:
             print(f'Server error: {result["error"]}')
             if 'details' in result:
                 print(f'Details: {result["details"]}')
-    return result
+
+    # last received (final) result of every image
+    return [results[index] for index in sorted(results)]
+
+
+def encode_image_file(path):
+    img = Image.open(path).convert("RGB")
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+def read_batch(path):
+    # payload dicts from JSONL (one object per line) or CSV (header row with payload fields)
+    if os.path.splitext(path)[1].lower() == '.csv':
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                entry = {key: value for key, value in row.items() if key and value not in (None, '')}
+                for key in CSV_INT_FIELDS:
+                    if key in entry:
+                        entry[key] = int(entry[key])
+                for key in CSV_FLOAT_FIELDS:
+                    if key in entry:
+                        entry[key] = float(entry[key])
+                yield entry
+    else:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def entry_key(entry, defaults):
+    # identifies a batch entry in the manifest by the fields it is sent with, entries edited or run with other defaults are generated again
+    return hashlib.sha256(json.dumps({**defaults, **entry}, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def read_manifest(path):
+    # keys of entries finished by previous runs whose images still exist
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # line cut by an interrupted run
+            if all(os.path.exists(file) for file in record['files']):
+                finished.add(record['key'])
+    return finished
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def run_batch(args):
+    entries = list(read_batch(args.batch))
+
+    output_dir = args.output if args.output else os.path.splitext(args.batch)[0]
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    finished = read_manifest(manifest_path)
+
+    # defaults for fields missing in entries, seed is random per entry unless given
+    defaults = {
+        'model': args.model,
+        'width': args.width,
+        'height': args.height,
+        'steps': args.steps,
+        'guidance': args.guidance,
+        'sampler': args.sampler,
+        'neg': args.neg,
+        'strength': args.strength,
+        'clip': args.clip,
+        'count': args.count,
+        'hires': args.hires,
+        'hires_upscale': args.hires_upscale,
+        'memory': args.memory,
+        'cache_interval': args.cache_interval,
+        'tile': args.tile,
+        'tile_overlap': args.tile_overlap
+    }
+
+    todo = [(index, entry) for index, entry in enumerate(entries) if entry_key(entry, defaults) not in finished]
+    print(f'Batch: {len(entries)} entries, {len(entries) - len(todo)} already finished, {len(todo)} to generate with {args.concurrency} concurrent requests')
+    if not todo:
+        return
+
+    # one pooled keep-alive connection per concurrent request
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency)
+    session.mount('http://', adapter)
+
+    manifest_lock = threading.Lock()
+    progress = {'done': 0, 'images': 0, 'failed': 0}
+    started = time.monotonic()
+
+    def generate(index, entry):
+        payload = {**defaults, **entry, 'stream': None}
+        filename = payload.pop('output', None) or f'{index:05d}.png'
+        filename = os.path.join(output_dir, filename)
+
+        if isinstance(payload.get('prompt'), list):
+            payload['prompt'] = ' '.join(payload['prompt'])
+
+        # input image by path
+        if payload.get('img') and os.path.exists(payload['img']):
+            payload['img'] = encode_image_file(payload['img'])
+        if payload.get('img'):
+            payload['hires'] = None
+
+        meta = {'meta': payload, 'out': ''}
+        resize = (payload['width'], payload['height']) if payload.get('hires') and not payload.get('tile') else None
+
+        # server queue is full, wait as long as it asks
+        for attempt in range(MAX_RETRIES):
+            try:
+                results = send_generate_request(payload, args.address, False, filename, meta, args.meta, prefix=f"Entry {index} saved", resize=resize, session=session)
+                break
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 429 or attempt == MAX_RETRIES - 1:
+                    raise
+                time.sleep(float(e.response.headers.get('Retry-After', 1)))
+
+        count = len(results)
+        files = [indexed_filename(filename, result.get('index', i), count) for i, result in enumerate(results)]
+        record = {'key': entry_key(entry, defaults), 'index': index, 'files': files, 'seeds': [result.get('seed') for result in results]}
+
+        with manifest_lock:
+            with open(manifest_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+            progress['images'] += count
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+        futures = {executor.submit(generate, index, entry): index for index, entry in todo}
+
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                progress['done'] += 1
+                try:
+                    future.result()
+                except Exception as e:
+                    progress['failed'] += 1
+                    print(f'Entry {futures[future]} failed: {e}')
+
+                elapsed = time.monotonic() - started
+                rate = progress['done'] / elapsed
+                eta = (len(todo) - progress['done']) / rate if rate > 0 else 0
+                print(f'Batch [{progress["done"]}/{len(todo)}]: {progress["images"] / elapsed:.2f} img/s, elapsed {format_duration(elapsed)}, ETA {format_duration(eta)}')
+        except KeyboardInterrupt:
+            print('Batch interrupted, finished entries are skipped on restart.')
+            for future in futures:
+                future.cancel()
+            raise
+
+    print(f'Batch finished: {progress["images"]} images in {format_duration(time.monotonic() - started)}, {progress["failed"]} entries failed')
 
 
 def run(args):
+    if args.batch:
+        try:
+            run_batch(args)
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print(f'An unexpected error occurred: {e}')
+        return
+
+    if not args.prompt:
+        print('Prompt is required')
+        return
+
     prompt = ' '.join(args.prompt)
 
     try:
         # img2img
         img_base64 = None
         if args.img:
-            img = Image.open(args.img).convert("RGB")
-            buffer = io.BytesIO()
-            img.save(buffer, format='PNG')
-            img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+            img_base64 = encode_image_file(args.img)
 
         payload = {
             'model': args.model,
@@ -82,9 +335,21 @@ def run(args):
             'stream': args.stream,
             'img': img_base64,
             'strength': args.strength,
-            'clip': args.clip
+            'clip': args.clip,
+            'count': args.count,
+            'preview': args.preview,
+            'memory': args.memory,
+            'cache_interval': args.cache_interval,
+            'tile': args.tile,
+            'tile_overlap': args.tile_overlap
         }
 
+        # high resolution fix, second pass runs on the server
+        hires = args.hires and not args.img
+        if hires:
+            payload['hires'] = args.hires
+            payload['hires_upscale'] = args.hires_upscale
+
         meta = {
             'meta': payload,
             'out': ''
@@ -92,39 +357,79 @@ def run(args):
 
         filename = args.output if args.output else f'{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.png'
 
-        result = send_generate_request(payload, args.address, args.stream, filename, meta, args.meta, prefix="Image saved")
-
-        # high resolution fix
-        if args.hires and not args.img:
-            meta['meta']['hires'] = args.hires
-
-            w = int(args.width * args.hires)
-            h = int(args.height * args.hires)
-
-            img_data = base64.b64decode(result['img'])
-            img = Image.open(io.BytesIO(img_data)).resize((w, h))
-
-            buffer = io.BytesIO()
-            img.save(buffer, format='PNG')
-            img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-            hires_payload = {
-                'model': args.model,
-                'prompt': prompt,
-                'width': w,
-                'height': h,
-                'steps': args.steps,
-                'guidance': args.guidance,
-                'sampler': args.sampler,
-                'seed': str(args.seed),
-                'neg': args.neg,
-                'stream': args.stream,
-                'img': img_base64,
-                'strength': 0.35,
-                'clip': args.clip
-            }
+        if hires and not args.tile:
+            # For hires.fix, final image is resized back to original dimensions
+            send_generate_request(payload, args.address, args.stream, filename, meta, args.meta, prefix="Image hires.fix saved", resize=(args.width, args.height))
+        else:
+            send_generate_request(payload, args.address, args.stream, filename, meta, args.meta, prefix="Image saved")
+
+    except requests.exceptions.ConnectionError as e:
+        print(f'Could not connect to the server. Is it running? Error: {e}')
+    except requests.exceptions.RequestException as e:
+        print(f'Request failed: {e}')
+    except Exception as e:
+        print(f'An unexpected error occurred: {e}')
 
-            send_generate_request(hires_payload, args.address, args.stream, filename, meta, args.meta, prefix="Image hires.fix saved", resize=(args.width, args.height))
+
+def grid(args):
+    prompt = ' '.join(args.prompt)
+
+    try:
+        payload = {
+            'model': args.model,
+            'prompt': prompt,
+            'width': args.width,
+            'height': args.height,
+            'neg': args.neg
+        }
+
+        # options with several values become axes, first one spans the columns of the contact sheet
+        axes = {}
+        for name in ['seed', 'guidance', 'steps', 'sampler', 'clip']:
+            values = imagine_grid.parse_values(name, getattr(args, name))
+            if len(values) > 1:
+                axes[name] = values
+            else:
+                payload[name] = str(values[0]) if name == 'seed' else values[0]
+
+        if not axes:
+            print('Nothing to sweep, give several values to at least one of --seed, --guidance, --steps, --sampler, --clip')
+            return
+
+        payload['axes'] = axes
+
+        filename = args.output if args.output else f'{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}_grid.png'
+        base_filename, ext = os.path.splitext(filename)
+
+        headers = {'Accept': imagine_frames.ACCEPT}
+        response = requests.post(IMAGINE_GRID_URL.format(address=args.address), json=payload, headers=headers, stream=True)
+        response.raise_for_status()
+
+        cells = 1
+        for values in axes.values():
+            cells *= len(values)
+
+        for result, img_data in read_results(response, True):
+            if 'error' in result:
+                print(f'Server error: {result["error"]}')
+                if 'details' in result:
+                    print(f'Details: {result["details"]}')
+                continue
+            if img_data is None:
+                continue
+
+            date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+            if result.get('status') == 'sheet':
+                imagine_png.write_file(filename, imagine_png.set_text(img_data, 'meta', json.dumps({**payload, 'date': date}, indent=2, ensure_ascii=False)))
+                print(f'Contact sheet saved: {filename}')
+            else:
+                # meta of a single cell, reproducible with `imagine run`
+                cell_meta = {key: value for key, value in payload.items() if key != 'axes'}
+                cell_meta.update({**result.get('cell', {}), 'seed': result.get('seed'), 'date': date})
+                cell_filename = f'{base_filename}_{result["index"]:03d}{ext}'
+                imagine_png.write_file(cell_filename, imagine_png.set_text(img_data, 'meta', json.dumps(cell_meta, indent=2, ensure_ascii=False)))
+                print(f'Cell saved [{result["index"] + 1}/{cells}]: {cell_filename}')
 
     except requests.exceptions.ConnectionError as e:
         print(f'Could not connect to the server. Is it running? Error: {e}')
@@ -139,12 +444,12 @@ def info(args):
         return
 
     try:
-        img = Image.open(args.img)
+        texts = imagine_png.read_text(args.img)
 
-        if 'meta' not in img.info:
+        if 'meta' not in texts:
             return
 
-        meta_json = img.info['meta']
+        meta_json = texts['meta']
         meta = json.loads(meta_json)
         print(json.dumps(meta, indent=2, ensure_ascii=False))
     except Exception as e:
@@ -172,48 +477,28 @@ def convert(args):
 
             # decode
             img_bytes = base64.b64decode(img_data_base64)
-            image = Image.open(io.BytesIO(img_bytes))
 
             # meta
-            png_info = PngInfo()
             meta_json_string = json.dumps(meta_data_for_png, indent=2, ensure_ascii=False)
-            png_info.add_text("meta", meta_json_string)
 
-            # save image
-            image.save(output_filename, pnginfo=png_info)
+            # save image with meta chunk, pixels stay as they are
+            imagine_png.write_file(output_filename, imagine_png.set_text(img_bytes, 'meta', meta_json_string))
 
             print(f'Image saved: {output_filename}')
 
         elif ext == '.png':
             output_filename = base_filename + '.json'
 
-            # open image
-            image = Image.open(args.filename)
-
             # extract meta
-            meta_json_string_from_png = image.info.get("meta")
+            meta_json_string_from_png = imagine_png.read_text(args.filename).get("meta")
             meta_data_for_json = {}
             if meta_json_string_from_png:
                 meta_data_for_json = json.loads(meta_json_string_from_png)
             else:
                 print(f"Warning: No 'meta' data found in {args.filename}. Output JSON 'meta' field will be empty.")
 
-            # encode image
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_bytes = img_byte_arr.getvalue()
-
-            img_base64_encoded = base64.b64encode(img_bytes).decode('utf-8')
-
-            # final json
-            output_json_data = {
-                "meta": meta_data_for_json,
-                "out": img_base64_encoded
-            }
-
-            # save
-            with open(output_filename, 'w', encoding='utf-8') as f:
-                json.dump(output_json_data, f, indent=2, ensure_ascii=False)
+            # save, image without its meta chunk streamed as base64
+            save_meta_json(output_filename, meta_data_for_json, imagine_png.copy_chunks(args.filename, "meta"))
 
             print(f'JSON saved: {output_filename}')
 
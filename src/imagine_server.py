@@ -1,13 +1,30 @@
 import os
 import io
 import json
+import time
 import queue
+import concurrent.futures
 import torch
 import base64
 import random
+import tempfile
+import hashlib
 import threading
+import collections
 import diffusers
 
+import imagine_grid
+import imagine_catalog
+import imagine_deepcache
+import imagine_metrics
+import imagine_jobs
+import imagine_embeds
+import imagine_frames
+import imagine_pipes
+import imagine_preview
+import imagine_results
+import imagine_store
+import imagine_tiled
 import imagine_server_defs
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
@@ -23,6 +40,21 @@ os.environ['HF_HUB_OFFLINE'] = '1'
 fp_prec = DEFAULT_FP_PREC
 dev = imagine_server_defs.DEFAULT_DEVICE
 models_path = imagine_server_defs.DEFAULT_MODELS_PATH
+pipe_cache = imagine_pipes.PipelineCache()
+embed_cache = imagine_embeds.EmbeddingCache()
+result_cache = imagine_results.ResultCache(max_size=0)
+inflight = {} # (result keys, cache flag) -> queued or running job, identical requests attach to it
+inflight_lock = threading.Lock()
+ready = threading.Event() # set once preloading and warmup are done
+scheduler = None
+catalog = None
+workers = [] # worker processes with --workers, generations run in process otherwise
+metrics = imagine_metrics.Metrics()
+preview_mode = imagine_server_defs.DEFAULT_PREVIEW
+memory_mode = imagine_server_defs.DEFAULT_MEMORY
+quant_mode = imagine_server_defs.DEFAULT_QUANT
+cache_interval = imagine_server_defs.DEFAULT_CACHE_INTERVAL
+tile_batch = imagine_server_defs.DEFAULT_TILE_BATCH
 
 SAMPLERS = {
     'ddim': diffusers.DDIMScheduler,
@@ -37,65 +69,356 @@ SAMPLERS = {
     'dpm2 a': diffusers.KDPM2AncestralDiscreteScheduler
 }
 
-def run_pipe(prompt, width, height, steps, guidance, strength, clip_skip, neg_prompt, img, gen, stream, pipe, cb_queue, res_queue, stop_event):
-    # sample callback
+def run_pipe(jobs, pipe, imgs, gens, embeds, taesd=None, hires_pipe=None, memory='none', base_pipe=None):
+    # jobs share every parameter except prompt, negative prompt, input image and seeds,
+    # `base_pipe` is the resident pipeline `pipe` is derived from, it holds the offload hooks,
+    # `imgs` and `gens` hold one entry per generated image in job order,
+    # `embeds` one (prompt_embeds, negative_prompt_embeds) pair per job
+    params = jobs[0].params
+    single = len(jobs) == 1
+    seeds = ', '.join(str(gen.initial_seed()) for gen in gens)
+
+    # (job, index within job) for every generated image
+    items = [(job, index) for job in jobs for index in range(len(job.params['seeds']))]
+
+    # preview decoding happens here, compression on the preview executor
+    preview_size = min(params['preview_size'], params['width'], params['height'])
+    previewer = imagine_preview.Previewer(params['preview'], pipe, preview_size, taesd)
+    previews = []
+
+    # step durations, previews decoded on the denoising thread are timed separately
+    step_times = []
+    clock = {'last': None, 'steps': 0, 'preview': 0.0}
+
+    # sample callback, also runs every step without streaming so cancellation reaches the pipeline
     def sample_cb(iter, t, latents):
-        # Check if the stop_event is set; if so, signal diffusers to stop
-        if stop_event.is_set():
-            print(f"Generation (seed {gen.initial_seed()}) cancelled due to client disconnect signal.")
+        # Check if every job is cancelled; if so, signal diffusers to stop
+        if all(job.cancelled() for job in jobs):
+            print(f"Generation (seed {seeds}) cancelled due to client disconnect signal.")
             raise Exception('Generation was cancelled by client.')
 
-        with torch.no_grad():
-            sample = pipe.decode_latents(latents)
-            image = pipe.numpy_to_pil(sample)
-
-            buffer = io.BytesIO()
-            image[0].save(buffer, format='PNG')
-            img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        # steps since the previous callback share its duration
+        imagine_pipes.synchronize(dev)
+        now = time.monotonic()
+        steps = iter + 1 - clock['steps']
+        if steps > 0:
+            step_times.extend([(now - clock['last']) / steps] * steps)
+            clock['steps'] = iter + 1
+            clock['last'] = now
+
+        if not params['stream']:
+            return
+
+        images = previewer.decode(latents)
+
+        for (job, index), image in zip(items, images):
+            if job.cancelled():
+                continue
+
+            previews.append(imagine_preview.executor.submit(previewer.publish, image, job, index))
+
+        elapsed = time.monotonic() - now
+        clock['preview'] += elapsed
+        clock['last'] += elapsed
+
+    def start_pass():
+        clock['last'] = time.monotonic()
+        clock['steps'] = 0
+        clock['preview'] = 0.0
+        return clock['last']
+
+    # single job repeats its embeddings for all its images, a batch of jobs takes per image embeddings
+    if single:
+        prompt_embeds, neg_prompt_embeds = embeds[0]
+        img = imgs[0] if imgs else None
+        images_per_prompt = len(gens)
+    else:
+        counts = [len(job.params['seeds']) for job in jobs]
+        prompt_embeds = torch.cat([e.repeat(count, 1, 1) for (e, _), count in zip(embeds, counts)])
+        neg_prompt_embeds = torch.cat([n.repeat(count, 1, 1) for (_, n), count in zip(embeds, counts)])
+        img = imgs
+        images_per_prompt = 1
 
-            cb_queue.put(img_base64)
+    # pipeline returns latents and decoding is timed on its own
+    hires = hires_pipe is not None
 
     try:
-        res = pipe(
-            prompt=prompt,
-            width=width,
-            height=height,
-            num_inference_steps=steps,
-            guidance_scale=guidance,
-            strength=strength,
-            clip_skip=max(clip_skip - 1, 0),
-            negative_prompt=neg_prompt,
-            image=img,
-            generator=gen,
-            callback = sample_cb if stream else None,
-            callback_steps=stream,
-        ).images[0]
-
-        # Only put the result if generation was NOT cancelled by the stop_event
-        if not stop_event.is_set():
-            res_queue.put(res)
-        else:
-            # If cancelled, put a specific signal or exception to distinguish from actual errors
-            res_queue.put(Exception("Generation cancelled by client."))
+        started = start_pass()
+        with imagine_tiled.tiled_unet(pipe, params['tile'], params['tile_overlap'], tile_batch) as tiled, imagine_deepcache.feature_cache(getattr(pipe, 'unet', None), params['cache_interval']) as feature_cache:
+            res = pipe(
+                prompt_embeds=prompt_embeds,
+                width=params['width'],
+                height=params['height'],
+                num_inference_steps=params['steps'],
+                guidance_scale=params['guidance'],
+                strength=params['strength'],
+                negative_prompt_embeds=neg_prompt_embeds,
+                num_images_per_prompt=images_per_prompt,
+                image=img,
+                generator=gens[0] if len(gens) == 1 else gens,
+                callback = sample_cb,
+                callback_steps=params['stream'] or 1,
+                output_type='latent',
+            ).images
+        imagine_pipes.synchronize(dev)
+        if feature_cache is not None:
+            print(f'Feature cache: {feature_cache.full_calls} of {feature_cache.calls} UNet calls full for seed {seeds}')
+        if tiled is not None and tiled.calls:
+            print(f'Tiled denoising: {tiled.tiles // tiled.calls} tiles per UNet call, {tile_batch} per batch for seed {seeds}')
+        record_stage(jobs, 'denoise', time.monotonic() - started - clock['preview'])
+        preview_time = clock['preview']
+        decode_time = 0.0
+
+        if hires:
+            # second pass at upscaled size on the same weights, same seeds as the first one
+            width = int(params['width'] * params['hires']) // 8 * 8
+            height = int(params['height'] * params['hires']) // 8 * 8
+
+            # hires.fix keeps first pass latents on the device when upscaling them directly
+            if params['hires_upscale'] == 'latent':
+                upscaled = torch.nn.functional.interpolate(res, size=(height // 8, width // 8), mode='bilinear')
+            else:
+                started = time.monotonic()
+                res = imagine_pipes.decode_images(pipe, res)
+                decode_time += time.monotonic() - started
+
+                upscaled = [image.resize((width, height)) for image in res]
+
+                # first pass result is the first sample of the stream
+                if params['stream']:
+                    for (job, index), image in zip(items, res):
+                        if not job.cancelled():
+                            previews.append(imagine_preview.executor.submit(previewer.publish, image, job, index))
+
+            for gen in gens:
+                gen.manual_seed(gen.initial_seed())
+
+            print(f'Hires.fix {params["hires"]}x ({params["hires_upscale"]}) to {width}x{height} for seed {seeds}')
+            started = start_pass()
+            with imagine_tiled.tiled_unet(hires_pipe, params['tile'], params['tile_overlap'], tile_batch) as tiled, imagine_deepcache.feature_cache(getattr(hires_pipe, 'unet', None), params['cache_interval']):
+                res = hires_pipe(
+                    prompt_embeds=prompt_embeds,
+                    num_inference_steps=params['hires_steps'],
+                    guidance_scale=params['guidance'],
+                    strength=params['hires_strength'],
+                    negative_prompt_embeds=neg_prompt_embeds,
+                    num_images_per_prompt=images_per_prompt,
+                    image=upscaled,
+                    generator=gens[0] if len(gens) == 1 else gens,
+                    callback = sample_cb,
+                    callback_steps=params['stream'] or 1,
+                    output_type='latent',
+                ).images
+            imagine_pipes.synchronize(dev)
+            if tiled is not None and tiled.calls:
+                print(f'Tiled denoising: {tiled.tiles // tiled.calls} tiles per UNet call, {tile_batch} per batch for seed {seeds}')
+            record_stage(jobs, 'hires', time.monotonic() - started - clock['preview'])
+            preview_time += clock['preview']
+
+        for step_time in step_times:
+            metrics.observe('step', step_time)
+        for job in jobs:
+            job.add_timing('steps', step_times)
+        if params['stream']:
+            record_stage(jobs, 'preview', preview_time)
+
+        started = time.monotonic()
+        res = imagine_pipes.decode_images(pipe, res)
+        record_stage(jobs, 'decode', decode_time + time.monotonic() - started)
+
+        # encode once for every request attached to the jobs and for the result cache
+        started = time.monotonic()
+        pngs = [encode_png(image) for image in res]
+        record_stage(jobs, 'png', time.monotonic() - started)
+        metrics.count_images(len(pngs))
+
+        peak = imagine_pipes.peak_memory(dev)
+        print(f"Memory: {memory} mode, peak {peak / 1024**2:.0f} MiB" if peak is not None else f"Memory: {memory} mode")
+        for job in jobs:
+            job.set_memory({'mode': memory, 'peak': peak})
+
+        start = 0
+        for job in jobs:
+            count = len(job.params['seeds'])
+
+            if job.params['cache']:
+                for key, png in zip(job.params['keys'], pngs[start:start + count]):
+                    result_cache.put(key, png)
+
+            # Only put the result if generation was NOT cancelled
+            if not job.cancelled():
+                job.put_result(pngs[start:start + count])
+            else:
+                # If cancelled, put a specific signal or exception to distinguish from actual errors
+                job.put_result(Exception("Generation cancelled by client."))
+            start += count
 
     except Exception as e:
-        # Catch any errors during generation and pass them to the main thread
-        res_queue.put(e)
+        # Catch any errors during generation and pass them to the waiting requests
+        for job in jobs:
+            job.put_result(e)
     finally:
         # Signal that callback stream is finished, or that the process is ending
-        cb_queue.put(None)
+        concurrent.futures.wait(previews)
+        for job in jobs:
+            job.put_sample(None)
 
-        # Cleanup model from memory
-        pipe.maybe_free_model_hooks()
+        # Cleanup model from memory, derived pipes share the components but not the offload hooks
+        (base_pipe or pipe).maybe_free_model_hooks()
 
-        print(f'Pipe cleared for seed {gen.initial_seed()}.')
+        print(f'Pipe cleared for seed {seeds}.')
 
-        if dev == 'cuda':
+        if dev.startswith('cuda'):
             torch.cuda.empty_cache()
-            print(f"CUDA cache cleared for seed {gen.initial_seed()}.")
-
-
-def generate_image_logic(data):
+            print(f"CUDA cache cleared for seed {seeds}.")
+
+
+def record_stage(jobs, stage, seconds):
+    # observe stage duration once and report it to every request of `jobs`
+    metrics.observe(stage, seconds)
+    for job in jobs:
+        job.add_timing(stage, seconds)
+
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def result_keys(params):
+    # one cache key per image, generation is deterministic given these fields
+    model_stat = os.stat(params['model_path'])
+    img = params['img']
+
+    fields = {
+        'model': os.path.realpath(params['model_path']),
+        'model_size': model_stat.st_size,
+        'model_mtime': model_stat.st_mtime_ns,
+        'hires': params['hires'],
+        'hires_upscale': params['hires_upscale'],
+        'hires_strength': params['hires_strength'],
+        'hires_steps': params['hires_steps'],
+        'prompt': params['prompt'],
+        'neg': params['neg'],
+        'sampler': params['sampler'],
+        'width': int(params['width']),
+        'height': int(params['height']),
+        'steps': int(params['steps']),
+        'guidance': float(params['guidance']),
+        'strength': float(params['strength']) if img else None,
+        'clip': int(params['clip']),
+        'img': hashlib.sha256(img.encode('utf-8')).hexdigest() if img else None,
+        'precision': str(fp_prec),
+        'device': dev,
+        # VAE tiling, channels_last and sliced attention change pixels, explicit memory modes get their own keys,
+        # `auto` accepts whichever mode free memory allows, so any result of an `auto` request answers it
+        'memory': params['memory']
+    }
+
+    # quantized weights, reused UNet features and tiled denoising generate different images, other keys stay as they were
+    if quant_mode != 'none':
+        fields['quant'] = quant_mode
+    if params['cache_interval'] > 1:
+        fields['cache_interval'] = params['cache_interval']
+    if params['tile']:
+        fields['tile'] = params['tile']
+        fields['tile_overlap'] = params['tile_overlap']
+
+    return [imagine_results.result_key({**fields, 'seed': seed}) for seed in params['seeds']]
+
+
+def batch_key(params):
+    # requests with equal keys can be denoised together in one pipeline call
+    return (
+        params['model_path'], params['width'], params['height'], params['steps'], params['guidance'],
+        params['sampler'], params['strength'], params['clip'], params['stream'], params['img'] is not None,
+        params['preview'], params['preview_size'], params['hires'], params['hires_upscale'], params['hires_strength'],
+        params['hires_steps'], params['memory'], params['cache_interval'], params['tile'], params['tile_overlap']
+    )
+
+
+def execute_jobs(jobs, device):
+    # runs on the scheduler worker of `device`, all jobs share the same `batch_key`
+    params = jobs[0].params
+    input_imgs = None
+
+    for job in jobs:
+        metrics.observe('queue', job.started - job.submitted)
+
+    if params['img']:
+        # img2img
+        input_imgs = []
+        for job in jobs:
+            img_data = base64.b64decode(job.params['img'])
+            img = Image.open(io.BytesIO(img_data)).convert("RGB").resize((params['width'], params['height']))
+            input_imgs.extend([img] * len(job.params['seeds']))
+
+    # txt2img and img2img share resident weights, only the scheduler is per request
+    started = time.monotonic()
+    base_pipe = pipe_cache.get(params['model_path'], device, fp_prec)
+
+    # offload, slicing and tiling by final size and free memory unless requested, switched on the shared weights
+    memory = params['memory']
+    if memory == 'auto':
+        scale = params['hires'] or 1
+        width, height = int(params['width'] * scale), int(params['height'] * scale)
+        count = sum(len(job.params['seeds']) for job in jobs)
+
+        # tiled denoising runs the UNet on batches of tiles, the full size image still needs a tiled VAE
+        tiled = params['tile'] and max(width, height) > params['tile']
+        if tiled:
+            count *= tile_batch
+            width, height = min(width, params['tile']), min(height, params['tile'])
+
+        memory = imagine_pipes.choose_memory_mode(base_pipe, device, width, height, count, fp_prec, pipe_cache.mem_reserve)
+        if tiled and memory == 'none':
+            memory = 'tiled'
+    imagine_pipes.set_memory_mode(base_pipe, memory, device)
+    pipe = imagine_pipes.derive_pipe(base_pipe, input_imgs is not None, SAMPLERS[params['sampler']], fp_prec)
+
+    # hires.fix second pass is img2img on the same resident weights
+    hires_pipe = None
+    if params['hires']:
+        hires_pipe = imagine_pipes.derive_pipe(base_pipe, True, SAMPLERS[params['sampler']], fp_prec)
+    record_stage(jobs, 'load', time.monotonic() - started)
+
+    # text encoder runs only for prompts not seen before with this model and clip skip
+    model_key = pipe_cache.key(params['model_path'], device, fp_prec)
+    clip_skip = max(params['clip'] - 1, 0)
+    embeds = []
+    for job in jobs:
+        started = time.monotonic()
+        embeds.append(embed_cache.encode(pipe, model_key, job.params['prompt'], job.params['neg'], clip_skip))
+        imagine_pipes.synchronize(device)
+        record_stage([job], 'encode', time.monotonic() - started)
+
+    stats = embed_cache.stats()
+    print(f"Prompt embeddings: {stats['entries']} cached ({stats['size'] / 1024**2:.1f} MiB), {stats['hits']} hits, {stats['misses']} misses")
+
+    # init generators, one per image so every image matches its unbatched result
+    gens = [torch.Generator(device).manual_seed(seed) for job in jobs for seed in job.params['seeds']]
+
+    # tiny autoencoder for streamed previews
+    taesd = None
+    if params['stream'] and params['preview'] == 'taesd':
+        taesd = imagine_preview.load_taesd(models_path, device, fp_prec)
+
+    print(f'Generating {len(gens)} image(s) (seed {", ".join(str(gen.initial_seed()) for gen in gens)}) on {device}')
+    imagine_pipes.reset_peak_memory(device)
+    run_pipe(jobs, pipe, input_imgs, gens, embeds, taesd, hires_pipe, memory, base_pipe)
+
+
+def find_model(model_name):
+    # diffusers model directory or single-file checkpoint in models path
+    model_path = os.path.join(os.path.expanduser(models_path), model_name)
+    if os.path.isfile(os.path.join(model_path, imagine_catalog.PRETRAINED_INDEX)):
+        return model_path
+    return f'{model_path}.safetensors'
+
+
+def build_job(data):
+    # validated job of a /generate payload, not queued yet
     # get prompt
     prompt = data.get('prompt')
     if not prompt:
@@ -106,7 +429,9 @@ def generate_image_logic(data):
     if not model_name:
         raise ValueError('Models is required')
 
-    model_path = os.path.join(os.path.expanduser(models_path), f'{model_name}.safetensors')
+    model_path = find_model(model_name)
+    if not os.path.exists(model_path):
+        raise ValueError(f"Model '{model_name}' not found")
 
     # get parameters
     width = data.get('width', 512)
@@ -120,6 +445,22 @@ def generate_image_logic(data):
     img_b64 = data.get('img', None)
     strength = data.get('strength', 0.8)
     clip_skip = data.get('clip', 1)
+    priority = int(data.get('priority', 0))
+    count = int(data.get('count', data.get('batch_size', 1)))
+    seeds = data.get('seeds', None)
+    preview = data.get('preview') or preview_mode
+    preview_size = data.get('preview_size')
+    preview_size = imagine_server_defs.DEFAULT_PREVIEW_SIZE if preview_size is None else preview_size
+    hires = data.get('hires', None)
+    hires_upscale = data.get('hires_upscale') or imagine_server_defs.DEFAULT_HIRES_UPSCALE
+    hires_strength = data.get('hires_strength', imagine_server_defs.DEFAULT_HIRES_STRENGTH)
+    hires_steps = data.get('hires_steps', None)
+    memory = data.get('memory') or memory_mode
+    feature_interval = int(data.get('cache_interval') or cache_interval)
+    tile = int(data.get('tile') or 0)
+    tile_overlap = data.get('tile_overlap')
+    tile_overlap = int(tile_overlap if tile_overlap is not None else imagine_server_defs.DEFAULT_TILE_OVERLAP)
+    use_cache = bool(data.get('cache', True))
 
     seed = int(seed_str)
 
@@ -127,137 +468,502 @@ def generate_image_logic(data):
     if sampler not in SAMPLERS:
         raise ValueError(f"Invalid sampler '{sampler}'. Available samplers: {list(SAMPLERS.keys())}")
 
-    # load model
-    pipe = None
-    input_img = None
+    # check preview mode and size
+    if preview not in imagine_preview.PREVIEW_MODES:
+        raise ValueError(f"Invalid preview '{preview}'. Available previews: {imagine_preview.PREVIEW_MODES}")
+    try:
+        preview_size = int(preview_size)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid preview size {preview_size!r}, expected a number of pixels")
+    if preview_size < 1:
+        raise ValueError(f"Invalid preview size {preview_size}, expected a number of pixels")
+
+    # check memory mode, offloading needs a device besides cpu memory
+    if memory not in imagine_server_defs.MEMORY_MODES:
+        raise ValueError(f"Invalid memory mode '{memory}'. Available modes: {imagine_server_defs.MEMORY_MODES}")
+    if memory in imagine_pipes.OFFLOAD_MODES and not dev.startswith('cuda'):
+        raise ValueError(f"Memory mode '{memory}' needs a CUDA device")
+
+    # check feature cache, every n-th UNet call runs in full
+    if feature_interval < 1:
+        raise ValueError(f"Invalid cache interval {feature_interval}, expected 1 (off) or more")
+
+    # check tiled denoising, tiles are whole latent pixels and overlap less than a tile
+    if tile:
+        if tile < imagine_server_defs.MIN_TILE or tile % 8 or tile_overlap % 8:
+            raise ValueError(f"Invalid tile {tile} (overlap {tile_overlap}), expected multiples of 8 and tile of at least {imagine_server_defs.MIN_TILE}")
+        if not 0 <= tile_overlap < tile:
+            raise ValueError(f"Invalid tile overlap {tile_overlap}, expected 0 to {tile - 8}")
+
+        # deep features of one tile don't fit the next one
+        feature_interval = 1
+    else:
+        tile_overlap = None
+
+    # check hires.fix, upscaled second pass of txt2img
+    if hires:
+        hires = float(hires)
+        if hires <= 1:
+            raise ValueError(f"Invalid hires scale {hires}, expected value above 1")
+        if img_b64:
+            raise ValueError("Hires.fix is only supported for txt2img")
+        if hires_upscale not in imagine_server_defs.HIRES_UPSCALERS:
+            raise ValueError(f"Invalid hires upscale '{hires_upscale}'. Available upscales: {imagine_server_defs.HIRES_UPSCALERS}")
+
+        hires_strength = float(hires_strength)
+        hires_steps = int(hires_steps or steps)
+    else:
+        hires = hires_upscale = hires_strength = hires_steps = None
 
-    print(f"Loading model: {model_path} for device {dev}, precision {fp_prec}")
-    if img_b64:
-        # img2img
-        pipe = diffusers.StableDiffusionImg2ImgPipeline.from_single_file(model_path, torch_dtype=fp_prec)
-        img_data = base64.b64decode(img_b64)
-        input_img = Image.open(io.BytesIO(img_data)).convert("RGB").resize((width, height))
+    # explicit seeds or consecutive ones starting at `seed`
+    if seeds:
+        seeds = [int(s) for s in seeds]
+        seed = seeds[0]
     else:
-        # txt2img
-        pipe = diffusers.StableDiffusionPipeline.from_single_file(model_path, torch_dtype=fp_prec)
+        seeds = [(seed + i) % 2**64 for i in range(count)]
+
+    if not 1 <= len(seeds) <= imagine_server_defs.MAX_COUNT:
+        raise ValueError(f"Invalid count {len(seeds)}, expected 1 to {imagine_server_defs.MAX_COUNT} images per request")
+
+    params = {
+        'model': model_name,
+        'model_path': model_path,
+        'prompt': prompt,
+        'neg': neg_prompt,
+        'seed': seed,
+        'seeds': seeds,
+        'sampler': sampler,
+        'width': width,
+        'height': height,
+        'steps': steps,
+        'guidance': guidance,
+        'stream': stream,
+        'img': img_b64,
+        'strength': strength,
+        'clip': clip_skip,
+        'preview': preview,
+        'preview_size': preview_size,
+        'hires': hires,
+        'hires_upscale': hires_upscale,
+        'hires_strength': hires_strength,
+        'hires_steps': hires_steps,
+        'memory': memory,
+        'cache_interval': feature_interval,
+        'tile': tile,
+        'tile_overlap': tile_overlap,
+        'cache': use_cache
+    }
+    params['keys'] = result_keys(params)
+
+    return imagine_jobs.Job(params, priority, len(seeds))
+
+
+def submit_job(data):
+    # answer from result cache, attach to an identical job or queue a new one
+    job = build_job(data)
+    params = job.params
+    img_b64 = params['img']
+    use_cache = params['cache']
+
+    request_log_data = {**params, 'img': f'{img_b64[:32]}...' if img_b64 else None, 'priority': job.priority}
+    del request_log_data['model_path']
+    del request_log_data['keys']
+
+    # identical request generated before, answer from result cache
+    started = time.monotonic()
+    cached = [result_cache.get(key) for key in params['keys']] if use_cache else [None]
+    if all(png is not None for png in cached):
+        record_stage([job], 'cache', time.monotonic() - started)
+        metrics.count_request('cached')
+        job.put_sample(None)
+        job.put_result(cached)
+        job.finish()
+        print(f'Cached image: {json.dumps(request_log_data)}')
+        return job
+
+    with inflight_lock:
+        for key, pending_job in list(inflight.items()):
+            if pending_job.done.is_set():
+                del inflight[key]
+
+        # identical request is queued or running, share its results instead of generating twice,
+        # only a leader with the same cache flag stores the results a follower expects to be cached
+        inflight_key = (tuple(params['keys']), params['cache'])
+        leader = inflight.get(inflight_key)
+        if leader is not None and leader.attach(job):
+            metrics.count_request('attached')
+            print(f'Attached image: {json.dumps(request_log_data)}')
+            return job
+
+        # enqueue, raises QueueFullError when there is no room left
+        try:
+            scheduler.submit(job)
+        except imagine_jobs.QueueFullError:
+            metrics.count_request('rejected')
+            raise
+        inflight[inflight_key] = job
+        metrics.count_request('queued')
+
+    print(f'Queued image: {json.dumps({**request_log_data, "position": job.position})}')
+
+    return job
 
-    pipe.unet.set_attn_processor(diffusers.models.attention_processor.AttnProcessor2_0())
-    pipe.scheduler = SAMPLERS[sampler].from_config(pipe.scheduler.config)
-    pipe.safety_checker = lambda images, clip_input: (images, None) # Disable safety checker
-    pipe.to(dev, fp_prec)
 
-    pipe.unet.to(fp_prec)
-    pipe.vae.to(fp_prec)
-    pipe.text_encoder.to(fp_prec)
+def generate_image_logic(data):
+    # returns a generator of response records
+    job = submit_job(data)
+    return job_results(job)
+
 
-    # init generator
-    gen = torch.Generator(dev).manual_seed(seed)
+def job_timings(job):
+    # stage timings (s) of a finished request, queue and total measured from its own submission
+    timings = dict(job.timings)
 
-    # Setup communication for generation thread
-    cb_queue = queue.Queue() # Queue for intermediate callbacks from run_pipe
-    res_queue = queue.Queue() # Queue for final result or error from run_pipe
-    stop_event = threading.Event() # Event to signal run_pipe to stop early
+    started = (job.leader or job).started
+    if started is not None:
+        timings['queue'] = max(started - job.submitted, 0.0)
 
-    # Start generation in a separate thread
-    proc = threading.Thread(target=run_pipe, args=(
-        prompt, width, height, steps, guidance, strength, clip_skip, neg_prompt,
-        input_img, gen, stream, pipe, cb_queue, res_queue, stop_event
-    ))
-    proc.start()
+    timings['total'] = time.monotonic() - job.submitted
+    metrics.observe('total', timings['total'])
+
+    return {stage: [round(value, 4) for value in values] if stage == 'steps' else round(values, 4) for stage, values in timings.items()}
+
+
+def final_records(job, images):
+    # one final record per image
+    seeds = job.params['seeds']
+
+    timings = job_timings(job)
+    print(f'Timings: {json.dumps({"seed": str(job.params["seed"]), "count": len(images), **timings})}')
+
+    for index, png in enumerate(images):
+        # png bytes, base64 only if the client wants JSON
+        print("Image generated and encoded successfully.")
+        record = {"img": png, "seed": str(seeds[index]), "index": index, "format": "png", "status": "final", "timings": timings}
+
+        # memory mode and peak use of the generation, cached results have none
+        if job.memory is not None:
+            record["memory"] = job.memory
+        yield record
+
+
+def job_results(job):
+    seed = job.params['seed']
+    seeds = job.params['seeds']
+    stream = job.params['stream']
 
     try:
-        request_log_data = {
-            'model': model_name,
-            'prompt': prompt,
-            'neg': neg_prompt,
-            'seed': seed,
-            'sampler': sampler,
-            'width': width,
-            'height': height,
-            'steps': steps,
-            'guidance': guidance,
-            'stream': stream,
-            'img': f'{img_b64[:32]}...' if img_b64 else None,
-            'strength': strength,
-            'clip': clip_skip
-        }
-        print(f'Generating image: {json.dumps(request_log_data)}')
-
-        # Send samples if streaming is enabled
+        # Send queue position and samples if streaming is enabled
         if stream:
+            position = None
             while True:
                 # Use a small timeout to allow the generator to be closed from outside,
                 # ensuring GeneratorExit can be handled in the outer try block.
                 try:
-                    img = cb_queue.get(timeout=0.1) # Blocks for max 0.1s
-                    if img is None: # Signal from run_pipe that no more callbacks will come
+                    sample = job.cb_queue.get(timeout=0.1) # Blocks for max 0.1s
+                    if sample is None: # Signal from run_pipe that no more callbacks will come
                         break
-                    # Yield JSON string with newline for stream processing
-                    yield json.dumps({"img": img, "seed": str(seed), "status": "intermediate"}) + '\n'
+                    index, img, fmt = sample
+                    # Yield record for stream processing
+                    yield {"img": img, "seed": str(seeds[index]), "index": index, "format": fmt, "status": "intermediate"}
                 except queue.Empty:
-                    # If queue is empty, check if the worker thread is still alive and not just waiting for data.
-                    # This helps prevent infinite loops if the worker died without signaling None.
-                    if not proc.is_alive() and cb_queue.empty() and res_queue.empty():
-                        print(f"Warning: Generation thread for seed {seed} ended prematurely or without final signal.")
-                        break # Exit loop if worker thread is gone and no more data expected
+                    # Report queue position while the job waits for a worker
+                    if job.position is not None and job.position != position:
+                        position = job.position
+                        yield {"seed": str(seed), "status": "queued", "position": position}
+
+                    # If queue is empty, check if the worker is done with the job and not just waiting for data.
+                    # This helps prevent infinite loops if the job ended without signaling None.
+                    if job.done.is_set() and job.cb_queue.empty() and job.res_queue.empty():
+                        print(f"Warning: Generation job for seed {seed} ended prematurely or without final signal.")
+                        break # Exit loop if job is gone and no more data expected
                     continue # Keep trying to get from queue
 
         # Wait for final output (only if generation was not cancelled externally via GeneratorExit)
         # This part will be reached if streaming finishes naturally or if not streaming.
         # If GeneratorExit was raised, this block won't be entered directly from `yield` loop.
         # Check stop_event here, in case client disconnected without streaming, or at the very end.
-        if not stop_event.is_set():
-            final_result = res_queue.get() # Blocking wait for final result
+        if not job.stop_event.is_set():
+            final_result = job.res_queue.get() # Blocking wait for final result
             if isinstance(final_result, Exception):
                 raise final_result # Re-raise error from run_pipe or cancellation signal
 
-            final_image = final_result
-
-            # image to base64
-            buffer = io.BytesIO()
-            final_image.save(buffer, format='PNG')
-            img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-            print("Image generated and encoded successfully.")
-            # Yield the final result
-            yield json.dumps({"img": img_base64, "seed": str(seed), "status": "final"}) + '\n'
+            # Yield the final results
+            yield from final_records(job, final_result)
 
     except GeneratorExit:
         # This exception is raised by the caller (.close() on generator) when the client disconnects.
-        print(f"Generator for seed {seed} detected client disconnect. Signaling generation thread to stop.")
-        stop_event.set()
+        print(f"Generator for seed {seed} detected client disconnect. Signaling generation job to stop.")
+        scheduler.cancel(job)
     except Exception as e:
         # Catch any other exceptions during the logic of this generator
         print(f"Error in generate_image_logic for seed {seed}: {e}")
-        stop_event.set() 
+        scheduler.cancel(job)
         raise
 
+
+class Grid:
+    """
+    Parameter sweep over `axes` of a /generate payload.
+
+    Cells differing only in seed share one job, so every job denoises several images on
+    the resident model with one prompt encoding, and jobs of a sweep only differ in
+    scheduler, guidance or steps. Jobs are queued as long as the scheduler has room and
+    the rest follow as earlier ones finish.
+    """
+    def __init__(self, data):
+        axes = data.get('axes')
+        if not isinstance(axes, dict) or not axes:
+            raise ValueError("Grid axes are required")
+
+        self.axes = {}
+        for name, values in axes.items():
+            if name not in imagine_grid.GRID_AXES:
+                raise ValueError(f"Invalid grid axis '{name}'. Available axes: {list(imagine_grid.GRID_AXES.keys())}")
+            self.axes[name] = imagine_grid.axis_values(name, values)
+
+        self.cells = imagine_grid.grid_cells(self.axes)
+        if len(self.cells) > imagine_grid.MAX_GRID_CELLS:
+            raise ValueError(f"Grid has {len(self.cells)} cells, at most {imagine_grid.MAX_GRID_CELLS} are allowed")
+
+        # one seed for every cell without seed axis, so cells compare the same noise
+        base = {key: value for key, value in data.items() if key not in ('axes', 'stream', 'count', 'seeds', 'hires')}
+        base_seed = int(base.get('seed', random.randint(0, 2**64 - 1)))
+
+        groups = collections.OrderedDict() # non-seed cell values -> [(cell index, seed)]
+        for index, cell in enumerate(self.cells):
+            params = tuple((name, value) for name, value in cell.items() if name != 'seed')
+            groups.setdefault(params, []).append((index, cell.get('seed', base_seed)))
+
+        self.pending = collections.deque() # (payload, cell indices) not submitted yet
+        for params, group in groups.items():
+            for start in range(0, len(group), imagine_server_defs.MAX_COUNT):
+                chunk = group[start:start + imagine_server_defs.MAX_COUNT]
+                self.pending.append(({**base, **dict(params), 'seeds': [seed for _, seed in chunk]}, [index for index, _ in chunk]))
+
+        self.jobs = collections.deque() # (job, cell indices) submitted
+        self.cancelled = False
+
+        print(f'Grid: {len(self.cells)} cells over {list(self.axes.keys())} in {len(self.pending)} jobs')
+        self.fill()
+
+    def fill(self):
+        # submit pending jobs while the queue has room, raises QueueFullError only if none of ours is queued
+        while self.pending and not self.cancelled:
+            data, cells = self.pending[0]
+            try:
+                job = submit_job(data)
+            except imagine_jobs.QueueFullError:
+                if self.jobs:
+                    return
+                raise
+            except Exception:
+                self.cancel()
+                raise
+
+            self.pending.popleft()
+            self.jobs.append((job, cells))
+
+    def cancel(self):
+        self.cancelled = True
+        self.pending.clear()
+        for job, _ in self.jobs:
+            scheduler.cancel(job)
+
+    def wait_result(self, job):
+        # final result of `job`, polling so cancellation of a queued job is noticed
+        while True:
+            try:
+                return job.res_queue.get(timeout=0.1)
+            except queue.Empty:
+                if job.done.is_set() and job.res_queue.empty():
+                    return Exception('Grid was cancelled.')
+
+    def cell_records(self, job, cells, result, images):
+        # final records of the cells of a finished job, their images are kept in `images` for the contact sheet
+        for index, png in zip(cells, result):
+            images[index] = Image.open(io.BytesIO(png))
+            yield {"img": png, "seed": str(self.cells[index].get('seed', job.params['seed'])), "index": index, "cell": self.cells[index], "format": "png", "status": "final"}
+
+    def sheet_record(self, images):
+        print(f'Grid finished, stitching {len(self.cells)} cells.')
+        sheet = imagine_grid.contact_sheet(images, self.cells, self.axes)
+        return {"img": sheet, "index": len(self.cells), "axes": self.axes, "format": "png", "status": "sheet"}
+
+    def records(self):
+        # one final record per cell as jobs finish, then the contact sheet
+        images = [None] * len(self.cells)
+
+        try:
+            while self.jobs or self.pending:
+                if not self.jobs:
+                    # queue filled up with other requests, wait for a slot
+                    try:
+                        self.fill()
+                    except imagine_jobs.QueueFullError as e:
+                        time.sleep(min(e.retry_after, 1))
+                    continue
+
+                job, cells = self.jobs[0]
+                result = self.wait_result(job)
+                self.jobs.popleft()
+
+                if isinstance(result, Exception):
+                    raise result
+
+                yield from self.cell_records(job, cells, result, images)
+                self.fill()
+
+            yield self.sheet_record(images)
+
+        except GeneratorExit:
+            print("Grid generator detected client disconnect. Signaling generation jobs to stop.")
+            self.cancel()
+        except Exception as e:
+            print(f"Error in grid: {e}")
+            self.cancel()
+            raise
+
+
+def grid_logic(data):
+    # returns a generator of response records, queues the first jobs right away
+    return Grid(data).records()
+
+
+def encode_record(record, binary):
+    # binary frame with raw image bytes or NDJSON line with base64 image
+    if binary:
+        header = {key: value for key, value in record.items() if key != 'img'}
+        return imagine_frames.pack_frame(header, record.get('img', b''))
+
+    if 'img' in record:
+        started = time.monotonic()
+        record = {**record, 'img': base64.b64encode(record['img']).decode('utf-8')}
+
+        # final records report their own base64 encoding
+        if 'timings' in record:
+            elapsed = time.monotonic() - started
+            metrics.observe('base64', elapsed)
+            record['timings'] = {**record['timings'], 'base64': round(elapsed, 4)}
+    return (json.dumps(record) + '\n').encode('utf-8')
+
+
+def parse_size(size):
+    # "WIDTHxHEIGHT" -> (width, height)
+    try:
+        width, height = (int(value) for value in size.lower().split('x'))
+    except ValueError:
+        raise ValueError(f"Invalid size '{size}', expected WIDTHxHEIGHT")
+    return width, height
+
+
+def startup(preload, warmup, samplers, sizes):
+    # load models and run warmup generations, generation requests are rejected until `ready`
+    try:
+        for model_name in preload:
+            if workers:
+                for worker in workers:
+                    worker.load(find_model(model_name))
+            else:
+                pipe_cache.get(find_model(model_name), dev, fp_prec)
+
+        if warmup:
+            if not preload:
+                print('Warning: --warmup needs --preload models, nothing to warm up.')
+
+            for model_name in preload:
+                for sampler in samplers:
+                    for width, height in sizes:
+                        print(f'Warming up {model_name}: {sampler}, {width}x{height}')
+                        started = time.monotonic()
+
+                        data = {
+                            'model': model_name,
+                            'prompt': 'warmup',
+                            'width': width,
+                            'height': height,
+                            'steps': imagine_server_defs.WARMUP_STEPS,
+                            'sampler': sampler,
+                            'seed': 0,
+                            'cache': False
+                        }
+
+                        if workers:
+                            # every worker compiles its own kernels, bypass the scheduler
+                            for worker in workers:
+                                job = build_job(data)
+                                job.started = time.monotonic()
+                                worker.execute([job])
+                                job.finish()
+                        else:
+                            job = submit_job(data)
+                            for _ in job_results(job):
+                                pass
+
+                        print(f'Warmed up {model_name}: {sampler}, {width}x{height} in {time.monotonic() - started:.1f}s')
+    except Exception as e:
+        print(f'Startup failed: {e}')
     finally:
-        # This block is *always* executed when the generator finishes or is closed (e.g., by GeneratorExit).
-        # Ensures the generation thread is joined and resources are cleaned up.
-        if proc.is_alive():
-            print(f"Waiting for generation thread (seed {seed}) to finish cleanup...")
-            stop_event.set() # Ensure the event is set, just in case
-            proc.join(timeout=5) # Give it some time to stop gracefully
-            if proc.is_alive():
-                print(f"Warning: Generation thread (seed {seed}) did not stop gracefully. It might still be running or stuck.")
-
-
-def get_models():
-    expanded_models_path = os.path.expanduser(models_path)
-    os.makedirs(expanded_models_path, exist_ok=True)
-
-    model_names = []
-    # read models
-    for filename in os.listdir(expanded_models_path):
-        # filter
-        if filename.endswith(('.safetensors', '.ckpt')):
-            model_name = os.path.splitext(filename)[0]
-            model_names.append(model_name)
-    
-    # sort
-    model_names.sort()
-    return model_names
+        ready.set()
+        print('Server is ready.')
+
+
+def ready_status():
+    # (http status, body) of /ready
+    if not ready.is_set():
+        return 503, {"ready": False}
+
+    resident = [os.path.splitext(os.path.basename(model_path))[0] for model_path in resident_models()]
+    return 200, {"ready": True, "models": resident}
+
+
+def get_catalog():
+    # catalog entries with `resident` flag, clients can prefer warm models
+    resident = resident_models()
+    entries = catalog.models()
+
+    for entry in entries:
+        entry['resident'] = os.path.realpath(os.path.join(catalog.models_path, entry['file'])) in resident
+    return entries
+
+
+def models_response():
+    # body of /models, bare names stay for older clients
+    entries = get_catalog()
+    return {"models": [entry['name'] for entry in entries], "catalog": entries}
+
+def metrics_response():
+    # body of /metrics, stage histograms plus current server state
+    caches = {'embed': embed_cache.stats(), 'result': result_cache.stats()}
+
+    with inflight_lock:
+        pending = sum(not job.done.is_set() for job in inflight.values())
+
+    # workers report device memory after every call
+    if workers:
+        memory = [({'device': str(worker), 'kind': kind}, value) for worker in workers for kind, value in worker.memory.items()]
+    else:
+        memory = [({'device': dev, 'kind': kind}, value) for kind, value in imagine_pipes.device_memory(dev).items()]
+
+    def hit_ratio(stats):
+        lookups = stats['hits'] + stats['misses']
+        return stats['hits'] / lookups if lookups else 0.0
+
+    return metrics.render([
+        ('imagine_ready', 'gauge', 'Startup preloading and warmup finished', [({}, int(ready.is_set()))]),
+        ('imagine_queue_depth', 'gauge', 'Jobs waiting in the generation queue', [({}, scheduler.depth())]),
+        ('imagine_active_jobs', 'gauge', 'Workers running a pipeline call', [({}, scheduler.active())]),
+        ('imagine_inflight_jobs', 'gauge', 'Queued or running jobs identical requests can attach to', [({}, pending)]),
+        ('imagine_threads', 'gauge', 'Live threads of the server process', [({}, threading.active_count())]),
+        ('imagine_models_resident', 'gauge', 'Models loaded on the device', [({}, len(resident_models()))]),
+        ('imagine_cache_hits_total', 'counter', 'Cache lookups answered from cache', [({'cache': name}, stats['hits']) for name, stats in caches.items()]),
+        ('imagine_cache_misses_total', 'counter', 'Cache lookups not in cache', [({'cache': name}, stats['misses']) for name, stats in caches.items()]),
+        ('imagine_cache_hit_ratio', 'gauge', 'Cache hits per lookup since start', [({'cache': name}, hit_ratio(stats)) for name, stats in caches.items()]),
+        ('imagine_cache_entries', 'gauge', 'Cached entries', [({'cache': name}, stats['entries']) for name, stats in caches.items()]),
+        ('imagine_cache_bytes', 'gauge', 'Size of cached entries', [({'cache': name}, stats['size']) for name, stats in caches.items()]),
+        ('imagine_device_memory_bytes', 'gauge', 'Memory use of the compute device', memory)
+    ])
+
 
 class SDRequestHandler(BaseHTTPRequestHandler):
     # Handle OPTIONS preflight requests
@@ -269,14 +975,36 @@ class SDRequestHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Max-Age', '86400') # Cache preflight response for 24 hours
         self.end_headers()
 
+    def send_json(self, code, data, headers=None):
+        response_body = json.dumps(data).encode('utf-8')
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-Length', str(len(response_body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(response_body)
+
     def do_GET(self):
-        if self.path == '/models':
+        if self.path == '/ready':
+            self.send_json(*ready_status())
+        elif self.path == '/metrics':
+            response_body = metrics_response()
+
+            self.send_response(200)
+            self.send_header('Content-Type', imagine_metrics.CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(response_body)))
+            self.end_headers()
+            self.wfile.write(response_body)
+        elif self.path == '/models':
             try:
                 # read models
-                model_names = get_models()
+                response_data = models_response()
+                model_names = response_data["models"]
 
                 # response
-                response_data = {"models": model_names}
                 response_body = json.dumps(response_data).encode('utf-8')
 
                 self.send_response(200)
@@ -295,7 +1023,9 @@ class SDRequestHandler(BaseHTTPRequestHandler):
             self.send_error(404, "Not Found")
 
     def do_POST(self):
-        if self.path == '/generate':
+        if self.path in ('/generate', '/grid') and not ready.is_set():
+            self.send_json(503, {"error": "Server is warming up"}, {'Retry-After': str(imagine_server_defs.WARMUP_RETRY_AFTER)})
+        elif self.path in ('/generate', '/grid'):
             content_length = int(self.headers.get('Content-Length', 0))
             if content_length == 0:
                 self.send_error(400, "Request body is empty")
@@ -309,34 +1039,37 @@ class SDRequestHandler(BaseHTTPRequestHandler):
                 post_body = self.rfile.read(content_length).decode('utf-8')
                 data = json.loads(post_body)
 
-                is_streaming_requested = data.get('stream', None) is not None
+                # grid cells are always streamed as they finish
+                is_streaming_requested = data.get('stream', None) is not None or self.path == '/grid'
+                is_binary_accepted = imagine_frames.CONTENT_TYPE in self.headers.get('Accept', '')
 
-                # Generate image logic returns a generator
-                response_generator = generate_image_logic(data)
+                # Generate image logic returns a generator of records
+                response_generator = grid_logic(data) if self.path == '/grid' else generate_image_logic(data)
 
                 if is_streaming_requested:
                     self.send_response(200)
-                    self.send_header('Content-Type', 'text/json')
+                    self.send_header('Content-Type', imagine_frames.CONTENT_TYPE if is_binary_accepted else 'text/json')
+                    self.send_header('Vary', 'Accept')
                     self.send_header('Access-Control-Allow-Origin', '*')
                     self.send_header('Access-Control-Allow-Headers', 'Content-Type')
                     self.send_header('Transfer-Encoding', 'chunked')
                     self.end_headers()
 
                     # Send chunks
-                    for chunk_data_line in response_generator:
-                        encoded_chunk = chunk_data_line.encode('utf-8')
+                    for record in response_generator:
+                        encoded_chunk = encode_record(record, is_binary_accepted)
                         self.wfile.write(f'{len(encoded_chunk):X}\r\n'.encode('ascii'))
                         self.wfile.write(encoded_chunk)
                         self.wfile.write(b'\r\n')
                     self.wfile.write(b'0\r\n\r\n')
 
                 else:
-                    # If not streaming, consume the generator to get the single final result
-                    final_response_json_line = next(response_generator)
-                    encoded_response = final_response_json_line.encode('utf-8')
+                    # If not streaming, consume the generator to get the final results, one record per image
+                    encoded_response = b''.join(encode_record(record, is_binary_accepted) for record in response_generator)
 
                     self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Type', imagine_frames.CONTENT_TYPE if is_binary_accepted else 'application/json')
+                    self.send_header('Vary', 'Accept')
                     self.send_header('Content-Length', str(len(encoded_response)))
                     self.send_header('Access-Control-Allow-Origin', '*')
                     self.send_header('Access-Control-Allow-Headers', 'Content-Type')
@@ -350,6 +1083,18 @@ class SDRequestHandler(BaseHTTPRequestHandler):
                     # This will raise GeneratorExit in generate_image_logic,
                     # which will then set the stop_event for run_pipe and handle cleanup.
                     response_generator.close()
+            except imagine_jobs.QueueFullError as e:
+                # Backpressure: tell client when to come back instead of piling up generations
+                print(f"Rejected {self.path} request: {e}")
+                error_response = json.dumps({"error": str(e), "retry_after": e.retry_after}).encode('utf-8')
+
+                self.send_response(429)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(error_response)))
+                self.send_header('Retry-After', str(e.retry_after))
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                self.wfile.write(error_response)
             except json.JSONDecodeError:
                 self.send_error(400, "Invalid JSON in request body",
                                 json.dumps({"error": "Invalid JSON"}))
@@ -375,16 +1120,108 @@ class SDRequestHandler(BaseHTTPRequestHandler):
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
     # Allow threads to exit when the main program exits
     daemon_threads = True
+    # pending connections, socketserver default of 5 resets bursts of clients
+    request_queue_size = 128
 
 
-def serve(args):
+def setup_pipelines(args, device):
+    # pipeline and prompt caches of the process that runs generations on `device`
     global dev
     global fp_prec
     global models_path
-
-    dev = args.device
-    fp_prec = torch.float32 if args.full_prec else (torch.bfloat16 if args.device == 'cpu' else torch.float16)
+    global pipe_cache
+    global embed_cache
+    global preview_mode
+    global memory_mode
+    global quant_mode
+    global cache_interval
+    global tile_batch
+
+    # int8 layers quantize float32 activations
+    dev = device
+    fp_prec = torch.float32 if args.full_prec or args.quant != 'none' else (torch.bfloat16 if device == 'cpu' else torch.float16)
     models_path = args.models
+    preview_mode = args.preview
+    memory_mode = args.memory
+    quant_mode = args.quant
+    cache_interval = args.cache_interval
+    tile_batch = args.tile_batch
+    loader = imagine_pipes.load_pipe
+    store = imagine_store.ModelStore(args.store, args.store_size * 1024**2) if args.store and args.store_size > 0 else None
+
+    if args.fake:
+        import imagine_fake
+        loader = imagine_fake.loader(args.fake_step / 1000, parse_size(args.fake_size) if args.fake_size else None)
+        store = None
+
+    pipe_cache = imagine_pipes.PipelineCache(args.max_models, args.mem_reserve * 1024**2, args.compile, store, loader, args.quant)
+    embed_cache = imagine_embeds.EmbeddingCache(args.embed_cache * 1024**2)
+
+
+def resident_models():
+    # real paths of models loaded in this process or any worker process
+    if workers:
+        return {model_path for worker in workers for model_path in worker.resident}
+    return {key[0] for key in pipe_cache.resident()}
+
+
+def serve(args):
+    global result_cache
+    global scheduler
+    global catalog
+    global workers
+
+    # stub backend without weights serving a single 'fake' model on cpu, for load tests
+    if args.fake:
+        import imagine_fake
+
+        args.device = 'cpu'
+        args.models = tempfile.mkdtemp(prefix='imagine-fake-')
+        args.compile = False
+        imagine_fake.create_model(args.models)
+        print(f"Fake backend: model '{imagine_fake.FAKE_MODEL}', {args.fake_step} ms per step")
+
+    # quantized kernels run on cpu only
+    if args.quant != 'none' and args.device != 'cpu':
+        raise ValueError(f"--quant {args.quant} needs --device cpu")
+
+    setup_pipelines(args, args.device)
+    catalog = imagine_catalog.ModelCatalog(models_path)
+    result_cache = imagine_results.ResultCache(args.cache_dir, args.cache_size * 1024**2)
+
+    if args.workers:
+        # one process per device or core group, jobs go to a worker with their model loaded
+        import imagine_workers
+
+        devices = imagine_workers.worker_devices(args.device, args.workers if args.workers > 0 else None)
+        workers = [imagine_workers.WorkerProcess(index, device, cpus, args, metrics, result_cache) for index, (device, cpus) in enumerate(devices)]
+        print(f"Workers: {', '.join(str(worker) for worker in workers)}")
+
+        affinity = lambda job, worker: worker.has_model(job.params['model_path'])
+        scheduler = imagine_jobs.JobScheduler(lambda jobs, worker: worker.execute(jobs), workers, args.queue_size, batch_key, args.max_batch, args.batch_window / 1000, affinity)
+    else:
+        scheduler = imagine_jobs.JobScheduler(execute_jobs, [dev], args.queue_size, batch_key, args.max_batch, args.batch_window / 1000)
+
+    # compiled kernels persist across restarts
+    if args.compile:
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.expanduser(args.compile_cache)
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+    # preload and warm up while the socket already answers /ready
+    preload = [name.strip() for name in (args.preload or '').split(',') if name.strip()]
+    samplers = [name.strip() for name in args.warmup_samplers.split(',') if name.strip()]
+    sizes = [parse_size(size) for size in args.warmup_sizes.split(',') if size.strip()]
+    for sampler in samplers:
+        if sampler not in SAMPLERS:
+            raise ValueError(f"Invalid warmup sampler '{sampler}'. Available samplers: {list(SAMPLERS.keys())}")
+
+    ready.clear()
+    threading.Thread(target=startup, args=(preload, args.warmup, samplers, sizes), name='imagine-startup', daemon=True).start()
+
+    if args.async_server:
+        import imagine_server_async
+        imagine_server_async.serve(args.host, args.port)
+        return
 
     server_address = (args.host, args.port)
     httpd = ThreadedHTTPServer(server_address, SDRequestHandler)
@@ -0,0 +1,507 @@
+import json
+import queue
+import asyncio
+
+import imagine_jobs
+import imagine_frames
+import imagine_metrics
+import imagine_server
+import imagine_server_defs
+
+
+# settings
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 64 * 1024**2 # base64 input images included
+KEEP_ALIVE_TIMEOUT = 75 # s, idle keep-alive connections are closed after it
+POSITION_POLL_INTERVAL = 0.1 # s, queue position is re-checked this often while waiting
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable'
+}
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+
+class Disconnected(Exception):
+    pass
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method, path, version, headers, body=b''):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers # lower-case names
+        self.body = body
+
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class Connection:
+    """
+    Single keep-alive client connection.
+
+    All reads go through `buffer`, so a pending read used to notice a disconnect while a
+    response is being generated never loses bytes of the next request.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray()
+        self.eof = False
+
+    async def fill(self):
+        # read more bytes into buffer, returns False at end of stream
+        if self.eof:
+            return False
+
+        try:
+            data = await self.reader.read(65536)
+        except (ConnectionError, OSError):
+            # reset by peer, e.g. closed with unread response bytes
+            data = b''
+
+        if not data:
+            self.eof = True
+            return False
+
+        self.buffer += data
+        return True
+
+    async def read_request(self):
+        # next request or None when the client closed the connection
+        while True:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end >= 0:
+                break
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise HTTPStatusError(431, 'Request headers too large')
+            if not await self.fill():
+                return None
+
+        head = bytes(self.buffer[:end]).decode('latin-1')
+        del self.buffer[:end + 4]
+
+        lines = head.split('\r\n')
+        try:
+            method, path, version = lines[0].split(' ', 2)
+        except ValueError:
+            raise HTTPStatusError(400, 'Malformed request line')
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HTTPStatusError(411, 'Chunked request bodies are not supported')
+
+        try:
+            length = int(headers.get('content-length', 0) or 0)
+        except ValueError:
+            raise HTTPStatusError(400, 'Invalid Content-Length')
+        if length < 0:
+            raise HTTPStatusError(400, 'Invalid Content-Length')
+        if length > MAX_BODY_SIZE:
+            raise HTTPStatusError(413, f'Request body larger than {MAX_BODY_SIZE} bytes')
+        while len(self.buffer) < length:
+            if not await self.fill():
+                raise Disconnected()
+
+        body = bytes(self.buffer[:length])
+        del self.buffer[:length]
+
+        return Request(method, path, version, headers, body)
+
+    async def write(self, data):
+        if self.writer.is_closing():
+            raise Disconnected()
+        self.writer.write(data)
+        try:
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            raise Disconnected()
+
+    async def send_head(self, status, headers):
+        lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        await self.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def send(self, status, body, content_type='application/json', headers=None, keep_alive=True):
+        await self.send_head(status, {
+            'Content-Type': content_type,
+            'Content-Length': str(len(body)),
+            'Connection': 'keep-alive' if keep_alive else 'close',
+            **CORS_HEADERS,
+            **(headers or {})
+        })
+        await self.write(body)
+
+    async def send_json(self, status, data, headers=None, keep_alive=True):
+        await self.send(status, json.dumps(data).encode('utf-8'), headers=headers, keep_alive=keep_alive)
+
+    async def send_chunk(self, data):
+        await self.write(f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n')
+
+
+async def wait_job(job, wake, watch, timeout=POSITION_POLL_INTERVAL):
+    # wait for job progress, queue position update or client disconnect
+    wake_task = asyncio.ensure_future(wake.wait())
+    try:
+        await asyncio.wait({wake_task, watch}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        wake_task.cancel()
+
+
+async def job_records(conn, job, streaming, binary):
+    # async counterpart of `imagine_server.job_results`, yields encoded records without blocking a thread,
+    # records with images are encoded (base64, JSON) on the default executor
+    loop = asyncio.get_running_loop()
+    seed = job.params['seed']
+    seeds = job.params['seeds']
+
+    wake = asyncio.Event()
+    job.cb_queue.listener = job.res_queue.listener = lambda: loop.call_soon_threadsafe(wake.set)
+
+    # pending read that completes when the client disconnects (or sends more data)
+    watch = asyncio.ensure_future(conn.fill())
+
+    try:
+        position = None
+        samples_done = False
+
+        while True:
+            wake.clear()
+
+            # samples, run_pipe always ends them with None
+            while not samples_done:
+                try:
+                    sample = job.cb_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if sample is None:
+                    samples_done = True
+                    break
+
+                index, img, fmt = sample
+                if streaming:
+                    record = {"img": img, "seed": str(seeds[index]), "index": index, "format": fmt, "status": "intermediate"}
+                    yield await loop.run_in_executor(None, imagine_server.encode_record, record, binary)
+
+            if samples_done or job.done.is_set():
+                try:
+                    final_result = job.res_queue.get_nowait()
+                    break
+                except queue.Empty:
+                    if job.done.is_set() and not samples_done:
+                        print(f"Warning: Generation job for seed {seed} ended prematurely or without final signal.")
+                        return
+
+            # Report queue position while the job waits for a worker
+            if streaming and job.position is not None and job.position != position:
+                position = job.position
+                yield imagine_server.encode_record({"seed": str(seed), "status": "queued", "position": position}, binary)
+
+            await wait_job(job, wake, watch)
+
+            if watch.done():
+                if not watch.result():
+                    raise Disconnected()
+                # client sent more data (pipelined request), keep it buffered and keep watching
+                watch = asyncio.ensure_future(conn.fill())
+
+        if isinstance(final_result, Exception):
+            raise final_result # Re-raise error from run_pipe or cancellation signal
+
+        # final records and their encoding are cpu work, keep them off the event loop
+        chunks = await loop.run_in_executor(None, lambda: [imagine_server.encode_record(record, binary) for record in imagine_server.final_records(job, final_result)])
+        for chunk in chunks:
+            yield chunk
+
+    finally:
+        watch.cancel()
+        job.cb_queue.listener = job.res_queue.listener = None
+
+
+async def submit(conn, request, submit_data):
+    # (data, submitted work) or None once the error response is sent,
+    # submitting stats the model, hashes input images and reads cached results, so it runs on the default executor
+    loop = asyncio.get_running_loop()
+    keep_alive = request.keep_alive()
+
+    if not imagine_server.ready.is_set():
+        await conn.send_json(503, {"error": "Server is warming up"}, {'Retry-After': str(imagine_server_defs.WARMUP_RETRY_AFTER)}, keep_alive)
+        return None
+
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        return data, await loop.run_in_executor(None, submit_data, data)
+    except json.JSONDecodeError:
+        await conn.send_json(400, {"error": "Invalid JSON"}, keep_alive=keep_alive)
+    except imagine_jobs.QueueFullError as e:
+        # Backpressure: tell client when to come back instead of piling up generations
+        print(f"Rejected {request.path} request: {e}")
+        await conn.send_json(429, {"error": str(e), "retry_after": e.retry_after}, {'Retry-After': str(e.retry_after)}, keep_alive)
+    except ValueError as e:
+        # Catch validation errors from submit_job
+        await conn.send_json(400, {"error": str(e)}, keep_alive=keep_alive)
+    except Exception as e:
+        print(f"Server error in {request.path} request: {e}")
+        await conn.send_json(500, {"error": "Internal server error", "details": str(e)}, keep_alive=keep_alive)
+
+    return None
+
+
+async def handle_generate(conn, request):
+    keep_alive = request.keep_alive()
+
+    submitted = await submit(conn, request, imagine_server.submit_job)
+    if submitted is None:
+        return keep_alive
+    data, job = submitted
+
+    streaming = data.get('stream', None) is not None
+    binary = imagine_frames.CONTENT_TYPE in request.headers.get('accept', '')
+    content_type = imagine_frames.CONTENT_TYPE if binary else ('text/json' if streaming else 'application/json')
+
+    try:
+        if streaming:
+            await conn.send_head(200, {
+                'Content-Type': content_type,
+                'Vary': 'Accept',
+                'Transfer-Encoding': 'chunked',
+                'Connection': 'keep-alive' if keep_alive else 'close',
+                **CORS_HEADERS
+            })
+
+            try:
+                async for chunk in job_records(conn, job, True, binary):
+                    await conn.send_chunk(chunk)
+            except Disconnected:
+                raise
+            except Exception as e:
+                # headers are already sent, report error as the last record
+                print(f"Server error during generation: {e}")
+                await conn.send_chunk(imagine_server.encode_record({"error": "Internal server error during image generation", "details": str(e), "status": "error"}, binary))
+
+            await conn.write(b'0\r\n\r\n')
+        else:
+            try:
+                body = b''.join([chunk async for chunk in job_records(conn, job, False, binary)])
+            except Disconnected:
+                raise
+            except Exception as e:
+                print(f"Server error during generation: {e}")
+                await conn.send_json(500, {"error": "Internal server error during image generation", "details": str(e)}, keep_alive=keep_alive)
+                return keep_alive
+
+            await conn.send(200, body, content_type, {'Vary': 'Accept'}, keep_alive)
+
+    except Disconnected:
+        # Client disconnected, stop generation or drop it from queue
+        print(f"Client disconnected from {request.path} prematurely. Signaling generation job (seed {job.params['seed']}) to stop.")
+        imagine_server.scheduler.cancel(job)
+        return False
+
+    return keep_alive
+
+
+async def grid_records(conn, grid, binary):
+    # async counterpart of `imagine_server.Grid.records`, waits for jobs through their queue listeners,
+    # submitting, encoding and stitching run on the default executor one short call at a time
+    loop = asyncio.get_running_loop()
+    images = [None] * len(grid.cells)
+
+    wake = asyncio.Event()
+    watch = asyncio.ensure_future(conn.fill())
+    job = None
+
+    async def wait(timeout=POSITION_POLL_INTERVAL):
+        # wait for job progress or client disconnect, keeps watching after pipelined data
+        nonlocal watch
+        await wait_job(job, wake, watch, timeout)
+        if watch.done():
+            if not watch.result():
+                raise Disconnected()
+            watch = asyncio.ensure_future(conn.fill())
+
+    try:
+        while grid.jobs or grid.pending:
+            if not grid.jobs:
+                # queue filled up with other requests, wait for a slot
+                try:
+                    await loop.run_in_executor(None, grid.fill)
+                except imagine_jobs.QueueFullError as e:
+                    wake.clear()
+                    await wait(min(e.retry_after, 1))
+                continue
+
+            job, cells = grid.jobs[0]
+            job.res_queue.listener = lambda: loop.call_soon_threadsafe(wake.set)
+
+            while True:
+                wake.clear()
+                try:
+                    result = job.res_queue.get_nowait()
+                    break
+                except queue.Empty:
+                    if job.done.is_set() and job.res_queue.empty():
+                        result = Exception('Grid was cancelled.')
+                        break
+                await wait()
+
+            job.res_queue.listener = None
+            grid.jobs.popleft()
+
+            if isinstance(result, Exception):
+                raise result
+
+            chunks = await loop.run_in_executor(None, lambda: [imagine_server.encode_record(record, binary) for record in grid.cell_records(job, cells, result, images)])
+            for chunk in chunks:
+                yield chunk
+
+            await loop.run_in_executor(None, grid.fill)
+
+        yield await loop.run_in_executor(None, lambda: imagine_server.encode_record(grid.sheet_record(images), binary))
+
+    except Disconnected:
+        raise
+    except Exception as e:
+        print(f"Error in grid: {e}")
+        grid.cancel()
+        raise
+    finally:
+        watch.cancel()
+        if job is not None:
+            job.res_queue.listener = None
+
+
+async def handle_grid(conn, request):
+    keep_alive = request.keep_alive()
+
+    submitted = await submit(conn, request, imagine_server.Grid)
+    if submitted is None:
+        return keep_alive
+    _, grid = submitted
+
+    binary = imagine_frames.CONTENT_TYPE in request.headers.get('accept', '')
+
+    try:
+        await conn.send_head(200, {
+            'Content-Type': imagine_frames.CONTENT_TYPE if binary else 'text/json',
+            'Vary': 'Accept',
+            'Transfer-Encoding': 'chunked',
+            'Connection': 'keep-alive' if keep_alive else 'close',
+            **CORS_HEADERS
+        })
+
+        try:
+            async for chunk in grid_records(conn, grid, binary):
+                await conn.send_chunk(chunk)
+        except Disconnected:
+            raise
+        except Exception as e:
+            # headers are already sent, report error as the last record
+            print(f"Server error during grid generation: {e}")
+            await conn.send_chunk(imagine_server.encode_record({"error": "Internal server error during image generation", "details": str(e), "status": "error"}, binary))
+
+        await conn.write(b'0\r\n\r\n')
+
+    except Disconnected:
+        print(f"Client disconnected from {request.path} prematurely. Signaling grid jobs to stop.")
+        grid.cancel()
+        return False
+
+    return keep_alive
+
+
+async def handle_request(conn, request):
+    # returns whether the connection stays open
+    keep_alive = request.keep_alive()
+
+    if request.method == 'OPTIONS':
+        await conn.send(200, b'', 'text/plain', {
+            'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
+            'Access-Control-Max-Age': '86400'
+        }, keep_alive)
+    elif request.method == 'GET' and request.path == '/ready':
+        status, data = imagine_server.ready_status()
+        await conn.send_json(status, data, keep_alive=keep_alive)
+    elif request.method == 'GET' and request.path == '/metrics':
+        await conn.send(200, imagine_server.metrics_response(), imagine_metrics.CONTENT_TYPE, keep_alive=keep_alive)
+    elif request.method == 'GET' and request.path == '/models':
+        try:
+            response_data = imagine_server.models_response()
+            model_names = response_data["models"]
+            await conn.send_json(200, response_data, keep_alive=keep_alive)
+            print(f"Served /models request. Found {len(model_names)} models.")
+        except Disconnected:
+            raise
+        except Exception as e:
+            print(f"Error serving /models request: {e}")
+            await conn.send_json(500, {"error": f"Failed to list models: {e}"}, keep_alive=keep_alive)
+    elif request.method == 'POST' and request.path == '/generate':
+        return await handle_generate(conn, request)
+    elif request.method == 'POST' and request.path == '/grid':
+        return await handle_grid(conn, request)
+    else:
+        await conn.send_json(404, {"error": "Not Found"}, keep_alive=keep_alive)
+
+    return keep_alive
+
+
+async def handle_connection(reader, writer):
+    conn = Connection(reader, writer)
+
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(conn.read_request(), KEEP_ALIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            except HTTPStatusError as e:
+                await conn.send_json(e.status, {"error": str(e)}, keep_alive=False)
+                break
+
+            if request is None or not await handle_request(conn, request):
+                break
+    except (Disconnected, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run(host, port):
+    server = await asyncio.start_server(handle_connection, host, port, limit=MAX_HEADER_SIZE)
+    print(f'Starting asyncio server on http://{host}:{port}')
+
+    async with server:
+        await server.serve_forever()
+
+
+def serve(host, port):
+    try:
+        asyncio.run(run(host, port))
+    except KeyboardInterrupt:
+        print('\nServer is shutting down.')
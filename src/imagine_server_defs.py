@@ -1,2 +1,37 @@
 DEFAULT_DEVICE = 'cuda'
 DEFAULT_MODELS_PATH = '~/.imagine/models'
+DEFAULT_MAX_MODELS = 2
+DEFAULT_MEM_RESERVE = 1024 # MiB
+DEFAULT_EMBED_CACHE = 64 # MiB
+DEFAULT_CACHE_PATH = '~/.imagine/cache'
+DEFAULT_CACHE_SIZE = 0 # MiB, the result cache is opt-in
+DEFAULT_STORE_PATH = '~/.imagine/store'
+DEFAULT_STORE_SIZE = 0 # MiB, converted models take gigabytes, the store is opt-in
+DEFAULT_HASHES_PATH = '~/.imagine/hashes.json'
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_MAX_BATCH = 1
+DEFAULT_BATCH_WINDOW = 50 # ms
+MAX_COUNT = 16
+PREVIEW_MODES = ['full', 'latent', 'taesd']
+DEFAULT_PREVIEW = 'full'
+DEFAULT_PREVIEW_SIZE = 256 # px
+MEMORY_MODES = ['auto', 'none', 'tiled', 'sliced', 'offload', 'sequential']
+DEFAULT_MEMORY = 'auto'
+QUANT_MODES = ['none', 'int8']
+DEFAULT_QUANT = 'none'
+DEFAULT_CACHE_INTERVAL = 1 # UNet calls per full one, 1 disables feature caching
+DEFAULT_TILE_OVERLAP = 64 # px
+DEFAULT_TILE_BATCH = 4 # tiles per UNet call
+MIN_TILE = 128 # px
+HIRES_UPSCALERS = ['image', 'latent']
+DEFAULT_HIRES_UPSCALE = 'image'
+DEFAULT_HIRES_STRENGTH = 0.35
+DEFAULT_WARMUP_SIZES = '512x512'
+WARMUP_STEPS = 2
+WARMUP_RETRY_AFTER = 5 # s
+DEFAULT_COMPILE_CACHE = '~/.imagine/compile'
+DEFAULT_BENCH_REPEAT = 5
+DEFAULT_BENCH_CONCURRENCY = '1,2,4'
+DEFAULT_BENCH_REQUESTS = 8
+DEFAULT_BENCH_THRESHOLD = 0.2 # relative slowdown reported as regression
+DEFAULT_FAKE_STEP = 50 # ms
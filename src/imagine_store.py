@@ -0,0 +1,133 @@
+import os
+import json
+import shutil
+import struct
+import hashlib
+import threading
+
+import diffusers
+
+import imagine_pipes
+import imagine_server_defs
+
+
+SOURCE_FILE = 'source.json'
+
+
+def header_hash(model_path):
+    # sha256 of the safetensors header (tensor names, dtypes, shapes and offsets), cheap unlike hashing gigabytes
+    hasher = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        prefix = f.read(8)
+        if len(prefix) == 8:
+            (header_size,) = struct.unpack('<Q', prefix)
+            hasher.update(f.read(min(header_size, 100 * 1024**2)))
+    return hasher.hexdigest()
+
+
+class ModelStore:
+    """
+    Directory of checkpoints converted to diffusers layout at the compute precision.
+
+    The first load of a single-file checkpoint converts it as usual and saves the result
+    with `save_pretrained`, later loads read the memory-mapped safetensors of that copy
+    and skip key conversion and casting. Entries are keyed by checkpoint header hash, size,
+    mtime and precision, so a replaced checkpoint is converted again and its stale entry
+    removed. Loads touch the entry, least recently loaded entries are removed once all of
+    them take more than `max_size` bytes.
+    """
+    def __init__(self, path=imagine_server_defs.DEFAULT_STORE_PATH, max_size=imagine_server_defs.DEFAULT_STORE_SIZE * 1024**2):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        self.lock = threading.Lock() # serializes conversions
+
+    def entry(self, model_path, fp_prec):
+        # (entry directory, source description)
+        stat = os.stat(model_path)
+        source = {
+            'model': os.path.realpath(model_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'header': header_hash(model_path),
+            'precision': str(fp_prec)
+        }
+
+        key = hashlib.sha256(json.dumps(source, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(model_path))[0]
+        return os.path.join(self.path, f'{name}-{key}'), source
+
+    def load(self, model_path, dev, fp_prec, loader=imagine_pipes.load_pipe):
+        entry_path, source = self.entry(model_path, fp_prec)
+
+        if os.path.exists(os.path.join(entry_path, SOURCE_FILE)):
+            try:
+                print(f"Loading converted model: {entry_path} for device {dev}, precision {fp_prec}")
+                pipe = diffusers.StableDiffusionPipeline.from_pretrained(entry_path, torch_dtype=fp_prec, safety_checker=None, requires_safety_checker=False)
+                os.utime(os.path.join(entry_path, SOURCE_FILE))
+                return imagine_pipes.prepare_pipe(pipe, dev, fp_prec)
+            except Exception as e:
+                print(f"Failed to load converted model {entry_path}, converting again: {e}")
+                shutil.rmtree(entry_path, ignore_errors=True)
+
+        pipe = loader(model_path, dev, fp_prec)
+        self.save(pipe, entry_path, source)
+        return pipe
+
+    def save(self, pipe, entry_path, source):
+        with self.lock:
+            tmp_path = f'{entry_path}.tmp'
+            try:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                pipe.save_pretrained(tmp_path, safe_serialization=True)
+
+                # source file marks a complete entry
+                with open(os.path.join(tmp_path, SOURCE_FILE), 'w') as f:
+                    json.dump(source, f, indent=2)
+
+                shutil.rmtree(entry_path, ignore_errors=True)
+                os.replace(tmp_path, entry_path)
+                print(f"Converted model saved: {entry_path}")
+            except Exception as e:
+                print(f"Failed to save converted model {entry_path}: {e}")
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+
+            self.remove_stale(entry_path, source)
+            self.trim()
+
+    def remove_stale(self, entry_path, source):
+        # entries of older versions of the same checkpoint at the same precision
+        for entry in os.scandir(self.path):
+            if not entry.is_dir() or entry.path == entry_path:
+                continue
+
+            try:
+                with open(os.path.join(entry.path, SOURCE_FILE)) as f:
+                    other = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            if other.get('model') == source['model'] and other.get('precision') == source['precision']:
+                print(f"Removing stale converted model: {entry.path}")
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def trim(self):
+        # least recently loaded entries while all of them take more than `max_size`, caller holds `lock`
+        entries = []
+        for entry in os.scandir(self.path):
+            source_path = os.path.join(entry.path, SOURCE_FILE)
+            if not entry.is_dir() or not os.path.exists(source_path):
+                continue
+
+            size = 0
+            for root, _, files in os.walk(entry.path):
+                size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+            entries.append((os.path.getmtime(source_path), entry.path, size))
+
+        total = sum(size for _, _, size in entries)
+        for _, entry_path, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            print(f"Removing least recently loaded converted model: {entry_path}")
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total -= size
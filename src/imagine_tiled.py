@@ -0,0 +1,110 @@
+import contextlib
+
+import torch
+import diffusers
+
+
+def tile_starts(size, tile, stride):
+    # offsets of overlapping tiles covering `size`, the last one flush with the end
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
+
+
+def tile_weights(height, width, overlap, device):
+    # blending weights of one tile, rising linearly across the overlap from every edge
+    def ramp(size):
+        steps = torch.arange(size, device=device, dtype=torch.float32)
+        return torch.minimum(steps + 1, size - steps).div(overlap + 1).clamp(max=1)
+
+    return ramp(height)[:, None] * ramp(width)[None, :]
+
+
+class TiledUNet:
+    """
+    MultiDiffusion-style denoising of latents larger than a tile.
+
+    Every UNet call on a large latent runs on overlapping tiles of `tile` x `tile` latent
+    pixels, `batch` tiles per call, and returns the weighted average of their predictions.
+    Weights fall off linearly across the `overlap`, so neighbouring tiles blend without
+    seams. Activations scale with tile size and batch, not with the size of the latent.
+    Smaller latents run the UNet as is.
+    """
+    def __init__(self, unet, tile, overlap, batch):
+        self.unet = unet
+        self.tile = tile
+        self.overlap = overlap
+        self.batch = max(batch, 1)
+        self.forward_full = unet.forward # hooked by model offload, if enabled
+
+        self.calls = 0
+        self.tiles = 0
+
+    def forward(self, sample, timestep, encoder_hidden_states, timestep_cond=None, cross_attention_kwargs=None, added_cond_kwargs=None, return_dict=True, **kwargs):
+        height, width = sample.shape[-2:]
+        if height <= self.tile and width <= self.tile:
+            return self.forward_full(sample, timestep, encoder_hidden_states, timestep_cond=timestep_cond, cross_attention_kwargs=cross_attention_kwargs, added_cond_kwargs=added_cond_kwargs, return_dict=return_dict, **kwargs)
+
+        tile_h, tile_w = min(self.tile, height), min(self.tile, width)
+        stride = self.tile - self.overlap
+        tiles = [(y, x) for y in tile_starts(height, tile_h, stride) for x in tile_starts(width, tile_w, stride)]
+        weights = tile_weights(tile_h, tile_w, self.overlap, sample.device)
+
+        self.calls += 1
+        self.tiles += len(tiles)
+
+        # predictions accumulate in float32, half precision sums lose the blend
+        count = sample.shape[0]
+        output = None
+        total = torch.zeros((height, width), device=sample.device)
+
+        for start in range(0, len(tiles), self.batch):
+            chunk = tiles[start:start + self.batch]
+
+            # tiles stacked along the batch, conditioning repeated for every tile
+            crops = torch.cat([sample[..., y:y + tile_h, x:x + tile_w] for y, x in chunk])
+            repeat = lambda tensor: torch.cat([tensor] * len(chunk)) if torch.is_tensor(tensor) and tensor.ndim > 0 and tensor.shape[0] == count else tensor
+            res = self.forward_full(
+                crops,
+                repeat(timestep),
+                repeat(encoder_hidden_states),
+                timestep_cond=repeat(timestep_cond),
+                cross_attention_kwargs=cross_attention_kwargs,
+                added_cond_kwargs=None if added_cond_kwargs is None else {key: repeat(value) for key, value in added_cond_kwargs.items()},
+                return_dict=False,
+                **kwargs
+            )[0]
+
+            if output is None:
+                output = torch.zeros((count, res.shape[1], height, width), device=res.device)
+            for index, (y, x) in enumerate(chunk):
+                output[..., y:y + tile_h, x:x + tile_w] += res[index * count:(index + 1) * count] * weights
+                total[y:y + tile_h, x:x + tile_w] += weights
+
+        output = (output / total).to(res.dtype)
+        return (output,) if not return_dict else diffusers.models.unets.unet_2d_condition.UNet2DConditionOutput(sample=output)
+
+
+@contextlib.contextmanager
+def tiled_unet(pipe, tile, overlap, batch):
+    # UNet calls of `pipe` within the block on latents larger than `tile` pixels run on overlapping tiles, yields the `TiledUNet` or None
+    unet = getattr(pipe, 'unet', None)
+    if not tile or not isinstance(unet, diffusers.UNet2DConditionModel):
+        yield None
+        return
+
+    # pixels to latent pixels
+    scale = pipe.vae_scale_factor
+    tiled = TiledUNet(unet, tile // scale, overlap // scale, batch)
+    previous = unet.__dict__.get('forward')
+    unet.forward = tiled.forward
+
+    try:
+        yield tiled
+    finally:
+        if previous is None:
+            del unet.forward
+        else:
+            unet.forward = previous
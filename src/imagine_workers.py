@@ -0,0 +1,305 @@
+import os
+import glob
+import time
+import queue
+import itertools
+import threading
+import multiprocessing
+
+import torch
+
+import imagine_jobs
+
+
+CANCEL_POLL_INTERVAL = 0.1 # s, how often cancelled requests are forwarded to a running worker
+
+
+def parse_cpulist(text):
+    # "0-3,8-11" -> [0, 1, 2, 3, 8, 9, 10, 11]
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def numa_nodes():
+    # usable cpus of every NUMA node, a single node without NUMA information
+    cpus = set(available_cpus())
+
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'), key=lambda path: int(path.split('/')[-2][4:])):
+        try:
+            with open(path) as f:
+                node = [cpu for cpu in parse_cpulist(f.read()) if cpu in cpus]
+        except (OSError, ValueError):
+            continue
+        if node:
+            nodes.append(node)
+
+    return nodes or [sorted(cpus)]
+
+
+def cpu_groups(count):
+    # `count` disjoint core groups, NUMA nodes when there is one per worker
+    nodes = numa_nodes()
+    if count == len(nodes):
+        return nodes
+
+    cpus = [cpu for node in nodes for cpu in node]
+    count = min(count, len(cpus))
+    return [cpus[len(cpus) * i // count:len(cpus) * (i + 1) // count] for i in range(count)]
+
+
+def worker_devices(device, count):
+    # (device, pinned cpus or None) of every worker, `count` None picks one per GPU or NUMA node
+    if device == 'cuda':
+        gpus = torch.cuda.device_count()
+        if gpus == 0:
+            raise ValueError('No CUDA devices found for --workers')
+        return [(f'cuda:{i % gpus}', None) for i in range(count or gpus)]
+
+    if device == 'mps':
+        return [('mps', None)] * (count or 1)
+
+    return [('cpu', cpus) for cpus in cpu_groups(count or len(numa_nodes()))]
+
+
+class Channel:
+    # connection shared by the worker thread and the preview executor
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+
+class WorkerJob(imagine_jobs.Job):
+    """
+    Job executed in a worker process on behalf of one in the front process.
+
+    Samples, results and timings published by `run_pipe` are sent to the front process,
+    which hands them to the original job. The front forwards cancellation of the original
+    job, which sets `stop_event`.
+    """
+    def __init__(self, channel, run, index, params, queued):
+        super().__init__(params, size=len(params['seeds']))
+        self.channel = channel
+        self.run = run
+        self.index = index
+
+        self.started = time.monotonic()
+        self.submitted = self.started - queued
+
+    def cancelled(self):
+        return self.stop_event.is_set()
+
+    def put_sample(self, sample):
+        self.channel.send(('sample', self.run, self.index, sample))
+
+    def put_result(self, result):
+        # exceptions of torch or diffusers may not unpickle in the front process
+        if isinstance(result, Exception):
+            result = Exception(str(result))
+        self.channel.send(('result', self.run, self.index, result))
+
+    def add_timing(self, stage, value):
+        self.channel.send(('timing', self.run, self.index, stage, value))
+
+    def set_memory(self, memory):
+        self.channel.send(('memory', self.run, self.index, memory))
+
+
+class RemoteMetrics:
+    # `imagine_metrics.Metrics` of a worker process, observations go to the front process
+    def __init__(self, channel):
+        self.channel = channel
+
+    def observe(self, stage, seconds):
+        self.channel.send(('observe', stage, seconds))
+
+    def count_images(self, count):
+        self.channel.send(('images', count))
+
+
+def worker_main(conn, device, cpus, args):
+    # worker process: owns the pipelines of `device` and runs jobs sent by the front process
+    if cpus:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+    if device.startswith('cuda'):
+        torch.cuda.set_device(torch.device(device))
+
+    import imagine_pipes
+    import imagine_server
+
+    channel = Channel(conn)
+    imagine_server.setup_pipelines(args, device)
+    imagine_server.metrics = RemoteMetrics(channel)
+
+    requests = queue.Queue()
+    jobs = {} # (run, index) -> running job
+    cancelled = set() # (run, index) cancelled before its job was created
+    lock = threading.Lock()
+
+    def read():
+        # cancellations apply right away, everything else in order on the main thread
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'cancel':
+                    with lock:
+                        if message[1:] in jobs:
+                            jobs[message[1:]].stop_event.set()
+                        else:
+                            cancelled.add(message[1:])
+                else:
+                    requests.put(message)
+        except (EOFError, OSError):
+            requests.put(None)
+
+    threading.Thread(target=read, name='imagine-worker-reader', daemon=True).start()
+    print(f'Worker {os.getpid()} ready on {device}' + (f', cpus {cpus[0]}-{cpus[-1]}' if cpus else ''))
+
+    while True:
+        message = requests.get()
+        if message is None:
+            return
+
+        error = None
+        try:
+            if message[0] == 'run':
+                _, run, entries = message
+                with lock:
+                    for index, (params, queued) in enumerate(entries):
+                        jobs[(run, index)] = WorkerJob(channel, run, index, params, queued)
+                        if (run, index) in cancelled:
+                            jobs[(run, index)].stop_event.set()
+                    cancelled.clear()
+                try:
+                    imagine_server.execute_jobs([jobs[(run, index)] for index in range(len(entries))], device)
+                finally:
+                    with lock:
+                        jobs.clear()
+            elif message[0] == 'load':
+                imagine_server.pipe_cache.get(message[1], device, imagine_server.fp_prec)
+        except Exception as e:
+            error = str(e)
+
+        state = {
+            'resident': [key[0] for key in imagine_server.pipe_cache.resident()],
+            'memory': imagine_pipes.device_memory(device)
+        }
+        channel.send(('done', error, state))
+
+
+class WorkerProcess:
+    """
+    Front process handle of one worker process.
+
+    `execute` sends jobs to the worker and relays what it publishes to the jobs until the
+    worker is done with them, so for the scheduler it behaves like in-process execution.
+    Messages travel over a pipe, streamed samples and final images included. A worker
+    that exited is started again by the next call.
+    """
+    def __init__(self, index, device, cpus, args, metrics, result_cache):
+        self.index = index
+        self.device = device
+        self.cpus = cpus
+        self.args = args
+        self.metrics = metrics
+        self.result_cache = result_cache # workers run without one, results are cached here
+
+        self.resident = set() # real paths of models loaded in the worker
+        self.memory = {} # device memory use reported by the worker
+        self.runs = itertools.count()
+
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock() # one call at a time
+
+    def __str__(self):
+        return f'{self.index}:{self.device}'
+
+    def start(self):
+        # caller holds `lock`
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn, self.device, self.cpus, self.args), name=f'imagine-worker-{self.index}', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.resident = set()
+
+    def call(self, message, jobs=(), run=None):
+        # send `message` and relay worker messages to `jobs` until it is done, caller holds `lock`
+        if self.process is None or not self.process.is_alive():
+            self.start()
+
+        cancelled = set()
+        try:
+            self.conn.send(message)
+
+            while True:
+                # forward requests that went away since the last check
+                for index, job in enumerate(jobs):
+                    if index not in cancelled and job.cancelled():
+                        self.conn.send(('cancel', run, index))
+                        cancelled.add(index)
+
+                if not self.conn.poll(CANCEL_POLL_INTERVAL):
+                    continue
+
+                message = self.conn.recv()
+                if message[0] == 'sample':
+                    jobs[message[2]].put_sample(message[3])
+                elif message[0] == 'result':
+                    job, result = jobs[message[2]], message[3]
+                    if job.params['cache'] and not isinstance(result, Exception):
+                        for key, png in zip(job.params['keys'], result):
+                            self.result_cache.put(key, png)
+                    job.put_result(result)
+                elif message[0] == 'timing':
+                    jobs[message[2]].add_timing(message[3], message[4])
+                elif message[0] == 'memory':
+                    jobs[message[2]].set_memory(message[3])
+                elif message[0] == 'observe':
+                    self.metrics.observe(message[1], message[2])
+                elif message[0] == 'images':
+                    self.metrics.count_images(message[1])
+                elif message[0] == 'done':
+                    _, error, state = message
+                    self.resident = set(state['resident'])
+                    self.memory = state['memory']
+                    if error is not None:
+                        raise Exception(error)
+                    return
+
+        except (EOFError, OSError):
+            self.process.join(1)
+            raise Exception(f'Worker {self} exited with code {self.process.exitcode}')
+
+    def execute(self, jobs):
+        # scheduler `execute` for this worker, queue time travels along for metrics
+        now = time.monotonic()
+        with self.lock:
+            run = next(self.runs)
+            entries = [(job.params, (job.started or now) - job.submitted) for job in jobs]
+            self.call(('run', run, entries), jobs, run)
+
+    def load(self, model_path):
+        with self.lock:
+            self.call(('load', model_path))
+
+    def has_model(self, model_path):
+        return os.path.realpath(model_path) in self.resident